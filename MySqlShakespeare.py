@@ -7,15 +7,53 @@ available from:
     <http://www.ibiblio.org/xml/examples/shakespeare/>
 """
 from __future__ import print_function
+import concurrent.futures
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import os
 import re
+import shutil
+import socket
+import time
+import urllib.error
 import urllib.request
 import xml.etree.ElementTree
 import xml.dom.minidom
+import zlib
 import mysql.connector
+import gutenberg
+import playparser
+import textindex
 
-FILE_CACHE = "P:/src/databases/cache"
+FILE_CACHE = os.environ.get('SHAKESPEARE_CACHE', "P:/src/databases/cache")
 GUT_INDEX = 'http://www.gutenberg.org/dirs/GUTINDEX.ALL'
+# the Shakespeare works found in GUTINDEX.ALL, saved in the cache root
+GUT_WORKS = 'gutindex_works.json'
+# pass DownloadHandler(mysql_config=...) to use another server, e.g. a local one
+MYSQL_CONFIG = {'user': 'pi', 'password': 'raspberry', 'host': '192.168.1.200',
+                'database': 'shakespeare'}
+BATCH_SIZE = 5000
+# the positional index; databases made before it was filled have these
+# tables without their keys, see DownloadHandler.upgrade_index
+WORD_TO_LINE_TABLE = '''
+            CREATE TABLE IF NOT EXISTS word_to_line
+                  (word_id  INTEGER,
+                   line_id  INTEGER,
+                   line_pos INTEGER,
+                   PRIMARY KEY (word_id, line_id, line_pos),
+                   KEY (line_id)
+                   );'''
+# binary collation: the tokens are already lower cased, and 'e' and
+# 'é' must stay different words under the unique key
+WORDS_TABLE = '''
+            CREATE TABLE IF NOT EXISTS words
+                  (id       INTEGER PRIMARY KEY AUTO_INCREMENT,
+                   word     VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+                   UNIQUE KEY (word)
+                   );'''
 
 MOBY_INDEX = [
     ("All's Well That Ends Well",
@@ -99,10 +137,52 @@ MOBY_INDEX = [
 
 class Cache(object):
     """Provide a local filesystem cache for material.
+
+    A manifest (manifest.json in the cache root) records the ETag,
+    Last-Modified, size and sha256 of every downloaded url so that a
+    refresh can revalidate with conditional requests, interrupted
+    downloads can be resumed with Range requests and files can be checked
+    for corruption when they are read.
+
+    With compress=True files are stored gzipped and decompressed as they
+    are read. With max_bytes set, the least recently used files are evicted
+    whenever the stored total goes over it.
     """
 
-    def __init__(self):
-        pass
+    MANIFEST = 'manifest.json'
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, root=FILE_CACHE, compress=True, max_bytes=None, retries=3):
+        self.root = root
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self._manifest = None
+        self.stats = {'hits': 0, 'not_modified': 0, 'downloads': 0,
+                      'resumed': 0, 'bytes': 0, 'corrupt': 0,
+                      'bytes_saved': 0, 'evictions': 0}
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.root, self.MANIFEST)) as f:
+                    self._manifest = json.load(f)
+            except FileNotFoundError:
+                self._manifest = {}
+        return self._manifest
+
+    def save_manifest(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        path = os.path.join(self.root, self.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def key(self, url, version=''):
+        "Manifest key of a version of url."
+        return version + ' ' + url if version else url
 
     def path(self, remote_url, version=''):
         """Get local path to text of remote url.
@@ -116,27 +196,239 @@ class Cache(object):
         localPath = self.path_from_offset(offset)
         return localPath
 
-    def download_url(self, url, overwrite=False):
+    def stored_path(self, url, version=''):
+        """Get the path the cached copy is actually stored under, which is
+        path() plus .gz for compressed entries.
+        """
+        entry = self.manifest.get(self.key(url, version))
+        localPath = self.path(url, version)
+        if entry is not None and 'compressed' in entry:
+            return localPath + '.gz' if entry['compressed'] else localPath
+        # not in the manifest yet: a plain file cached before compression
+        if os.path.exists(localPath):
+            return localPath
+        return localPath + '.gz' if self.compress else localPath
+
+    def exists(self, url, version=''):
+        return os.path.exists(self.stored_path(url, version))
+
+    def download_url(self, url, overwrite=False, refresh=False):
         """Download a url to the local cache
         @overwrite: if True overwrite an existing local copy otherwise don't
+        @refresh: if True revalidate an existing local copy with a
+            conditional request and only download it again if it changed
         """
         localPath = self.path(url)
         dirpath = os.path.dirname(localPath)
-        if overwrite or not(os.path.exists(localPath)):
-            if not os.path.exists(dirpath):
-                os.makedirs(dirpath)
-            # use wget as it seems to work more reliably on wikimedia
-            # see extensive comments on issue in shakespeare.eb.Wikimedia class
-            # rgrp: 2008-03-18 use urllib rather than wget despite these issues
-            # as wget is fairly specific to linux/unix and even there may not
-            # be installed.
-            # cmd = 'wget -O %s %s' % (localPath, url) 
-            # os.system(cmd)
-            urllib.request.urlretrieve(url, localPath)
+        exists = self.exists(url)
+        if exists and not (overwrite or refresh):
+            self.stats['hits'] += 1
+            return self.stored_path(url)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        # rgrp: 2008-03-18 use urllib rather than wget, as wget is fairly
+        # specific to linux/unix and even there may not be installed.
+        conditional = exists and refresh and not overwrite
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, localPath, conditional)
+                return self.stored_path(url)
+            except (http.client.IncompleteRead, ConnectionError, socket.timeout) as e:
+                # whatever arrived is kept in the .part file and resumed
+                if attempt == self.retries:
+                    raise
+                print('Retrying %s after %r' % (url, e))
+
+    def _fetch(self, url, localPath, conditional):
+        entry = self.manifest.get(url, {})
+        partPath = localPath + '.part'
+        headers = {}
+        if conditional:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        partial = entry.get('partial')
+        offset = os.path.getsize(partPath) if partial and os.path.exists(partPath) else 0
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            validator = partial.get('etag') or partial.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.stats['not_modified'] += 1
+                self.touch(url)
+                return
+            if e.code == 416 and offset:
+                # the partial file is no use any more, start again
+                os.remove(partPath)
+                del entry['partial']
+                return self._fetch(url, localPath, conditional)
+            raise
+        with response:
+            digest = hashlib.sha256()
+            if response.status == 206:
+                self.stats['resumed'] += 1
+                mode = 'ab'
+                with open(partPath, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                        digest.update(chunk)
+            else:
+                mode = 'wb'
+                offset = 0
+            entry['partial'] = {'etag': response.headers.get('ETag'),
+                                'last_modified': response.headers.get('Last-Modified')}
+            self.manifest[url] = entry
+            self.save_manifest()
+            received = 0
+            with open(partPath, mode) as f:
+                for chunk in iter(lambda: response.read(self.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    received += len(chunk)
+                    self.stats['bytes'] += len(chunk)
+            length = response.headers.get('Content-Length')
+            if length is not None and received < int(length):
+                # read(amt) just stops short when the server hangs up
+                raise http.client.IncompleteRead(b'', int(length) - received)
+        self.stats['downloads'] += 1
+        self._store(url, '', partPath, digest.hexdigest(), {
+            'etag': entry['partial']['etag'],
+            'last_modified': entry['partial']['last_modified'],
+            'fetched': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    def store_file(self, url, version, srcPath, fields=None):
+        """Move srcPath into the cache as the given version of url.
+        @fields: extra fields for its manifest entry
+        """
+        digest = hashlib.sha256()
+        with open(srcPath, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        dirpath = os.path.dirname(self.path(url, version))
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        self._store(url, version, srcPath, digest.hexdigest(), dict(fields or {}))
+
+    def _store(self, url, version, srcPath, sha256, entry):
+        localPath = self.path(url, version)
+        size = os.path.getsize(srcPath)
+        # drop whichever form the old copy was stored in
+        for old in (localPath, localPath + '.gz'):
+            if os.path.exists(old):
+                os.remove(old)
+        if self.compress:
+            with open(srcPath, 'rb') as src, gzip.open(localPath + '.gz.tmp', 'wb', 6) as dest:
+                shutil.copyfileobj(src, dest, self.CHUNK_SIZE)
+            os.replace(localPath + '.gz.tmp', localPath + '.gz')
+            os.remove(srcPath)
+            stored = os.path.getsize(localPath + '.gz')
+        else:
+            os.replace(srcPath, localPath)
+            stored = size
+        self.stats['bytes_saved'] += size - stored
+        entry.update({'size': size, 'stored_size': stored, 'sha256': sha256,
+                      'compressed': self.compress, 'accessed': time.time()})
+        key = self.key(url, version)
+        self.manifest[key] = entry
+        self.evict(keep=key)
+        self.save_manifest()
+
+    def touch(self, url, version=''):
+        "Mark url as recently used for LRU eviction."
+        entry = self.manifest.get(self.key(url, version))
+        if entry is not None:
+            entry['accessed'] = time.time()
+            self.save_manifest()
+
+    def total_size(self):
+        return sum(entry.get('stored_size', 0) for entry in self.manifest.values())
+
+    def evict(self, max_bytes=None, keep=None):
+        """Remove least recently used files until the cache fits in max_bytes.
+        @keep: manifest key that must not be evicted
+        @return: number of files evicted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return 0
+        total = self.total_size()
+        evicted = 0
+        entries = sorted((entry.get('accessed', 0), key) for key, entry in self.manifest.items()
+                         if 'stored_size' in entry and key != keep)
+        for accessed, key in entries:
+            if total <= max_bytes:
+                break
+            version, _, url = key.rpartition(' ')
+            path = self.stored_path(url, version)
+            if os.path.exists(path):
+                os.remove(path)
+            total -= self.manifest.pop(key)['stored_size']
+            evicted += 1
+        self.stats['evictions'] += evicted
+        if evicted:
+            self.save_manifest()
+        return evicted
+
+    def _read_stored(self, path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+        return open(path, 'rb')
+
+    def verify(self, url, version=''):
+        """Check the cached copy of url against the size and checksum in the
+        manifest. Files cached before the manifest existed are trusted.
+        """
+        entry = self.manifest.get(self.key(url, version))
+        path = self.stored_path(url, version)
+        if not entry or 'sha256' not in entry:
+            return os.path.exists(path)
+        if not os.path.exists(path) or os.path.getsize(path) != entry['stored_size']:
+            return False
+        digest = hashlib.sha256()
+        try:
+            with self._read_stored(path) as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        except (OSError, EOFError, zlib.error):
+            return False
+        return digest.hexdigest() == entry['sha256']
+
+    def open(self, url, encoding=None, refresh=False, version=''):
+        """Open the cached copy of url, downloading it if need be.
+
+        Compressed copies are decompressed as they are read. A downloaded
+        copy that fails verification is downloaded again.
+        @encoding: if given open in text mode with this encoding, else binary
+        @version: open a derived version (e.g. 'plain') stored with store_file
+        """
+        if not version:
+            self.download_url(url, refresh=refresh)
+            if not self.verify(url):
+                self.stats['corrupt'] += 1
+                print('Cached copy of %s is corrupt, downloading again' % url)
+                self.download_url(url, overwrite=True)
+        self.touch(url, version)
+        f = self._read_stored(self.stored_path(url, version))
+        if encoding:
+            return io.TextIOWrapper(f, encoding=encoding)
+        return f
+
+    def report(self):
+        stats = dict(self.stats)
+        stats['hit_ratio'] = 100.0 * stats['hits'] / max(stats['hits'] + stats['downloads'], 1)
+        stats['total'] = self.total_size()
+        return ('cache: %(hits)d hits, %(not_modified)d not modified, '
+                '%(downloads)d downloads (%(resumed)d resumed), %(hit_ratio).0f%% hit ratio, '
+                '%(bytes)d bytes fetched, %(bytes_saved)d bytes saved by compression, '
+                '%(evictions)d evictions, %(corrupt)d corrupt, %(total)d bytes stored' % stats)
 
     def path_from_offset(self, offset):
         "Get full path of file in cache given by offset."
-        return os.path.join(FILE_CACHE, offset)
+        return os.path.join(self.root, offset)
 
 
 class DownloadHandler():
@@ -144,10 +436,12 @@ class DownloadHandler():
         and moby files for shakespeare's works
     '''
     
-    def __init__(self):
-        self.cache = Cache()
-        self._gutindex_local_path = self.cache.path(GUT_INDEX)
-        self.cache.download_url(GUT_INDEX)
+    def __init__(self, cache=None, mysql_config=None, verbose=False):
+        self.cache = cache or Cache()
+        self.mysql_config = mysql_config or MYSQL_CONFIG
+        self.verbose = verbose
+        self._works = None
+        self._gutindex_local_path = self.cache.download_url(GUT_INDEX)
 
 
     def make_gutenberg_url(self, year, idStr):
@@ -183,18 +477,65 @@ class DownloadHandler():
     def _extract_shakespeare_works(self):
         """Get non-copyrighted Shakespeare works from Gutenberg
         Results consist of folio and one other 'standard' version.
+
+        The works found are saved in GUT_WORKS along with the size and mtime
+        of the cached GUTINDEX.ALL, and reused until that changes.
         @return: list consisting of tuples in form [title, year, id, comment]
         """
-        ff = open(self._gutindex_local_path, encoding='latin-1')
+        # through the cache, which fetches the index again if it was evicted
+        stat = os.stat(self.cache.download_url(GUT_INDEX))
+        key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        sidecar = self.cache.path_from_offset(GUT_WORKS)
+        try:
+            with open(sidecar) as f:
+                saved = json.load(f)
+            if saved['key'] == key:
+                return saved['works']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        results = self._scan_gutindex()
+        with open(sidecar + '.tmp', 'w') as f:
+            json.dump({'key': key, 'works': results}, f, indent=1)
+        os.replace(sidecar + '.tmp', sidecar)
+        return results
+
+    def _scan_gutindex(self):
+        "Parse the Shakespeare lines of GUTINDEX.ALL in one streaming pass."
         results = []
-        for line in ff.readlines():
-            result = self.parse_line_for_folio(line)
-            if result:
-                results.append(result + ['folio'])
-            resultNormal = self.parse_line_for_normal(line)
-            if resultNormal:
-                results.append(resultNormal + [''])
+        tail = b''
+        with self.cache.open(GUT_INDEX) as ff:
+            for block in iter(lambda: ff.read(self.cache.CHUNK_SIZE * 16), b''):
+                block = tail + block
+                end = block.rfind(b'\n') + 1
+                block, tail = block[:end], block[end:]
+                for line in self._marked_lines(block):
+                    self._parse_index_line(line.decode('latin-1'), results)
+        for line in self._marked_lines(tail):
+            self._parse_index_line(line.decode('latin-1'), results)
         return results
+
+    def _marked_lines(self, block):
+        """The lines of block either parser could match, in order. Almost
+        every line is some other author's, so rather than splitting block
+        into lines the markers are searched for and only their lines cut out.
+        """
+        starts = set()
+        for marker in (b'Shakespeare', b'[FF]'):
+            i = block.find(marker)
+            while i != -1:
+                starts.add(block.rfind(b'\n', 0, i) + 1)
+                i = block.find(marker, i + len(marker))
+        for start in sorted(starts):
+            end = block.find(b'\n', start)
+            yield block[start:] if end == -1 else block[start:end + 1]
+
+    def _parse_index_line(self, line, results):
+        result = self.parse_line_for_folio(line)
+        if result:
+            results.append(result + ['folio'])
+        resultNormal = self.parse_line_for_normal(line)
+        if resultNormal:
+            results.append(resultNormal + [''])
     
     def parse_line_for_normal(self, line):
         """Parse GUTINDEX for 'normal' gutenberg shakespeare versions (i.e. not
@@ -232,30 +573,82 @@ class DownloadHandler():
         else:
             return None
 
-    def clean_gutenberg(self, line=None):
-        '''See parent class.
-        '''
-        textsToProcess = self._filter_index(line) 
-        for item in textsToProcess:
+    @property
+    def _index(self):
+        "The Gutenberg works as get_relevant_works lists them, worked out once."
+        if self._works is None:
+            self._works = self.get_relevant_works()
+        return self._works
+
+    def _filter_index(self, line=None):
+        """The works of the index whose title contains line (in any case),
+        or all of them.
+        """
+        if line is None:
+            return list(self._index)
+        return [item for item in self._index if line.lower() in item[0].lower()]
+
+    def _source_checksum(self, url):
+        entry = self.cache.manifest.get(url, {})
+        if 'sha256' in entry:
+            return entry['sha256']
+        # cached before the manifest recorded checksums
+        digest = hashlib.sha256()
+        with self.cache._read_stored(self.cache.stored_path(url)) as f:
+            for chunk in iter(lambda: f.read(self.cache.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _is_clean(self, url, source_sha256):
+        "Is the plain copy of url there and made from this source by this cleaner?"
+        entry = self.cache.manifest.get(self.cache.key(url, gutenberg.PLAIN), {})
+        return (self.cache.exists(url, gutenberg.PLAIN)
+                and entry.get('source_sha256') == source_sha256
+                and entry.get('cleaner') == gutenberg.CLEANER_VERSION)
+
+    def clean_gutenberg(self, line=None, workers=None):
+        """Strip the Gutenberg header and footer from the works in the index
+        (those whose title contains line, if given) and cache the result as
+        the 'plain' version of each url.
+
+        Texts are cleaned in a process pool. A plain copy made from a source
+        with the same checksum by the same cleaner version is left alone.
+        @return: dict of texts cleaned and skipped, bytes read and seconds
+        """
+        t = time.time()
+        stats = {'cleaned': 0, 'skipped': 0, 'read': 0, 'written': 0}
+        jobs = {}
+        for item in self._filter_index(line):
             url = item[1]
-            src = self.cache.path(url)
-            dest = self.cache.path(url, 'plain')
-            if os.path.exists(dest):
+            src = self.cache.download_url(url)
+            checksum = self._source_checksum(url)
+            if self._is_clean(url, checksum):
                 if self.verbose:
-                    print('Skip clean of %s as clean version already exists' % src)
+                    print('Skip clean of %s as clean version is up to date' % src)
+                stats['skipped'] += 1
                 continue
-            if self.verbose:
-                print('Formatting %s to %s' % (src, dest))
-            infile = file(src)
-            if src.endswith('wssnt10.txt'): # if it is the sonnets need a hack
-                # delete last 140 characters
-                tmp1 = infile.read()
-                infile = StringIO.StringIO(tmp1[:-120])
-            formatter = shakespeare.gutenberg.GutenbergCleaner(infile)
-            ff = file(dest, 'w')
-            out = formatter.extract_text()
-            ff.write(out)
-            ff.close()
+            jobs[url] = (src, self.cache.path(url, gutenberg.PLAIN) + '.tmp',
+                         gutenberg.TRIM_TAIL.get(url.rsplit('/', 1)[1], 0))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(gutenberg.clean_file, *job): url
+                       for url, job in jobs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                result = future.result()
+                if self.verbose:
+                    print('Formatted %s (%d bytes) in %.2fs'
+                          % (url, result['read'], result['time']))
+                # the manifest is only ever written from this process
+                self.cache.store_file(url, gutenberg.PLAIN, jobs[url][1],
+                                      {'source_sha256': result['source_sha256'],
+                                       'cleaner': gutenberg.CLEANER_VERSION})
+                stats['cleaned'] += 1
+                stats['read'] += result['read']
+                stats['written'] += result['written']
+        stats['time'] = time.time() - t
+        print('Cleaned %(cleaned)d texts (%(skipped)d up to date), %(read)d bytes in %(time).2fs'
+              % stats + ', %.1f MB/s' % (stats['read'] / 1e6 / max(stats['time'], 1e-9)))
+        return stats
 
     def add_to_db_gutenberg(self):
         """Add all gutenberg texts to the db list of texts.
@@ -375,19 +768,35 @@ class DownloadHandler():
             result['acts'].append(self.handle_act(act))
         return result
     
-    def get_moby_works(self):
+    def parse_play(self, play_text, streaming=False):
+        if streaming:
+            return playparser.parse_play(play_text)
+        return self.handle_play(xml.dom.minidom.parseString(play_text))
+
+    def get_moby_works(self, streaming=False, play_cache=None):
+        """Parse every cached Moby play into self.plays.
+        @streaming: if True use the iterparse based playparser instead of a DOM
+        @play_cache: a playcache.ParsedPlayCache to load already parsed plays from
+        """
         self.plays = []
         for item in MOBY_INDEX:
-            self.cache.download_url(item[1])
-            dom = xml.dom.minidom.parse(self.cache.path(item[1]))
-            play = self.handle_play(dom)
+            with self.cache.open(item[1]) as f:
+                if play_cache is not None:
+                    play = play_cache.get_or_parse(
+                        f.read(), lambda text: self.parse_play(text, streaming))
+                elif streaming:
+                    play = playparser.build_play(playparser.iter_play_rows(f))
+                else:
+                    play = self.handle_play(xml.dom.minidom.parse(f))
             print(play['title'])
             self.plays.append(play)
 
 
+    def connect_mysql(self):
+        return mysql.connector.connect(**self.mysql_config)
+
     def create_mysql(self):
-        conn = mysql.connector.connect(user='pi', password='raspberry',host='192.168.1.200',
-                                       database='shakespeare')
+        conn = self.connect_mysql()
         c = conn.cursor()
         # Now create the tables
         c.execute('''CREATE TABLE IF NOT EXISTS plays
@@ -421,17 +830,8 @@ class DownloadHandler():
                   the_text  TEXT,
                   speaker   TEXT
                   );''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS word_to_line
-                  (word_id  INTEGER,
-                   line_id  INTEGER,
-                   line_pos INTEGER
-                   );''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS words
-                  (id       INTEGER PRIMARY KEY AUTO_INCREMENT,
-                   word     TEXT
-                   );''')
+        c.execute(WORD_TO_LINE_TABLE)
+        c.execute(WORDS_TABLE)
         c.execute('''
             CREATE TABLE IF NOT EXISTS person
                  (id        INTEGER PRIMARY KEY AUTO_INCREMENT,
@@ -442,12 +842,83 @@ class DownloadHandler():
                   );''')
 
         conn.commit()
+        self.upgrade_index(conn)
+
+    def _index_is_current(self, c):
+        "True if word_to_line and words have the keys WordIndex seeks on."
+        c.execute('SHOW INDEX FROM word_to_line')
+        # (Key_name, Column_name) of each indexed column
+        keys = {(row[2], row[4]) for row in c.fetchall()}
+        c.execute('SHOW INDEX FROM words')
+        unique_word = any(row[4] == 'word' and not row[1] for row in c.fetchall())
+        return (('PRIMARY', 'word_id') in keys and
+                any(column == 'line_id' and key != 'PRIMARY' for key, column in keys) and
+                unique_word)
+
+    def upgrade_index(self, conn):
+        """Rebuild words and word_to_line with their keys if they were made by
+        the code that created them unindexed (and never filled them). Both
+        are derived from actor_lines, so the lines already stored are
+        indexed again. Returns True if they were rebuilt.
+        """
+        c = conn.cursor()
+        if self._index_is_current(c):
+            return False
+        print('Rebuilding the word index with its keys')
+        c.execute('DROP TABLE IF EXISTS word_to_line')
+        c.execute('DROP TABLE IF EXISTS words')
+        c.execute(WORD_TO_LINE_TABLE)
+        c.execute(WORDS_TABLE)
+        self._load_word_ids(c)
+        last_id = 0
+        while True:
+            c.execute('''SELECT id, the_text FROM actor_lines WHERE id > %s
+                         ORDER BY id LIMIT %s''', (last_id, BATCH_SIZE))
+            rows = c.fetchall()
+            if not rows:
+                break
+            for line_id, text in rows:
+                self._index_line(line_id, text)
+            last_id = rows[-1][0]
+            self._flush_index(c)
+            conn.commit()
+        return True
+
+    def _load_word_ids(self, c):
+        """Start handing out word ids after those already in words; they are
+        assigned here so postings can be batched with them."""
+        c.execute('SELECT id, word FROM words')
+        self._word_ids = {word: word_id for word_id, word in c}
+        self._next_word_id = max(self._word_ids.values(), default=0) + 1
+        self._new_words = []
+        self._postings = []
+
+    def _index_line(self, line_id, text):
+        """Queue the word_to_line postings of one stored line."""
+        for line_pos, word in textindex.positions(text):
+            word_id = self._word_ids.get(word)
+            if word_id is None:
+                word_id = self._word_ids[word] = self._next_word_id
+                self._next_word_id += 1
+                self._new_words.append((word_id, word))
+            self._postings.append((word_id, line_id, line_pos))
+
+    def _flush_index(self, c):
+        """Bulk load the queued words and postings."""
+        for i in range(0, len(self._new_words), BATCH_SIZE):
+            c.executemany('INSERT INTO words (id, word) VALUES (%s,%s)',
+                          self._new_words[i:i + BATCH_SIZE])
+        for i in range(0, len(self._postings), BATCH_SIZE):
+            c.executemany('''INSERT INTO word_to_line (word_id, line_id, line_pos)
+                             VALUES (%s,%s,%s)''', self._postings[i:i + BATCH_SIZE])
+        self._new_words = []
+        self._postings = []
 
     def write_to_mysql(self):
         self.create_mysql()
-        conn = mysql.connector.connect(user='pi', password='raspberry',host='192.168.1.200',
-                                       database='shakespeare')
+        conn = self.connect_mysql()
         c = conn.cursor()
+        self._load_word_ids(c)
         for play in self.plays:
             print(play['title'])
             c.execute('''
@@ -502,6 +973,7 @@ class DownloadHandler():
                                VALUES (%s,%s,%s,%s,%s,%s)''',
                                (play_id, act_id, scene_id,
                                 1, content[1], 'None'))
+                            self._index_line(c.lastrowid, content[1])
                         else:
                             try:
                                 speaker = content[1]['speaker']
@@ -516,11 +988,13 @@ class DownloadHandler():
                                     (play_id, act_id, scene_id,
                                      0, line, speaker))
                                 line_id = c.lastrowid
+                                self._index_line(line_id, line)
 
                     # Increment scene_num
                     scene_num = scene_num + 1
                 # Increment act num
                 act_num = act_num + 1
+            self._flush_index(c)
             # Commit this play.
             conn.commit()
 
@@ -563,24 +1037,110 @@ class DownloadHandler():
         
 
 
+class WordIndex(object):
+    ''' Queries over the positional index in words/word_to_line that
+        write_to_mysql fills. Query words go through the same tokenizer as
+        the lines did, so 'King,' finds the postings of 'king'. Every query
+        is an index seek on word_to_line's (word_id, line_id, line_pos) key
+        rather than a LIKE scan over actor_lines.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _words(self, words):
+        if isinstance(words, str):
+            words = [words]
+        tokens = []
+        for word in words:
+            tokens.extend(token for token in textindex.tokenize(word) if token not in tokens)
+        return tokens
+
+    def word_ids(self, words):
+        "Map the known words among words to their ids."
+        tokens = self._words(words)
+        if not tokens:
+            return {}
+        c = self.conn.cursor()
+        c.execute('SELECT word, id FROM words WHERE word IN (%s)'
+                  % ','.join(['%s'] * len(tokens)), tokens)
+        return dict(c.fetchall())
+
+    def _match(self, words, operator):
+        """SQL (and its parameters) selecting the ids of the matching lines."""
+        if operator not in ('and', 'or'):
+            raise ValueError('operator must be "and" or "or", not %r' % operator)
+        tokens = self._words(words)
+        ids = list(self.word_ids(tokens).values())
+        if not ids or (operator == 'and' and len(ids) < len(tokens)):
+            # a word that is not in the index matches nothing
+            return None, None
+        marks = ','.join(['%s'] * len(ids))
+        if operator == 'or':
+            return ('SELECT DISTINCT line_id FROM word_to_line WHERE word_id IN (%s)' % marks,
+                    ids)
+        return ('''SELECT line_id FROM word_to_line WHERE word_id IN (%s)
+                   GROUP BY line_id HAVING COUNT(DISTINCT word_id) = %%s''' % marks,
+                ids + [len(ids)])
+
+    def postings(self, word):
+        "(line_id, line_pos) of every occurrence of word, in line order."
+        ids = list(self.word_ids(word).values())
+        if len(ids) != 1:
+            return []
+        c = self.conn.cursor()
+        c.execute('''SELECT line_id, line_pos FROM word_to_line
+                     WHERE word_id = %s ORDER BY line_id, line_pos''', (ids[0],))
+        return c.fetchall()
+
+    def lines(self, words, operator='and'):
+        """Ids of the lines holding all (operator='and') or any ('or') of words."""
+        sql, params = self._match(words, operator)
+        if sql is None:
+            return []
+        c = self.conn.cursor()
+        c.execute(sql + ' ORDER BY line_id', params)
+        return [row[0] for row in c]
+
+    def play_postings(self, words, operator='and'):
+        """(play_id, title, matching lines) for each play, most matches first."""
+        sql, params = self._match(words, operator)
+        if sql is None:
+            return []
+        c = self.conn.cursor()
+        c.execute('''SELECT plays.id, plays.title, COUNT(*)
+                     FROM (%s) AS matches
+                     JOIN actor_lines ON actor_lines.id = matches.line_id
+                     JOIN plays ON plays.id = actor_lines.play_id
+                     GROUP BY plays.id, plays.title
+                     ORDER BY COUNT(*) DESC''' % sql, params)
+        return c.fetchall()
+
+    def search(self, words, operator='and'):
+        """The matching lines as (the_text, speaker, title) rows."""
+        sql, params = self._match(words, operator)
+        if sql is None:
+            return []
+        c = self.conn.cursor()
+        c.execute('''SELECT actor_lines.the_text, actor_lines.speaker, plays.title
+                     FROM (%s) AS matches
+                     JOIN actor_lines ON actor_lines.id = matches.line_id
+                     JOIN plays ON plays.id = actor_lines.play_id
+                     ORDER BY actor_lines.id''' % sql, params)
+        return c.fetchall()
+
+
 def main():
     handler = DownloadHandler()
     handler.get_moby_works()
     handler.write_to_mysql()
 
-    conn = mysql.connector.connect(user='pi', password='raspberry',host='192.168.1.200',
-                                   database='shakespeare')
-    c = conn.cursor()
-    #c.execute('''select actor_lines.the_text, actor_lines.speaker, plays.title from actor_lines, plays WHERE
-    #                    plays.id = actor_lines.play_id AND
-    #                    actor_lines.the_text LIKE %s
-    #                    ''', ('%the%',))
-    c.execute('''select count(actor_lines.the_text) from actor_lines, plays WHERE
-                        plays.id = actor_lines.play_id AND
-                        actor_lines.the_text LIKE %s
-                        ''', ('%the%',))
-    x = 0
-    for row in c:
+    conn = handler.connect_mysql()
+    index = WordIndex(conn)
+    #for row in index.search(['the']):
+    #    print(row)
+    x = len(index.lines(['the']))
+    for row in index.play_postings(['the']):
         print(row)
     print(x)
 
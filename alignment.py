@@ -0,0 +1,410 @@
+# coding: utf-8
+
+"""
+Line by line alignment of a play's First Folio text with its standard edition.
+
+Aligning about 3,000 lines against 3,000 with a plain dynamic programming
+diff costs some nine million line comparisons per play. Instead the two
+texts are anchored first: a hapax index (words and whole lines, spelling
+normalised, that occur exactly once in each text) gives pairs of lines that
+must correspond, the longest increasing subsequence of them keeps those
+that agree in order, and only the short stretches between anchors are left.
+Each stretch is anchored again on what is unique within it, and whatever is
+left without anchors is aligned by Hirschberg's linear space version of the
+similarity-weighted diff.
+
+The result goes into the alignments table, one row per aligned position:
+
+    kind 'same'      the lines match once spelling is normalised
+         'variant'   the lines correspond but read differently
+         'folio'     only in the folio
+         'standard'  only in the standard edition
+
+    pairs = edition_pairs(conn)
+    align_all(syncshake.DBFILE)
+    for row in variants(conn, 'Hamlet'): ...
+"""
+import bisect
+import collections
+import concurrent.futures
+import re
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Text, Tuple
+
+from textindex import tokenize
+
+FOLIO = 'gutenberg folio'
+# the edition a folio is aligned against, in order of preference
+STANDARD_EDITIONS = ('gutenberg', 'moby')
+# lines less alike than this are never paired, only reported one-sided
+MIN_SIMILARITY = 0.3
+# stretches with no anchors and more line pairs than this are not aligned
+# by the quadratic time diff but reported one-sided
+MAX_CELLS = 1000000
+
+ALIGN_TABLES: List[Text] = ['''CREATE TABLE IF NOT EXISTS alignments
+                              (folio_play_id    INTEGER,
+                               standard_play_id INTEGER,
+                               position         INTEGER,
+                               folio_line_id    INTEGER,
+                               standard_line_id INTEGER,
+                               kind             TEXT,
+                               similarity       REAL,
+                               PRIMARY KEY (folio_play_id, standard_play_id, position)
+                               ) WITHOUT ROWID;''',
+                            '''CREATE INDEX IF NOT EXISTS alignments_standard
+                               ON alignments (standard_play_id)''']
+
+# a play's alignments go when its lines do (see syncshake.delete_play)
+DELETE = 'DELETE FROM alignments WHERE folio_play_id = ? OR standard_play_id = ?'
+
+INSERT = '''INSERT INTO alignments
+            (folio_play_id, standard_play_id, position, folio_line_id, standard_line_id,
+             kind, similarity)
+            VALUES (?,?,?,?,?,?,?)'''
+
+DOUBLED = re.compile(r'(.)\1')
+# Folio spelling: v for u, i for j, doubled letters, a final e
+SPELLING = str.maketrans('vj', 'ui')
+
+# Titles differ between sources ("The Tragedy of Hamlet, Prince of Denmark"
+# in the Moby XML, "Hamlet" or "The Tragedie of Hamlet" in GUTINDEX), so the
+# editions of a play are paired on title_key instead. A comma before 'and' or
+# 'that' is inside the title ("Anthonie, and Cleopatra", "All's Well, that
+# Ends Well"), not before a subtitle.
+SUBTITLE = re.compile(r'[;:(]|,(?!\s*(?:and|that)\b)| or ')
+# with the Folio's fift, sixt, eight and twelfe
+TITLE_NUMBERS = {'first': '1', 'i': '1', 'second': '2', 'ii': '2', 'third': '3', 'iii': '3',
+                 'fourth': '4', 'iv': '4', 'fifth': '5', 'fift': '5', 'v': '5',
+                 'sixth': '6', 'sixt': '6', 'vi': '6', 'eighth': '8', 'eight': '8',
+                 'viii': '8', 'twelfth': '12', 'twelfe': '12'}
+# Folio title spellings the folding below does not catch
+TITLE_SPELLINGS = {'midsommer': 'midsummer'}
+TITLE_STOPWORDS = ('the', 'a', 'an', 'of', 'and', 'king', 'part', 'tragedy', 'tragedie',
+                   'comedy', 'comedie', 'history', 'historie', 'life', 'death', 'famous',
+                   'chronicle', 'true', 'lamentable')
+
+Line = collections.namedtuple('Line', 'line_id words key')
+# i, j: positions in the folio and standard lines, None on the other side
+Op = Tuple[Optional[int], Optional[int], float]
+
+
+def normalize(word: Text) -> Text:
+    """Fold the spelling differences between the Folio and a modern text."""
+    word = DOUBLED.sub(r'\1', word.translate(SPELLING))
+    if len(word) > 2 and word.endswith('e'):
+        word = word[:-1]
+    return word
+
+
+def _title_word(word: Text) -> Text:
+    word = TITLE_NUMBERS.get(word, word)
+    word = TITLE_SPELLINGS.get(word, word)
+    # Night's/Nights/Night: the Folio drops apostrophes, so the possessive
+    # goes with them, and a final s with it
+    word = word.replace("'", '')
+    if len(word) > 3 and word.endswith('s'):
+        word = word[:-1]
+    # labour/labor, Troylus/Troilus, Anthonie/Antony: only worth folding in
+    # titles
+    return normalize(re.sub(r'our\b', 'or', word).replace('y', 'i').replace('th', 't'))
+
+
+TITLE_STOP = frozenset(_title_word(word) for word in TITLE_STOPWORDS)
+
+
+def title_key(title: Text) -> Text:
+    """The words that identify a play whatever the source calls it: no
+    subtitle (except a part number), genre or articles, numbers as digits,
+    spelling normalised, in sorted order. 'The First Part of King Henry the
+    Fourth' and 'Henry IV, Part I' are both '1 4 henri'.
+    """
+    pieces = SUBTITLE.split(title.lower())
+    kept = [pieces[0]] + [piece for piece in pieces[1:] if 'part' in tokenize(piece)]
+    words = {_title_word(word) for word in tokenize(' '.join(kept))}
+    return ' '.join(sorted(words - TITLE_STOP))
+
+
+def make_line(line_id: int, text: Text) -> Line:
+    words = [normalize(word) for word in tokenize(text)]
+    return Line(line_id, frozenset(words), ' '.join(words))
+
+
+def similarity(a: Line, b: Line) -> float:
+    if a.key == b.key:
+        return 1.0
+    if not a.words or not b.words:
+        return 0.0
+    return len(a.words & b.words) / len(a.words | b.words)
+
+
+def _increasing(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """The longest chain of pairs increasing in both coordinates (pairs are
+    sorted by the first)."""
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous: List[int] = []
+    for k, (i, j) in enumerate(pairs):
+        n = bisect.bisect_left(tails, j)
+        if n == len(tails):
+            tails.append(j)
+            tail_index.append(k)
+        else:
+            tails[n] = j
+            tail_index[n] = k
+        previous.append(tail_index[n - 1] if n else -1)
+    chain = []
+    k = tail_index[-1] if tail_index else -1
+    while k != -1:
+        chain.append(pairs[k])
+        k = previous[k]
+    return chain[::-1]
+
+
+def _hapaxes(lines: Sequence[Line], start: int, end: int) -> Dict[Text, int]:
+    """Feature -> line of the features found in exactly one line of the range;
+    the features are the line's words and the whole line.
+    """
+    seen: Dict[Text, int] = {}
+    repeated = set()
+    for i in range(start, end):
+        line = lines[i]
+        for feature in line.words | {'\n' + line.key}:
+            if feature in seen:
+                repeated.add(feature)
+            else:
+                seen[feature] = i
+    for feature in repeated:
+        del seen[feature]
+    return seen
+
+
+def anchors(a: Sequence[Line], a0: int, a1: int, b: Sequence[Line], b0: int,
+            b1: int) -> List[Tuple[int, int]]:
+    """Line pairs of a[a0:a1] and b[b0:b1] sharing a hapax, in order."""
+    unique_a = _hapaxes(a, a0, a1)
+    unique_b = _hapaxes(b, b0, b1)
+    pairs = {(i, unique_b[feature]) for feature, i in unique_a.items() if feature in unique_b}
+    pairs = {(i, j) for i, j in pairs if similarity(a[i], b[j]) >= MIN_SIMILARITY}
+    # sorting on -j within an i keeps two pairs of one line out of a chain
+    return _increasing(sorted(pairs, key=lambda pair: (pair[0], -pair[1])))
+
+
+def _scores(a: Sequence[Line], b: Sequence[Line]) -> List[float]:
+    """Last row of the similarity-weighted LCS table of a against b, kept in
+    two rows of len(b) + 1."""
+    previous = [0.0] * (len(b) + 1)
+    for line in a:
+        current = [0.0]
+        for j, other in enumerate(b):
+            best = previous[j + 1] if previous[j + 1] > current[j] else current[j]
+            score = similarity(line, other)
+            if score >= MIN_SIMILARITY and previous[j] + score > best:
+                best = previous[j] + score
+            current.append(best)
+        previous = current
+    return previous
+
+
+def hirschberg(a: Sequence[Line], b: Sequence[Line], i0: int = 0, j0: int = 0) -> List[Op]:
+    """Align a with b in linear space; positions are offset by i0 and j0."""
+    if not a:
+        return [(None, j0 + j, 0.0) for j in range(len(b))]
+    if not b:
+        return [(i0 + i, None, 0.0) for i in range(len(a))]
+    if len(a) == 1:
+        scores = [similarity(a[0], other) for other in b]
+        best = max(range(len(b)), key=scores.__getitem__)
+        if scores[best] < MIN_SIMILARITY:
+            return [(i0, None, 0.0)] + [(None, j0 + j, 0.0) for j in range(len(b))]
+        return ([(None, j0 + j, 0.0) for j in range(best)] + [(i0, j0 + best, scores[best])]
+                + [(None, j0 + j, 0.0) for j in range(best + 1, len(b))])
+    middle = len(a) // 2
+    forward = _scores(a[:middle], b)
+    backward = _scores(a[middle:][::-1], b[::-1])[::-1]
+    split = max(range(len(b) + 1), key=lambda k: forward[k] + backward[k])
+    return (hirschberg(a[:middle], b[:split], i0, j0)
+            + hirschberg(a[middle:], b[split:], i0 + middle, j0 + split))
+
+
+def _align(a: Sequence[Line], a0: int, a1: int, b: Sequence[Line], b0: int, b1: int,
+           ops: List[Op]) -> None:
+    # lines that match at either end need no searching
+    while a0 < a1 and b0 < b1 and a[a0].key == b[b0].key:
+        ops.append((a0, b0, 1.0))
+        a0, b0 = a0 + 1, b0 + 1
+    tail: List[Op] = []
+    while a0 < a1 and b0 < b1 and a[a1 - 1].key == b[b1 - 1].key:
+        a1, b1 = a1 - 1, b1 - 1
+        tail.append((a1, b1, 1.0))
+    chain = anchors(a, a0, a1, b, b0, b1) if a0 < a1 and b0 < b1 else []
+    if chain:
+        for i, j in chain:
+            _align(a, a0, i, b, b0, j, ops)
+            ops.append((i, j, similarity(a[i], b[j])))
+            a0, b0 = i + 1, j + 1
+        _align(a, a0, a1, b, b0, b1, ops)
+    elif (a1 - a0) * (b1 - b0) <= MAX_CELLS:
+        ops.extend(hirschberg(a[a0:a1], b[b0:b1], a0, b0))
+    else:
+        ops.extend((i, None, 0.0) for i in range(a0, a1))
+        ops.extend((None, j, 0.0) for j in range(b0, b1))
+    ops.extend(reversed(tail))
+
+
+def align(a: Sequence[Line], b: Sequence[Line]) -> List[Op]:
+    """Anchored alignment of the folio lines a with the standard lines b."""
+    ops: List[Op] = []
+    _align(a, 0, len(a), b, 0, len(b), ops)
+    return ops
+
+
+def kind(a: Optional[Line], b: Optional[Line]) -> Text:
+    """The kind of an aligned position, given its folio and standard line."""
+    if a is None:
+        return 'standard'
+    if b is None:
+        return 'folio'
+    # not the score: the same words in another order are a variant too
+    return 'same' if a.key == b.key else 'variant'
+
+
+def play_lines(conn, play_id: int) -> List[Line]:
+    return [make_line(line_id, text) for line_id, text in conn.execute(
+        'SELECT id, the_text FROM actor_lines WHERE play_id = ? AND is_stagedir = 0 ORDER BY id',
+        (play_id,))]
+
+
+def edition_pairs(conn) -> List[Tuple[int, int, Text]]:
+    """(folio play id, standard play id, title) of every play stored in a
+    folio and a standard edition, matched on title_key. Folios with no
+    standard edition to go with them are reported.
+    """
+    standard: Dict[Tuple[Text, Text], int] = {}
+    folios = []
+    for play_id, title, edition in conn.execute('SELECT id, title, edition FROM plays '
+                                                'ORDER BY id DESC').fetchall():
+        if edition == FOLIO:
+            folios.append((play_id, title))
+        elif edition in STANDARD_EDITIONS:
+            # the first stored copy of a title wins
+            standard[(title_key(title), edition)] = play_id
+    pairs = []
+    for folio_id, title in reversed(folios):
+        key = title_key(title)
+        partner = next((standard[(key, edition)] for edition in STANDARD_EDITIONS
+                        if (key, edition) in standard), None)
+        if partner is None:
+            print('Warning: no standard edition of the folio %r (key %r), not aligned'
+                  % (title, key))
+        else:
+            pairs.append((folio_id, partner, title))
+    return pairs
+
+
+def align_pair(db: Text, folio_id: int, standard_id: int) -> Tuple[List[Tuple], Dict]:
+    """Map step of align_all: the alignments rows of one pair, and stats."""
+    conn = sqlite3.connect(db)
+    try:
+        a, b = play_lines(conn, folio_id), play_lines(conn, standard_id)
+    finally:
+        conn.close()
+    t = time.perf_counter()
+    ops = align(a, b)
+    elapsed = time.perf_counter() - t
+    rows = [(folio_id, standard_id, position,
+             a[i].line_id if i is not None else None, b[j].line_id if j is not None else None,
+             kind(a[i] if i is not None else None, b[j] if j is not None else None), score)
+            for position, (i, j, score) in enumerate(ops)]
+    counts = collections.Counter(row[5] for row in rows)
+    return rows, {'folio_lines': len(a), 'standard_lines': len(b), 'time': elapsed, **counts}
+
+
+def create_alignments(conn) -> None:
+    for sql in ALIGN_TABLES:
+        conn.execute(sql)
+    conn.commit()
+
+
+def align_all(db: Text, pairs: Iterable[Tuple[int, int, Text]] = None,
+              workers: int = None) -> Dict[Text, Dict]:
+    """Align every folio/standard pair (edition_pairs by default) in a process
+    pool and store the results, replacing any earlier alignment of a pair.
+    Returns the stats of each pair by title.
+    """
+    conn = sqlite3.connect(db)
+    create_alignments(conn)
+    pairs = list(edition_pairs(conn) if pairs is None else pairs)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(align_pair, db, folio_id, standard_id): title
+                   for folio_id, standard_id, title in pairs}
+        for future in concurrent.futures.as_completed(futures):
+            rows, stats = future.result()
+            if rows:
+                # SQLite has one writer: the results are stored from here
+                conn.execute('DELETE FROM alignments WHERE folio_play_id = ? AND '
+                             'standard_play_id = ?', rows[0][:2])
+                conn.executemany(INSERT, rows)
+                conn.commit()
+            results[futures[future]] = stats
+    conn.close()
+    return results
+
+
+def variants(conn, title: Text, kinds: Sequence[Text] = ('variant', 'folio', 'standard')
+             ) -> List[Tuple]:
+    """(position, kind, folio text, standard text) of the differences found
+    in the alignment of title, in order."""
+    return conn.execute('''SELECT alignments.position, alignments.kind, f.the_text, s.the_text
+                           FROM alignments
+                               JOIN plays ON plays.id = alignments.folio_play_id
+                               LEFT JOIN actor_lines AS f ON f.id = alignments.folio_line_id
+                               LEFT JOIN actor_lines AS s ON s.id = alignments.standard_line_id
+                           WHERE plays.title = ? AND alignments.kind IN (%s)
+                           ORDER BY alignments.folio_play_id, alignments.position'''
+                        % ','.join('?' * len(kinds)), (title,) + tuple(kinds)).fetchall()
+
+
+def benchmark(db: Text, naive_lines: int = 1000, workers: int = None) -> Dict:
+    """Time align_all over every pair, and on the first naive_lines lines of
+    the first pair, the anchored alignment against Hirschberg alone.
+    """
+    results: Dict = {}
+    t = time.perf_counter()
+    stats = align_all(db, workers=workers)
+    results['all'] = {'time': time.perf_counter() - t, 'pairs': stats}
+    lines = sum(pair['folio_lines'] + pair['standard_lines'] for pair in stats.values())
+    print('aligned %d pairs, %d lines in %.2fs (%.0f lines/s)'
+          % (len(stats), lines, results['all']['time'], lines / max(results['all']['time'], 1e-9)))
+    for title, pair in sorted(stats.items()):
+        print('    %-30s %5d x %5d lines %7.1fms  same %d, variant %d, folio %d, standard %d'
+              % (title, pair['folio_lines'], pair['standard_lines'], pair['time'] * 1000,
+                 pair.get('same', 0), pair.get('variant', 0), pair.get('folio', 0),
+                 pair.get('standard', 0)))
+    conn = sqlite3.connect(db)
+    pairs = edition_pairs(conn)
+    if pairs:
+        folio_id, standard_id, title = pairs[0]
+        a = play_lines(conn, folio_id)[:naive_lines]
+        b = play_lines(conn, standard_id)[:naive_lines]
+        t = time.perf_counter()
+        anchored = align(a, b)
+        anchored_time = time.perf_counter() - t
+        t = time.perf_counter()
+        naive = hirschberg(a, b)
+        naive_time = time.perf_counter() - t
+        score = lambda ops: sum(op[2] for op in ops)
+        results['naive'] = {'lines': len(a), 'anchored': anchored_time, 'naive': naive_time,
+                            'anchored_score': score(anchored), 'naive_score': score(naive)}
+        print('%s, first %d lines: anchored %.1fms (score %.1f), Hirschberg alone %.1fms '
+              '(score %.1f)' % (title, len(a), anchored_time * 1000, score(anchored),
+                                naive_time * 1000, score(naive)))
+    conn.close()
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else './syncshakedb.sqlite')
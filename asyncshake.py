@@ -9,12 +9,21 @@ import xml.etree.ElementTree
 import xml.dom.minidom
 import time
 import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import random
 import sqlite3
 import aiosqlite
 import aiohttp
 import aiofiles
 import nest_asyncio
-from typing import Dict, Text, List, Match, Any, Coroutine
+import alignment
+import ftsindex
+import playparser
+import wordfreq
+from playcache import ParsedPlayCache
+from typing import Dict, Text, List, Match, Any, Coroutine, Iterable, Tuple, Optional
 nest_asyncio.apply()
 
 
@@ -104,6 +113,7 @@ TEST_MOBY_INDEX = [
 
 
 DBFILE = "./shakedb.sqlite"
+ADD_EDITION = "ALTER TABLE plays ADD COLUMN edition TEXT DEFAULT 'moby'"
 
 async def create_tables(conn: sqlite3.Connection) -> Coroutine:
     # Now create the tables
@@ -111,7 +121,8 @@ async def create_tables(conn: sqlite3.Connection) -> Coroutine:
                         (id        INTEGER PRIMARY KEY,
                         title     TEXT,
                         subtitle  TEXT,
-                        scene     TEXT
+                        scene     TEXT,
+                        edition   TEXT DEFAULT 'moby'
                         );''', 
                   '''CREATE TABLE IF NOT EXISTS acts
                          (id        INTEGER PRIMARY KEY,
@@ -141,11 +152,67 @@ async def create_tables(conn: sqlite3.Connection) -> Coroutine:
                           name      TEXT,
                           description TEXT,
                           group_name TEXT
+                          );''',
+                    '''CREATE TABLE IF NOT EXISTS play_sources
+                         (play_id   INTEGER PRIMARY KEY,
+                          url       TEXT UNIQUE,
+                          content_hash TEXT,
+                          size      INTEGER,
+                          etag      TEXT,
+                          last_modified TEXT,
+                          fetched_at TEXT
                           );'''
                  ]
     tasks = [conn.execute(sql) for sql in tables]
     await asyncio.gather(*tasks)
+    await add_edition(conn)
+    await conn.commit()
+    await create_fts(conn)
+    await create_freq(conn)
+    for sql in alignment.ALIGN_TABLES:
+        await conn.execute(sql)
+    await conn.commit()
+
+async def add_edition(conn: aiosqlite.Connection) -> None:
+    """Add plays.edition to a database made before it existed, see
+    syncshake.add_edition."""
+    async with conn.execute('PRAGMA table_info(plays)') as cursor:
+        columns = [row[1] async for row in cursor]
+    if 'edition' not in columns:
+        await conn.execute(ADD_EDITION)
+
+async def create_freq(conn: aiosqlite.Connection) -> bool:
+    """Create the word frequency tables, counting any plays already stored,
+    see wordfreq.create_freq."""
+    async with conn.execute(wordfreq.FREQ_EXISTS) as cursor:
+        created = not (await cursor.fetchone())[0]
+    for sql in wordfreq.FREQ_TABLES:
+        await conn.execute(sql)
+    if created:
+        freqs: Dict[int, wordfreq.PlayFrequencies] = {}
+        async with conn.execute('''SELECT play_id, act_id, scene_id, speaker, the_text
+                                   FROM actor_lines WHERE is_stagedir = 0''') as cursor:
+            async for play_id, act_id, scene_id, speaker, text in cursor:
+                if play_id not in freqs:
+                    freqs[play_id] = wordfreq.PlayFrequencies(play_id)
+                freqs[play_id].add(act_id, scene_id, speaker, text)
+        for freq in freqs.values():
+            for table, rows in freq.rows().items():
+                await conn.executemany(wordfreq.INSERTS[table], rows)
+    await conn.commit()
+    return created
+
+async def create_fts(conn: aiosqlite.Connection) -> bool:
+    """Create the full-text indexes and triggers, see ftsindex.create_fts."""
+    async with conn.execute(ftsindex.FTS_EXISTS) as cursor:
+        created = not (await cursor.fetchone())[0]
+    for sql in ftsindex.FTS_TABLES:
+        await conn.execute(sql)
+    if created:
+        for sql in ftsindex.REBUILD:
+            await conn.execute(sql)
     await conn.commit()
+    return created
 
 def _get_text(nodelist: List) -> Text:
     rc: List = []
@@ -224,119 +291,687 @@ def handle_act(act):
         result['scenes'].append(handle_scene(scene))
     return result
 
+def parse_play(play_text: bytes, streaming: bool = False) -> Dict:
+    """Parse a play's XML into plain dicts, lists and tuples of strings.
+
+    Runs in a worker process when create_database is given workers, so it
+    must stay a module level function and return only picklable data.
+    """
+    if streaming:
+        return playparser.parse_play(play_text)
+    play = xml.dom.minidom.parseString(play_text)
+    result: Dict = {}
+    result['title'] = handle_title(play.getElementsByTagName('TITLE')[0])
+    result['subtitle'] = handle_title(play.getElementsByTagName('PLAYSUBT')[0])
+    result['scene_description'] = handle_title(play.getElementsByTagName('SCNDESCR')[0])
+    result['personae'] = handle_personae(play.getElementsByTagName('PERSONAE')[0])
+    result['acts'] = []
+    acts = play.getElementsByTagName('ACT')
+    for act in acts:
+        result['acts'].append(handle_act(act))
+    return result
+
+async def get_sources(conn: aiosqlite.Connection) -> Dict[Text, Dict]:
+    """The play_sources rows of the stored plays, keyed by url."""
+    conn.row_factory = aiosqlite.Row
+    try:
+        async with conn.execute('SELECT * FROM play_sources') as cursor:
+            return {row['url']: dict(row) async for row in cursor}
+    finally:
+        conn.row_factory = None
+
+async def delete_play(play_id: int, conn: aiosqlite.Connection) -> None:
+    for table in ('actor_lines', 'scenes', 'acts', 'person') + wordfreq.TABLES:
+        await conn.execute('DELETE FROM %s WHERE play_id = ?' % table, (play_id,))
+    await conn.execute(alignment.DELETE, (play_id, play_id))
+    await conn.execute('DELETE FROM plays WHERE id = ?', (play_id,))
+
+async def write_play(play: Dict[Text, Dict], conn: aiosqlite.Connection) -> int:
+    """Insert one play without committing and return its id.
+
+    Acts and scenes are inserted one by one for their ids; persons,
+    actor_lines and the word counts of each wordfreq table go in with one
+    executemany each. If the play carries a
+    'source' (see Play.fetch) it is recorded in play_sources, and a stored
+    copy of the same url is deleted first and its play id reused.
+    """
+    print(play['title'])
+    source: Dict = play.get('source') or {}
+    if source.get('play_id') is not None:
+        await delete_play(source['play_id'], conn)
+    cursor: aiosqlite.Cursor = await conn.execute('''
+                INSERT INTO plays
+                (id, title, subtitle, scene)
+                VALUES (?,?,?,?)''',
+                (source.get('play_id'), play['title'], play['subtitle'],
+                 play['scene_description']))
+    play_id: int = cursor.lastrowid
+    if source:
+        await conn.execute('''
+            INSERT OR REPLACE INTO play_sources
+            (play_id, url, content_hash, size, etag, last_modified, fetched_at)
+            VALUES (?,?,?,?,?,?,datetime('now'))''',
+            (play_id, source['url'], source['content_hash'], source['size'],
+             source['etag'], source['last_modified']))
+    people: List[Tuple] = []
+    for person in play['personae']['persona']:
+        # split the name
+        matches: List[Text] = re.split(r',', person[1])
+        match: Match[Any] = re.match(r'[A-z ]*', matches[0])
+        name = match.group(0).strip(' .')
+        if len(matches) == 1:
+            persona = (name,'')
+        elif len(matches) == 2:
+            persona = (name, re.match(r'[A-z ]*',matches[1]).group(0).strip(' .'))
+        else:
+            persona = (person[1],'')
+        people.append((play_id, persona[0], persona[1], person[0]))
+    await conn.executemany('''
+        INSERT INTO person
+        (play_id, name, description,group_name)
+        VALUES (?,?,?,?)''', people)
+    lines: List[Tuple] = []
+    freq = wordfreq.PlayFrequencies(play_id)
+    act_num = 1
+    for act in play['acts']:
+        print(play['title'], act['title'])
+        cursor = await conn.execute('''
+            INSERT INTO acts
+            (title, play_id, act_num)
+            VALUES (?,?,?)''',
+            (act['title'],play_id,act_num))
+        act_id = cursor.lastrowid
+        scene_num = 1
+        for scene in act['scenes']:
+            cursor = await conn.execute('''
+                INSERT INTO scenes
+                (play_id, act_id, title, scene_num)
+                VALUES (?,?,?,?)''',
+                (play_id, act_id, scene['title'], scene_num))
+            scene_id = cursor.lastrowid
+            for content in scene['content']:
+                if content[0] == 0:
+                    # This is stage direction
+                    lines.append((play_id, act_id, scene_id, '', 1, content[1]))
+                elif 'speaker' not in content[1]:
+                    print(content)
+                else:
+                    speaker = content[1]['speaker']
+                    lines.extend((play_id, act_id, scene_id, speaker, 0, line)
+                                 for line in content[1]['lines'])
+                    for line in content[1]['lines']:
+                        freq.add(act_id, scene_id, speaker, line)
+            # Increment scene_num
+            scene_num = scene_num + 1
+        # Increment act num
+        act_num = act_num + 1
+    await conn.executemany('''
+        INSERT INTO actor_lines
+        (play_id, act_id, scene_id, speaker,
+        is_stagedir, the_text)
+        VALUES (?,?,?,?,?,?)''', lines)
+    for table, rows in freq.rows().items():
+        await conn.executemany(wordfreq.INSERTS[table], rows)
+    return play_id
+
+
+class WriterStats():
+
+    def __init__(self) -> None:
+        self.plays: int = 0
+        self.failures: int = 0
+        self.commits: int = 0
+        self.busy: float = 0.0
+
+    def report(self) -> Text:
+        return 'writer stored %d plays (%d failed) in %d commits, %.2fs writing' % (
+            self.plays, self.failures, self.commits, self.busy)
+
+
+class PlayWriter():
+    ''' The only task that writes to the shared aiosqlite connection.
+
+        Whole plays are queued with put/submit. The writer takes up to
+        group_size plays that are waiting, writes each inside its own
+        SAVEPOINT and commits them together, so every play lands atomically
+        and a failed play is rolled back without losing the rest of the group.
+    '''
+
+    def __init__(self, conn: aiosqlite.Connection, group_size: int = 8,
+                 queue_size: int = 16) -> None:
+        self.conn: aiosqlite.Connection = conn
+        self.group_size: int = group_size
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.stats: WriterStats = WriterStats()
+        self.task: asyncio.Future = None
+
+    async def __aenter__(self) -> 'PlayWriter':
+        self.task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def put(self, play: Dict, future: asyncio.Future = None) -> None:
+        """Queue a play, waiting while the queue is full.
+
+        Raises the writer's error if it dies (or RuntimeError if it has been
+        closed) instead of waiting for good on a queue nobody reads.
+        """
+        if not self.task.done():
+            putting = asyncio.ensure_future(self.queue.put((play, future)))
+            try:
+                await asyncio.wait([putting, self.task], return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                putting.cancel()
+                raise
+            if not self.task.done():
+                return
+            putting.cancel()
+        self.task.result()
+        raise RuntimeError('PlayWriter is closed')
+
+    async def submit(self, play: Dict) -> int:
+        """Queue a play and wait until it is committed, returning its id."""
+        future = asyncio.get_running_loop().create_future()
+        await self.put(play, future)
+        return await future
+
+    async def close(self) -> None:
+        if self.task is not None and not self.task.done():
+            await self.queue.put(None)
+        await self.task
+
+    async def _run(self) -> None:
+        try:
+            running = True
+            while running:
+                item = await self.queue.get()
+                if item is None:
+                    break
+                group = [item]
+                while len(group) < self.group_size and not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    if item is None:
+                        running = False
+                        break
+                    group.append(item)
+                await self._write_group(group)
+        except asyncio.CancelledError:
+            self._fail_queued(None)
+            raise
+        except Exception as e:
+            # nothing will write what is still queued, so its submitters
+            # would wait for good
+            self._fail_queued(e)
+            raise
+
+    def _fail_queued(self, error: Optional[Exception]) -> None:
+        """Fail (or with no error, cancel) the plays left in the queue."""
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is None:
+                continue
+            play, future = item
+            if error is None:
+                if future is not None:
+                    future.cancel()
+            else:
+                self._failed(play, future, error)
+
+    async def _write_group(self, group: List[Tuple]) -> None:
+        t = time.perf_counter()
+        conn = self.conn
+        done: List[Tuple] = []
+        failed: List[int] = []
+        try:
+            await conn.execute('BEGIN')
+            for i, (play, future) in enumerate(group):
+                await conn.execute('SAVEPOINT play')
+                try:
+                    play_id = await write_play(play, conn)
+                except Exception as e:
+                    await conn.execute('ROLLBACK TO play')
+                    await conn.execute('RELEASE play')
+                    failed.append(i)
+                    self._failed(play, future, e)
+                    continue
+                await conn.execute('RELEASE play')
+                done.append((play, future, play_id))
+            await conn.commit()
+        except Exception as e:
+            # every play of the group not already failed on its own, written
+            # or not yet reached, goes with the transaction
+            for i, (play, future) in enumerate(group):
+                if i not in failed:
+                    self._failed(play, future, e)
+            await conn.rollback()
+            return
+        finally:
+            self.stats.busy += time.perf_counter() - t
+        self.stats.commits += 1
+        self.stats.plays += len(done)
+        for play, future, play_id in done:
+            if future is not None and not future.done():
+                future.set_result(play_id)
+
+    def _failed(self, play: Dict, future: asyncio.Future, error: Exception) -> None:
+        self.stats.failures += 1
+        if future is not None and not future.done():
+            future.set_exception(error)
+        else:
+            print('Failed to store %s: %r' % (play['title'], error))
+
+async def parse_play_async(play_text: bytes, streaming: bool = False,
+                           executor: concurrent.futures.Executor = None,
+                           play_cache: ParsedPlayCache = None) -> Dict:
+    """parse_play, answered from the parsed play cache when possible.
+
+    With an executor the parse runs in another process and the loop carries
+    on fetching and writing the other plays meanwhile.
+    """
+    if play_cache is not None:
+        result = play_cache.get(play_text)
+        if result is not None:
+            return result
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(executor, parse_play, play_text, streaming)
+    else:
+        result = parse_play(play_text, streaming)
+    if play_cache is not None:
+        play_cache.put(play_text, result)
+    return result
+
 class Play():
     
-    def __init__(self, title: Text, url: Text) -> None:
+    def __init__(self, title: Text, url: Text, source: Dict = None) -> None:
         self.title: Text = title
         self.url: Text = url
+        # the play_sources row of the stored copy, if there is one
+        self.source: Dict = source or {}
+
+    async def fetch(self, fetcher: 'Fetcher') -> Optional[bytes]:
+        """Fetch the play's XML, or None if the stored copy is still current.
+
+        The request is conditional on the stored ETag/Last-Modified and the
+        body is compared by sha256, so unchanged plays are never re-parsed.
+        """
+        response = await fetcher.fetch_source(self.url, self.source.get('etag'),
+                                              self.source.get('last_modified'))
+        if response.data is None:
+            return None
+        content_hash = hashlib.sha256(response.data).hexdigest()
+        if content_hash == self.source.get('content_hash'):
+            return None
+        self.fetched: Dict = {'play_id': self.source.get('play_id'), 'url': self.url,
+                              'content_hash': content_hash, 'size': len(response.data),
+                              'etag': response.etag, 'last_modified': response.last_modified}
+        return response.data
+
+    def with_source(self, result: Dict) -> Dict:
+        result['source'] = self.fetched
+        return result
     
     async def store(self, play: Dict[Text, Dict], conn: aiosqlite.Connection):
-        print(play['title'])
-        
-        cursor: aiosqlite.Cursor = await conn.execute('''
-                    INSERT INTO plays
-                    (title, subtitle, scene)
-                    VALUES (?,?,?)''',
-                    (play['title'], play['subtitle'], play['scene_description']))
-        play_id: int = cursor.lastrowid
-        # create the groups
-        person_ids = {}
-        for person in play['personae']['persona']:
-            # split the name
-            matches: List[Text] = re.split(r',', person[1])
-            match: Match[Any] = re.match(r'[A-z ]*', matches[0])
-            name = match.group(0).strip(' .')
-            if len(matches) == 1:
-                persona = (name,'')
-            elif len(matches) == 2:
-                persona = (name, re.match(r'[A-z ]*',matches[1]).group(0).strip(' .'))
-            else:
-                persona = (person[1],'')
-            cursor = await conn.execute('''
-                INSERT INTO person
-                (play_id, name, description,group_name)
-                VALUES (?,?,?,?)''',
-                (play_id, persona[0], persona[1], person[0]))
-            person_ids[persona[0]] = cursor.lastrowid
-        act_num = 1
-        for act in play['acts']:
-            print(play['title'], act['title'])
-            cursor = await conn.execute('''
-                INSERT INTO acts
-                (title, play_id, act_num)
-                VALUES (?,?,?)''',
-                (act['title'],play_id,act_num))
-            act_id = cursor.lastrowid
-            scene_num = 1
-            for scene in act['scenes']:
-                cursor = await conn.execute('''
-                    INSERT INTO scenes
-                    (play_id, act_id, title, scene_num)
-                    VALUES (?,?,?,?)''',
-                    (play_id, act_id, scene['title'], scene_num))
-                scene_id = cursor.lastrowid
-                # and finally write the lines
-                for content in scene['content']:
-                    if content[0] == 0:
-                        # This is stage direction
-                        await conn.execute('''
-                        INSERT INTO actor_lines
-                        (play_id, act_id, scene_id, speaker,
-                        is_stagedir, the_text)
-                        VALUES (?,?,?,?,?,?)''',
-                        (play_id, act_id, scene_id, '',
-                            1, content[1]))
-                    else:
-                        try:
-                            speaker = content[1]['speaker']
-                            for line in content[1]['lines']:
-                                cursor = await conn.execute('''
-                                    INSERT INTO actor_lines
-                                    (play_id, act_id, scene_id, speaker,
-                                    is_stagedir, the_text)
-                                    VALUES (?,?,?,?,?,?)''',
-                                    (play_id, act_id, scene_id, speaker,
-                                    0, line))
-    
-                        except KeyError:
-                            print(content)
-                # Increment scene_num
-                scene_num = scene_num + 1
-            # Increment act num
-            act_num = act_num + 1
+        await write_play(play, conn)
         # Commit this play.
         await conn.commit()
 
-    async def fetch_and_store(self, session: aiohttp.ClientSession, conn: aiosqlite.Connection) -> Coroutine:
-        async with session.get(self.url) as response:
-            play_text = await response.text()
-            play = xml.dom.minidom.parseString(play_text)
-            result: Dict = {}
-            result['title'] = handle_title(play.getElementsByTagName('TITLE')[0])              
-            result['subtitle'] = handle_title(play.getElementsByTagName('PLAYSUBT')[0])
-            result['scene_description'] = handle_title(play.getElementsByTagName('SCNDESCR')[0])
-            result['personae'] = handle_personae(play.getElementsByTagName('PERSONAE')[0])
-            result['acts'] = []
-            acts = play.getElementsByTagName('ACT')
-            for act in acts:
-                result['acts'].append(handle_act(act))
-            await self.store(result, conn)
-
-async def create_database() -> Coroutine:
+    async def fetch_and_store(self, fetcher: 'Fetcher', writer: PlayWriter,
+                              streaming: bool = False,
+                              executor: concurrent.futures.Executor = None,
+                              play_cache: ParsedPlayCache = None) -> Coroutine:
+        play_text = await self.fetch(fetcher)
+        if play_text is None:
+            print('Unchanged: %s' % self.title)
+            return
+        result = await parse_play_async(play_text, streaming, executor, play_cache)
+        await writer.submit(self.with_source(result))
+
+
+FetchResult = collections.namedtuple('FetchResult', ['data', 'etag', 'last_modified'])
+
+
+class FetchStats():
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.fetched: int = 0
+        self.not_modified: int = 0
+        self.retries: int = 0
+        self.failures: int = 0
+        self.bytes: int = 0
+        self.started: float = time.perf_counter()
+        self.finished: float = self.started
+        self.errors: Dict[Text, Text] = {}
+
+    @property
+    def elapsed(self) -> float:
+        return self.finished - self.started
+
+    def report(self) -> Text:
+        elapsed = max(self.elapsed, 1e-9)
+        lines = ['fetched %d urls, %d not modified (%d requests, %d retries, %d failed) in %.2fs'
+                    % (self.fetched, self.not_modified, self.requests, self.retries,
+                       self.failures, elapsed),
+                 '%.1f KiB received, %.1f KiB/s, %.2f urls/s'
+                    % (self.bytes / 1024, self.bytes / 1024 / elapsed, self.fetched / elapsed)]
+        for url, error in self.errors.items():
+            lines.append('failed %s: %s' % (url, error))
+        return '\n'.join(lines)
+
+
+class Fetcher():
+    ''' Shared HTTP fetch layer: one pooled keep-alive session, at most
+        `concurrency` requests in flight, per-request timeouts and
+        exponential-backoff retries for transient failures.
+    '''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, concurrency: int = 8, limit_per_host: int = 8,
+                 retries: int = 3, backoff: float = 0.5, timeout: float = 30.0,
+                 connect_timeout: float = 10.0, keepalive_timeout: float = 30.0) -> None:
+        self.concurrency: int = concurrency
+        self.limit_per_host: int = limit_per_host
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.keepalive_timeout: float = keepalive_timeout
+        self.stats: FetchStats = FetchStats()
+        self.session: aiohttp.ClientSession = None
+        self.semaphore: asyncio.Semaphore = None
+
+    async def __aenter__(self) -> 'Fetcher':
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.stats = FetchStats()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.stats.finished = time.perf_counter()
+        await self.session.close()
+
+    async def fetch(self, url: Text) -> bytes:
+        return (await self.fetch_source(url)).data
+
+    async def fetch_source(self, url: Text, etag: Text = None,
+                           last_modified: Text = None) -> FetchResult:
+        """GET url, conditionally if etag/last_modified are given.
+
+        A 304 Not Modified comes back with data None.
+        """
+        headers: Dict[Text, Text] = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    self.stats.requests += 1
+                    async with self.session.get(url, headers=headers) as response:
+                        if response.status == 304:
+                            self.stats.not_modified += 1
+                            return FetchResult(None, etag, last_modified)
+                        response.raise_for_status()
+                        data = await response.read()
+                        result = FetchResult(data, response.headers.get('ETag'),
+                                             response.headers.get('Last-Modified'))
+                self.stats.fetched += 1
+                self.stats.bytes += len(data)
+                self.stats.finished = time.perf_counter()
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                transient = (not isinstance(e, aiohttp.ClientResponseError)
+                             or e.status in self.RETRY_STATUS)
+                if not transient or attempt >= self.retries:
+                    self.stats.failures += 1
+                    self.stats.errors[url] = str(e) or type(e).__name__
+                    raise
+            # back off outside the semaphore so a waiting retry doesn't hold a slot
+            delay = self.backoff * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+            self.stats.retries += 1
+
+class StageStats():
+
+    def __init__(self, name: Text, workers: int) -> None:
+        self.name: Text = name
+        self.workers: int = workers
+        self.items: int = 0
+        self.failures: int = 0
+        self.skipped: int = 0
+        self.busy: float = 0.0
+        self.depth_max: int = 0
+        self.depth_total: int = 0
+        self.depth_samples: int = 0
+
+    def sample(self, queue: asyncio.Queue) -> None:
+        depth = queue.qsize()
+        self.depth_max = max(self.depth_max, depth)
+        self.depth_total += depth
+        self.depth_samples += 1
+
+    def utilisation(self, elapsed: float) -> float:
+        return self.busy / max(elapsed * self.workers, 1e-9)
+
+    def report(self, elapsed: float) -> Text:
+        return ('%-6s workers %2d  items %4d  skipped %4d  failed %2d  %6.2f items/s  '
+                'busy %5.1f%%  queue in avg %.1f max %d'
+                % (self.name, self.workers, self.items, self.skipped, self.failures,
+                   self.items / max(elapsed, 1e-9), 100 * self.utilisation(elapsed),
+                   self.depth_total / max(self.depth_samples, 1), self.depth_max))
+
+
+async def _gather(*aws) -> List[Any]:
+    """asyncio.gather, except that if one raises the others are cancelled
+    and waited for rather than left blocked on their queues."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
     try:
-        os.remove(DBFILE)
-    except FileNotFoundError:
-        pass
-    async with aiosqlite.connect(DBFILE) as dbconn:
-        print('Creating tables')
-        await create_tables(dbconn)
-        async with aiohttp.ClientSession() as session:
-            plays: List[Play] = [Play(play[0], play[1]) for play in MOBY_INDEX]
-            tasks: List[Task] = [play.fetch_and_store(session, dbconn) for play in plays]
-            await asyncio.gather(*tasks)
-
-async def get_stuff(like: Text) -> Coroutine:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Pipeline():
+    ''' Fetch -> parse -> store stages joined by bounded queues.
+
+        Each stage has its own worker count and the store stage is the
+        single PlayWriter task on the shared connection. A full queue blocks
+        the stage in front of it, so only a bounded number of plays is held
+        in memory however long the index is.
+    '''
+
+    def __init__(self, fetchers: int = 8, parsers: int = 2, queue_size: int = 4,
+                 sample_interval: float = 0.05) -> None:
+        self.fetchers: int = fetchers
+        self.parsers: int = parsers
+        self.queue_size: int = queue_size
+        self.sample_interval: float = sample_interval
+        self.stages: Dict[Text, StageStats] = {}
+        self.elapsed: float = 0.0
+
+    async def _worker(self, stats: StageStats, inq: asyncio.Queue, put, work) -> None:
+        while True:
+            item = await inq.get()
+            if item is None:
+                break
+            play = item[0]
+            t = time.perf_counter()
+            try:
+                result = await work(*item)
+            except Exception as e:
+                stats.failures += 1
+                print('Failed to %s %s: %r' % (stats.name, play.title, e))
+                continue
+            finally:
+                stats.busy += time.perf_counter() - t
+            stats.items += 1
+            if result is None:
+                # nothing to pass on, e.g. an unchanged play
+                stats.skipped += 1
+                continue
+            await put(play, result)
+
+    async def _stage(self, stats: StageStats, inq: asyncio.Queue, put, work,
+                     close) -> None:
+        await _gather(*[self._worker(stats, inq, put, work)
+                        for _ in range(stats.workers)])
+        await close()
+
+    async def _monitor(self, queues: List[Any]) -> None:
+        while True:
+            for stats, queue in queues:
+                stats.sample(queue)
+            await asyncio.sleep(self.sample_interval)
+
+    async def run(self, index: Iterable, fetcher: Fetcher, writer: PlayWriter,
+                  streaming: bool = False,
+                  executor: concurrent.futures.Executor = None,
+                  sources: Dict[Text, Dict] = None,
+                  play_cache: ParsedPlayCache = None) -> Dict[Text, StageStats]:
+        """Run index through the stages; the store stage is the writer task.
+        @sources: play_sources rows by url, plays that are unchanged are skipped
+        """
+        sources = sources or {}
+        fetch_q: asyncio.Queue = asyncio.Queue(self.queue_size)
+        parse_q: asyncio.Queue = asyncio.Queue(self.queue_size)
+        fetch = StageStats('fetch', self.fetchers)
+        parse = StageStats('parse', self.parsers)
+        store = StageStats('store', 1)
+        self.stages = {'fetch': fetch, 'parse': parse, 'store': store}
+
+        async def do_fetch(play: Play) -> Optional[bytes]:
+            return await play.fetch(fetcher)
+
+        async def do_parse(play: Play, play_text: bytes) -> Dict:
+            return await parse_play_async(play_text, streaming, executor, play_cache)
+
+        async def to_parse(play: Play, play_text: bytes) -> None:
+            await parse_q.put((play, play_text))
+
+        async def to_store(play: Play, result: Dict) -> None:
+            await writer.put(play.with_source(result))
+
+        async def end_parse() -> None:
+            for _ in range(self.parsers):
+                await parse_q.put(None)
+
+        async def feed() -> None:
+            # the index is consumed lazily, a generator of any length is fine
+            for title, url in index:
+                await fetch_q.put((Play(title, url, sources.get(url)),))
+            for _ in range(self.fetchers):
+                await fetch_q.put(None)
+
+        monitor = asyncio.ensure_future(self._monitor(
+            [(fetch, fetch_q), (parse, parse_q), (store, writer.queue)]))
+        t = time.perf_counter()
+        try:
+            await _gather(feed(),
+                          self._stage(fetch, fetch_q, to_parse, do_fetch, end_parse),
+                          self._stage(parse, parse_q, to_store, do_parse, writer.close))
+        finally:
+            self.elapsed = time.perf_counter() - t
+            monitor.cancel()
+            await asyncio.gather(monitor, return_exceptions=True)
+            store.items = writer.stats.plays
+            store.failures = writer.stats.failures
+            store.busy = writer.stats.busy
+        return self.stages
+
+    def report(self) -> Text:
+        lines = ['pipeline finished in %.2fs' % self.elapsed]
+        lines += [stats.report(self.elapsed) for stats in self.stages.values()]
+        if self.stages:
+            slowest = max(self.stages.values(), key=lambda s: s.utilisation(self.elapsed))
+            lines.append('bottleneck: %s' % slowest.name)
+        return '\n'.join(lines)
+
+
+async def create_database(index: Iterable = MOBY_INDEX, fetcher: Fetcher = None,
+                          streaming: bool = False, workers: int = None,
+                          pipeline: Pipeline = None, incremental: bool = False,
+                          play_cache: ParsedPlayCache = None) -> Coroutine:
+    """Fetch, parse and store every play in index into a fresh DBFILE.
+    @workers: if set, parse the XML in a pool of that many processes
+    @pipeline: if given, run the plays through its staged queues instead of
+        one fetch_and_store task per play
+    @incremental: keep the existing DBFILE, skip plays whose source is
+        unchanged and replace only the rows of plays that have changed
+    @play_cache: reuse parsed plays from this cache instead of parsing again
+    """
+    if not incremental:
+        try:
+            os.remove(DBFILE)
+        except FileNotFoundError:
+            pass
+    fetcher = fetcher or Fetcher()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        async with aiosqlite.connect(DBFILE) as dbconn:
+            print('Creating tables')
+            await create_tables(dbconn)
+            sources = await get_sources(dbconn) if incremental else {}
+            writer = PlayWriter(dbconn)
+            async with fetcher, writer:
+                if pipeline is not None:
+                    await pipeline.run(index, fetcher, writer, streaming, executor, sources,
+                                       play_cache)
+                else:
+                    plays: List[Play] = [Play(play[0], play[1], sources.get(play[1]))
+                                         for play in index]
+                    tasks: List[Coroutine] = [play.fetch_and_store(fetcher, writer, streaming,
+                                                                   executor, play_cache)
+                                              for play in plays]
+                    # a failed play is reported instead of aborting the whole run
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    for play, result in zip(plays, results):
+                        if isinstance(result, Exception):
+                            print('Failed to load %s: %r' % (play.title, result))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if pipeline is not None:
+        print(pipeline.report())
+    print(writer.stats.report())
+    if play_cache is not None:
+        print(play_cache.stats.report())
+    print(fetcher.stats.report())
+    return fetcher.stats
+
+async def search(conn: aiosqlite.Connection, query: Text, mode: Text = 'token',
+                 limit: int = 20, edition: Optional[Text] = ftsindex.MOBY_EDITION) -> List[Dict]:
+    """Ranked full-text matches of query, see ftsindex.search."""
+    conn.row_factory = aiosqlite.Row
+    try:
+        async with conn.execute(ftsindex.SEARCH, (ftsindex.match_expression(query, mode), edition,
+                                                  -1 if limit is None else limit)) as cursor:
+            return [dict(row) async for row in cursor]
+    finally:
+        conn.row_factory = None
+
+async def get_stuff(like: Text, match: Text = None, mode: Text = 'token') -> Coroutine:
+    """Print the lines matching like, or with match given, the ranked
+    full-text matches of match (see ftsindex.match_expression for mode).
+    """
     async with aiosqlite.connect(DBFILE) as dbconn:
+        if match is not None:
+            x = 0
+            for row in await search(dbconn, match, mode, None):
+                x = x + 1
+                print((row['the_text'], row['speaker'], row['title'], row['act'], row['scene']))
+            print(x)
+            return
         dbconn.row_factory = aiosqlite.Row
         async with dbconn.execute('''SELECT 
                                 actor_lines.the_text, actor_lines.speaker, plays.title 
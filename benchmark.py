@@ -0,0 +1,339 @@
+# coding: utf-8
+
+"""
+End-to-end ingest benchmarks of the syncshake, asyncshake and MySQL paths.
+
+The Moby XML is served from a local directory by fixtureserver, so runs do
+not depend on ibiblio and are repeatable. Every case runs in a fresh
+process against a fresh database and reports
+
+    wall    seconds of the timed load
+    cpu     user + system seconds of the process and its parse workers
+    rss     peak resident set size of the process and its workers
+    rows    actor_lines written by the load (the change in their count), and
+            rows/s of those; total is the count afterwards
+    db      size of the database on disk
+
+Each run is appended to a JSON history and compared with the last run of
+the same case on the same fixtures, so a regression shows up as soon as it
+is made:
+
+    python benchmark.py ./moby
+    python benchmark.py ./moby --cases sync-bulk async-pipeline --repeat 3
+    python benchmark.py ./moby --mysql '{"user": "bench", "password": "bench",
+                                         "host": "127.0.0.1", "database": "bench"}'
+
+The mysql case needs a server to stand in for the real one; its tables are
+dropped before each run, so point it at a scratch database.
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Text, Tuple
+
+from fixtureserver import FixtureServer, rebase_index
+
+HISTORY = './benchmark_results.json'
+# a case is slower than the last run if it takes this much longer, and by
+# more than the noise of a short case
+TOLERANCE = 0.10
+NOISE = {'wall': 0.1, 'cpu': 0.1, 'rss': 4 * 2**20}
+METRICS = ('wall', 'cpu', 'rss')
+MYSQL_TABLES = ('plays', 'acts', 'scenes', 'actor_lines', 'word_to_line', 'words', 'person')
+
+
+def _rusage() -> Tuple[float, int]:
+    """CPU seconds and peak RSS in bytes of this process and its waited for
+    children.
+    """
+    cpu = 0.0
+    rss = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu += usage.ru_utime + usage.ru_stime
+        rss = max(rss, usage.ru_maxrss)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return cpu, rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _sqlite_size(path: Text) -> int:
+    return sum(os.path.getsize(name) for name in (path, path + '-wal')
+               if os.path.exists(name))
+
+
+def _sqlite_rows(path: Text) -> int:
+    if not os.path.exists(path):
+        return 0
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        try:
+            return conn.execute('SELECT count(*) FROM actor_lines').fetchone()[0]
+        except sqlite3.OperationalError:
+            # no tables yet
+            return 0
+
+
+# Each case prepares its run in workdir and returns the load to time and a
+# function giving (actor_lines rows, db bytes), called before and after it.
+
+def _sync(workdir: Text, base_url: Text, options: Dict, **kwargs):
+    import syncshake
+    syncshake.DBFILE = os.path.join(workdir, 'syncshakedb.sqlite')
+    syncshake.MOBY_INDEX = rebase_index(syncshake.MOBY_INDEX, base_url)
+    load = lambda: syncshake.main(**kwargs)
+    return load, lambda: (_sqlite_rows(syncshake.DBFILE), _sqlite_size(syncshake.DBFILE))
+
+
+def _async(workdir: Text, base_url: Text, options: Dict, pipeline: bool = False, **kwargs):
+    import asyncshake
+    asyncshake.DBFILE = os.path.join(workdir, 'shakedb.sqlite')
+    index = rebase_index(asyncshake.MOBY_INDEX, base_url)
+    if pipeline:
+        kwargs['pipeline'] = asyncshake.Pipeline()
+    load = lambda: asyncio.run(asyncshake.create_database(index, **kwargs))
+    return load, lambda: (_sqlite_rows(asyncshake.DBFILE), _sqlite_size(asyncshake.DBFILE))
+
+
+def _mysql(workdir: Text, base_url: Text, options: Dict, streaming: bool = False):
+    import MySqlShakespeare
+    config = options.get('mysql')
+    if not config:
+        raise RuntimeError('no MySQL stand-in given (--mysql)')
+    cache = MySqlShakespeare.Cache(os.path.join(workdir, 'cache'), compress=False)
+    # seed the cache from the fixture server so DownloadHandler never goes
+    # out to gutenberg.org or ibiblio
+    empty = os.path.join(workdir, 'GUTINDEX.ALL')
+    open(empty, 'wb').close()
+    cache.store_file(MySqlShakespeare.GUT_INDEX, '', empty)
+    for title, url in MySqlShakespeare.MOBY_INDEX:
+        fetched = cache.download_url(rebase_index([(title, url)], base_url)[0][1])
+        copy = os.path.join(workdir, os.path.basename(url))
+        shutil.copyfile(fetched, copy)
+        cache.store_file(url, '', copy)
+    handler = MySqlShakespeare.DownloadHandler(cache=cache, mysql_config=config)
+    conn = handler.connect_mysql()
+    c = conn.cursor()
+    for table in MYSQL_TABLES:
+        c.execute('DROP TABLE IF EXISTS %s' % table)
+    conn.commit()
+    conn.close()
+
+    def load():
+        handler.get_moby_works(streaming)
+        handler.write_to_mysql()
+
+    def result():
+        c = handler.connect_mysql().cursor()
+        c.execute('''SELECT COUNT(*) FROM information_schema.tables
+                     WHERE table_schema = %s AND table_name = 'actor_lines' ''',
+                  (config['database'],))
+        rows = 0
+        if c.fetchone()[0]:
+            c.execute('SELECT count(*) FROM actor_lines')
+            rows = c.fetchone()[0]
+        c.execute('''SELECT SUM(data_length + index_length) FROM information_schema.tables
+                     WHERE table_schema = %s''', (config['database'],))
+        size = int(c.fetchone()[0] or 0)
+        c.connection.close()
+        return rows, size
+    return load, result
+
+
+# name: (setup, its keyword arguments, the case to run untimed first in the
+# same workdir, if any)
+CASES: Dict[Text, Tuple[Callable, Dict, Optional[Text]]] = {
+    'sync': (_sync, {}, None),
+    'sync-bulk': (_sync, {'streaming': True, 'bulk': True}, None),
+    # every play is unchanged since the sync-bulk load before it
+    'sync-incremental': (_sync, {'bulk': True, 'incremental': True}, 'sync-bulk'),
+    'async': (_async, {}, None),
+    'async-workers': (_async, {'streaming': True, 'workers': os.cpu_count()}, None),
+    'async-pipeline': (_async, {'streaming': True, 'pipeline': True}, None),
+    'mysql': (_mysql, {}, None),
+    'mysql-streaming': (_mysql, {'streaming': True}, None),
+}
+
+
+def _run_case(name: Text, workdir: Text, base_url: Text, options: Dict, pipe) -> None:
+    """Child process: run one case and send its measurements back."""
+    try:
+        setup, kwargs, _ = CASES[name]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if options.get('verbose') else out):
+            load, result = setup(workdir, base_url, options, **kwargs)
+            rows_before = result()[0]
+            cpu = _rusage()[0]
+            t = time.perf_counter()
+            load()
+            wall = time.perf_counter() - t
+            cpu, rss = _rusage()[0] - cpu, _rusage()[1]
+            total, size = result()
+        rows = max(total - rows_before, 0)
+        pipe.send({'wall': wall, 'cpu': cpu, 'rss': rss, 'rows': rows,
+                   'rows_per_s': rows / max(wall, 1e-9), 'total_rows': total,
+                   'db_bytes': size})
+    except Exception as e:
+        pipe.send({'error': '%s: %s' % (type(e).__name__, e)})
+    finally:
+        pipe.close()
+
+
+def _spawn(name: Text, workdir: Text, base_url: Text, options: Dict) -> Dict:
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case,
+                              args=(name, workdir, base_url, options, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'exited with %s' % process.exitcode}
+    process.join()
+    return result
+
+
+def run_case(name: Text, base_url: Text, options: Dict) -> Dict:
+    """Run one case in a new process against a new database; ru_maxrss only
+    ever grows, so a process of its own is the only way to get the peak RSS
+    of one case. A case that starts from a loaded database has the load run
+    in a process before it.
+    """
+    with tempfile.TemporaryDirectory(prefix='shakebench-') as workdir:
+        before = CASES[name][2]
+        if before is not None:
+            result = _spawn(before, workdir, base_url, options)
+            if 'error' in result:
+                return result
+        return _spawn(name, workdir, base_url, options)
+
+
+def fixtures_key(directory: Text) -> Text:
+    """A digest of the fixture files' names and sizes; only runs over the
+    same fixtures are compared.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        digest.update(('%s %d\n' % (name, os.path.getsize(os.path.join(directory, name))))
+                      .encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit,
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def run(fixtures: Text, cases: List[Text] = None, repeat: int = 1, options: Dict = None) -> Dict:
+    """Serve fixtures and run each case repeat times; the run with the
+    median wall time is reported.
+    """
+    options = options or {}
+    results: Dict = {}
+    with FixtureServer(fixtures) as server:
+        for name in cases or list(CASES):
+            runs = [run_case(name, server.base_url, options) for _ in range(repeat)]
+            errors = [r for r in runs if 'error' in r]
+            if errors:
+                results[name] = errors[0]
+                print('%-17s skipped: %s' % (name, errors[0]['error']))
+                continue
+            result = sorted(runs, key=lambda r: r['wall'])[(len(runs) - 1) // 2]
+            if repeat > 1:
+                result['wall_stdev'] = statistics.stdev(r['wall'] for r in runs)
+            results[name] = result
+            print('%-17s %7.2fs wall %7.2fs cpu %7.1f MiB rss %8d rows %8.0f rows/s '
+                  '(%d total) %7.1f MiB db'
+                  % (name, result['wall'], result['cpu'], result['rss'] / 2**20,
+                     result['rows'], result['rows_per_s'], result['total_rows'],
+                     result['db_bytes'] / 2**20))
+    return {'environment': environment(), 'fixtures': fixtures_key(fixtures),
+            'repeat': repeat, 'cases': results}
+
+
+def load_history(path: Text) -> List[Dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def previous_case(history: List[Dict], fixtures: Text, name: Text) -> Optional[Dict]:
+    """The most recent successful result of case name over the same fixtures."""
+    for run in reversed(history):
+        case = run['cases'].get(name)
+        if run['fixtures'] == fixtures and case and 'error' not in case:
+            return case
+    return None
+
+
+def compare(history: List[Dict], current: Dict, tolerance: float = TOLERANCE) -> List[Text]:
+    """Print each case's change against its previous run; returns the
+    regressions, metrics that grew by more than tolerance (and NOISE).
+    """
+    regressions = []
+    for name, case in current['cases'].items():
+        before = previous_case(history, current['fixtures'], name)
+        if 'error' in case or before is None:
+            continue
+        changes = []
+        for metric in METRICS:
+            change = case[metric] / max(before[metric], 1e-9) - 1
+            changes.append('%s %+.1f%%' % (metric, change * 100))
+            if change > tolerance and case[metric] - before[metric] > NOISE[metric]:
+                regressions.append('%s %s %+.1f%%' % (name, metric, change * 100))
+        print('%-17s vs previous: %s' % (name, ', '.join(changes)))
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Time loading the Moby plays from a local '
+                                     'fixture server through each ingest path.')
+    parser.add_argument('fixtures', help='directory of the Moby XML files, named as in '
+                        'MOBY_INDEX')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=None)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--mysql', type=json.loads, default=None,
+                        help='JSON connection config of a scratch MySQL server')
+    parser.add_argument('--history', default=HISTORY)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--no-save', action='store_true', help='do not append to the history')
+    parser.add_argument('--verbose', action='store_true', help="show the loaders' own output")
+    args = parser.parse_args(argv)
+
+    cases = args.cases or [name for name in CASES
+                           if args.mysql or not name.startswith('mysql')]
+    current = run(args.fixtures, cases, args.repeat,
+                  {'mysql': args.mysql, 'verbose': args.verbose})
+    history = load_history(args.history)
+    regressions = compare(history, current, args.tolerance)
+    if not args.no_save:
+        with open(args.history, 'w') as f:
+            json.dump(history + [current], f, indent=1)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
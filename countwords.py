@@ -1,44 +1,436 @@
-import sqlite3
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import json
+import locale
+import mmap
+import os
 import re
+import sqlite3
+import sys
+import time
 from collections import Counter
+
 DBNAME = 'P:/src/shakespeare/plays.db'
-conn = sqlite3.connect(DBNAME)
-c = conn.cursor()
-#rows = c.execute('''SELECT id, text from lines where is_stagedir=0''')
-#f = open('P:/src/shakespeare/plays.txt','wt')
-#for row in rows:
-#    f.write(str(row[0])+'|'+row[1]+'\n')
-#f.close()
-f = open('P:/src/shakespeare/plays.txt','r')
-fulltext = []
-lineindex = {}
-for line in f:
-    try:
-        split = line.split('|')
-        fulltext.append(split[1].lower())
-        lineindex[split[0]] = split[1]
-    except IndexError:
-        print(line)
-s = '\n'.join(fulltext)
-print(len(s))
-words=Counter(re.findall(r"(\w[\w']*)",s))
-print(len(words))
-n = 1000
-unique_words = []
-for word, count in words.items():
-    if count == 1:
-        unique_words.append(word)
-print(len(unique_words))
-for word in unique_words:
-    row = c.execute('''
+DUMPFILE = 'P:/src/shakespeare/plays.txt'
+WORD = re.compile(r"(\w[\w']*)")
+# stay under SQLite's default limit of 999 bound variables
+BATCH_SIZE = 500
+FORMATS = ('pipe', 'tsv', 'csv', 'json')
+# the dump is written in text mode, so in the platform's encoding
+ENCODING = locale.getpreferredencoding(False)
+# byte ranges per worker, so a slow range doesn't hold up the others
+RANGES_PER_WORKER = 4
+# a dump line that starts a record; in the plain format any other line
+# carries on the text of the record before it (a line with a newline in it)
+RECORD = re.compile(r'(\d+)\|(.*)', re.DOTALL)
+# first line of a dump in the escaped format, where backslash, newline and
+# carriage return in the text are written as \\, \n and \r
+ESCAPED_HEADER = '#countwords escaped dump 1'
+ESCAPE = re.compile(r'\\(.)')
+ESCAPES = {'n': '\n', 'r': '\r'}
+# malformed dump lines are counted, but only this many are kept to show
+MAX_MALFORMED = 5
+# with mmap, hand the pages already read back to the OS every so often
+MMAP_RELEASE = 16 * 2**20
+
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def unescape(text):
+    return ESCAPE.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), text)
+
+
+def dump_lines(conn, path=DUMPFILE, escaped=False):
+    """Write the spoken lines to path as id|text, one per line.
+    @escaped: write the escaped format, which survives any text
+    """
+    rows = conn.execute('''SELECT id, text from lines where is_stagedir=0''')
+    with open(path, 'wt') as f:
+        if escaped:
+            f.write(ESCAPED_HEADER + '\n')
+        for row in rows:
+            f.write(str(row[0])+'|'+(escape(row[1]) if escaped else row[1])+'\n')
+
+
+def dump_is_escaped(path):
+    with open(path, 'rb') as f:
+        return f.readline().decode(ENCODING).rstrip('\r\n') == ESCAPED_HEADER
+
+
+def _raw_lines(path, start, use_mmap):
+    with open(path, 'rb') as f:
+        if not use_mmap:
+            f.seek(start)
+            yield from f
+            return
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            released = start - start % mmap.PAGESIZE
+            while start < len(m):
+                end = m.find(b'\n', start) + 1 or len(m)
+                yield m[start:end]
+                start = end
+                if start - released > MMAP_RELEASE and hasattr(m, 'madvise'):
+                    # or the mapped pages pile up in the resident set
+                    upto = start - start % mmap.PAGESIZE
+                    m.madvise(mmap.MADV_DONTNEED, released, upto - released)
+                    released = upto
+
+
+def iter_dump_lines(path=DUMPFILE, start=0, end=None, use_mmap=False):
+    """Yield the decoded lines of the records of the dump that start in
+    [start, end), reading through mmap or a buffered file, one line at a time.
+
+    A record's continuation lines go with it, so byte ranges can be cut
+    anywhere and every record is read by exactly one range.
+    """
+    raw = _raw_lines(path, start - 1 if start else 0, use_mmap)
+    offset = 0
+    if start:
+        # finish the line that runs over start, it belongs to the range before
+        offset = start - 1 + len(next(raw, b''))
+    leading = bool(start)
+    for line in raw:
+        text = line.decode(ENCODING)
+        is_record = RECORD.match(text) is not None
+        if leading and not is_record:
+            offset += len(line)
+            continue
+        leading = False
+        if end is not None and offset >= end and is_record:
+            break
+        offset += len(line)
+        yield text
+
+
+def new_malformed():
+    """A tally of malformed dump lines: how many, and the first MAX_MALFORMED."""
+    return {'count': 0, 'lines': []}
+
+
+def add_malformed(malformed, lines, count=None):
+    """Add lines (and with count, that many in all) to the malformed tally."""
+    malformed['count'] += len(lines) if count is None else count
+    malformed['lines'].extend(lines[:MAX_MALFORMED - len(malformed['lines'])])
+
+
+def parse_records(lines, escaped=False, malformed=None):
+    """Yield (line_id, text) for the records made of lines.
+
+    Text after the first '|' is kept whole, '|' and all. Lines that cannot
+    belong to any record are added to the malformed tally (see
+    new_malformed) instead of being lost without trace.
+    """
+    pending = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        match = RECORD.match(line)
+        if match:
+            if pending is not None:
+                yield pending
+            text = match.group(2)
+            pending = (int(match.group(1)), unescape(text) if escaped else text)
+        elif pending is not None and not escaped:
+            pending = (pending[0], pending[1] + '\n' + line)
+        elif line and line != ESCAPED_HEADER and malformed is not None:
+            add_malformed(malformed, [line])
+    if pending is not None:
+        yield pending
+
+
+def read_dump(path=DUMPFILE, use_mmap=False, malformed=None):
+    """Yield (line_id, text) for each record of the dump, in either format."""
+    return parse_records(iter_dump_lines(path, use_mmap=use_mmap), dump_is_escaped(path),
+                         malformed)
+
+
+def count_words(lines):
+    """Count the words of (line_id, text) pairs in one pass.
+
+    Returns the Counter and, for each word, the id of the first line it
+    occurs in, so rare words can be looked up by id instead of searched for.
+    """
+    words = Counter()
+    first_line = {}
+    for line_id, text in lines:
+        for word in WORD.findall(text.lower()):
+            words[word] += 1
+            if word not in first_line:
+                first_line[word] = line_id
+    return words, first_line
+
+
+def count_play(db, play_id):
+    """Map step of a count by play: the words of one play, overall and by speaker.
+
+    Returns (title, words, {speaker: words}, first_line).
+    """
+    conn = sqlite3.connect(db)
+    rows = conn.execute('''
+                    SELECT L.id, L.text, L.speaker, P.title
+                    FROM lines as L
+                    JOIN plays as P
+                    ON L.play_id = P.id
+                    WHERE L.play_id = ? AND L.is_stagedir=0
+                    ORDER BY L.id''', (play_id,))
+    title = None
+    speakers = {}
+    words = Counter()
+    first_line = {}
+    for line_id, text, speaker, title in rows:
+        line_words = WORD.findall(text.lower())
+        words.update(line_words)
+        speakers.setdefault(speaker, Counter()).update(line_words)
+        for word in line_words:
+            if word not in first_line:
+                first_line[word] = line_id
+    conn.close()
+    return title, words, speakers, first_line
+
+
+def line_owners(conn, line_ids):
+    """Look up the play and speaker of many lines: {line id: (play_id, speaker)}."""
+    owners = {}
+    for i in range(0, len(line_ids), BATCH_SIZE):
+        batch = line_ids[i:i + BATCH_SIZE]
+        rows = conn.execute('SELECT id, play_id, speaker FROM lines WHERE id IN ({})'
+                            .format(','.join('?' * len(batch))), batch)
+        for line_id, play_id, speaker in rows:
+            owners[line_id] = (play_id, speaker)
+    return owners
+
+
+def count_speakers(conn, records):
+    """count_words, also counting by (play_id, speaker) of each line, looked
+    up in the lines table a batch of records at a time.
+
+    Returns (words, first_line, {(play_id, speaker): words}).
+    """
+    words = Counter()
+    first_line = {}
+    speakers = {}
+    while True:
+        batch = list(itertools.islice(records, BATCH_SIZE))
+        if not batch:
+            break
+        owners = line_owners(conn, [line_id for line_id, text in batch])
+        for line_id, text in batch:
+            line_words = WORD.findall(text.lower())
+            words.update(line_words)
+            if line_id in owners:
+                speakers.setdefault(owners[line_id], Counter()).update(line_words)
+            for word in line_words:
+                if word not in first_line:
+                    first_line[word] = line_id
+    return words, first_line, speakers
+
+
+def count_range(path, start, end, use_mmap=False, db=None):
+    """Map step of a count by byte range: the words of the records of the
+    dump that start within [start, end). With db, they are also counted by
+    play and speaker (see count_speakers).
+
+    Returns (words, first_line, {(play_id, speaker): words}, malformed).
+    """
+    malformed = new_malformed()
+    records = parse_records(iter_dump_lines(path, start, end, use_mmap),
+                            dump_is_escaped(path), malformed)
+    if db is None:
+        words, first_line = count_words(records)
+        return words, first_line, {}, malformed
+    conn = sqlite3.connect(db)
+    words, first_line, speakers = count_speakers(conn, records)
+    conn.close()
+    return words, first_line, speakers, malformed
+
+
+def byte_ranges(path, parts):
+    size = os.path.getsize(path)
+    step = max(size // max(parts, 1), 1)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def merge_first_lines(first_line, other):
+    for word, line_id in other.items():
+        if word not in first_line or line_id < first_line[word]:
+            first_line[word] = line_id
+
+
+def parallel_count(db=DBNAME, dump=DUMPFILE, split='play', workers=None, use_mmap=False,
+                   tables=False):
+    """Count words in a process pool and merge the Counters.
+
+    split='play' counts each play of the database in its own task and also
+    gives per-play and per-speaker tables. split='bytes' cuts the dump into
+    byte ranges, which needs no database for the global table; with tables
+    the play and speaker of each line are looked up in db for the others.
+
+    Returns {'words': Counter, 'first_line': {word: line id},
+             'titles': {play_id: title}, 'plays': {play_id: Counter},
+             'speakers': {(play_id, speaker): Counter},
+             'malformed': {'count': lines, 'lines': [the first few]}}
+    """
+    workers = workers or os.cpu_count()
+    counts = {'words': Counter(), 'first_line': {}, 'titles': {}, 'plays': {}, 'speakers': {},
+              'malformed': new_malformed()}
+    if split == 'play' or tables:
+        conn = sqlite3.connect(db)
+        counts['titles'] = dict(conn.execute('SELECT id, title FROM plays ORDER BY id'))
+        conn.close()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        if split == 'play':
+            play_ids = list(counts['titles'])
+            results = executor.map(count_play, [db] * len(play_ids), play_ids)
+            for play_id, (title, words, speakers, first_line) in zip(play_ids, results):
+                counts['words'].update(words)
+                counts['plays'][play_id] = words
+                for speaker, speaker_words in speakers.items():
+                    counts['speakers'][(play_id, speaker)] = speaker_words
+                merge_first_lines(counts['first_line'], first_line)
+        elif split == 'bytes':
+            ranges = byte_ranges(dump, workers * RANGES_PER_WORKER)
+            results = executor.map(count_range, [dump] * len(ranges),
+                                   [r[0] for r in ranges], [r[1] for r in ranges],
+                                   [use_mmap] * len(ranges),
+                                   [db if tables else None] * len(ranges))
+            for words, first_line, speakers, malformed in results:
+                counts['words'].update(words)
+                merge_first_lines(counts['first_line'], first_line)
+                # a speaker's lines, and a play's, fall in more than one range
+                for (play_id, speaker), speaker_words in speakers.items():
+                    counts['speakers'].setdefault((play_id, speaker),
+                                                  Counter()).update(speaker_words)
+                    counts['plays'].setdefault(play_id, Counter()).update(speaker_words)
+                add_malformed(counts['malformed'], malformed['lines'], malformed['count'])
+        else:
+            raise ValueError('split must be "play" or "bytes", not %r' % split)
+    return counts
+
+
+def write_tables(counts, directory):
+    """Write the global, per-play and per-speaker frequency tables as TSV,
+    most frequent first. Plays are given by id and title, as two plays can
+    share a title.
+    """
+    os.makedirs(directory, exist_ok=True)
+    titles = counts['titles']
+    with open(os.path.join(directory, 'words.tsv'), 'w') as out:
+        for word, count in counts['words'].most_common():
+            print('{}\t{}'.format(word, count), file=out)
+    with open(os.path.join(directory, 'plays.tsv'), 'w') as out:
+        for play_id, words in counts['plays'].items():
+            for word, count in words.most_common():
+                print('{}\t{}\t{}\t{}'.format(play_id, titles.get(play_id), word, count),
+                      file=out)
+    with open(os.path.join(directory, 'speakers.tsv'), 'w') as out:
+        for (play_id, speaker), words in counts['speakers'].items():
+            for word, count in words.most_common():
+                print('{}\t{}\t{}\t{}\t{}'.format(play_id, titles.get(play_id), speaker,
+                                                  word, count), file=out)
+
+
+def rare_words(words, threshold=1):
+    """The words occurring at most threshold times, rarest first."""
+    return sorted((word for word, count in words.items() if count <= threshold),
+                  key=lambda word: (words[word], word))
+
+
+def fetch_lines(conn, line_ids):
+    """Look up many lines at once: {line id: (text, speaker, title, act_num)}."""
+    line_ids = sorted(set(line_ids))
+    lines = {}
+    for i in range(0, len(line_ids), BATCH_SIZE):
+        batch = line_ids[i:i + BATCH_SIZE]
+        rows = conn.execute('''
                     SELECT L.id, L.text, L.speaker, 
                             P.title, A.act_num
                     FROM lines as L
                     JOIN plays as P, acts as A
                     ON L.play_id = P.id 
                         AND L.act_id = A.id 
-                    WHERE L.text LIKE ?
-                    ''',('%'+word+'%',)).fetchone()
-    s = '{}|{}|{}|{}|Act {}'.format(word, row[1], row[2], row[3], row[4])
-    print(s)
-    
+                    WHERE L.id IN ({})
+                    '''.format(','.join('?' * len(batch))), batch)
+        for row in rows:
+            lines[row[0]] = row[1:]
+    return lines
+
+
+def write_report(words, first_line, lines, rare, fmt='pipe', out=sys.stdout):
+    """Write word, count and the first line of each rare word in fmt."""
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(['word', 'count', 'line_id', 'text', 'speaker', 'title', 'act'])
+    for word in rare:
+        line_id = first_line[word]
+        text, speaker, title, act_num = lines.get(line_id, (None,) * 4)
+        if fmt == 'pipe':
+            # the original report format
+            print('{}|{}|{}|{}|Act {}'.format(word, text, speaker, title, act_num), file=out)
+        elif fmt == 'tsv':
+            print('\t'.join(str(field) for field in
+                            (word, words[word], line_id, text, speaker, title, act_num)),
+                  file=out)
+        elif fmt == 'csv':
+            writer.writerow([word, words[word], line_id, text, speaker, title, act_num])
+        else:
+            print(json.dumps({'word': word, 'count': words[word], 'line_id': line_id,
+                              'text': text, 'speaker': speaker, 'title': title,
+                              'act': act_num}), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report the rare words of the plays '
+                                     'with the line each first occurs in.')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--dump', default=DUMPFILE, help='id|text file of the spoken lines')
+    parser.add_argument('--make-dump', action='store_true',
+                        help='write the dump from the database first')
+    parser.add_argument('--escaped', action='store_true',
+                        help='with --make-dump, write the escaped dump format')
+    parser.add_argument('--mmap', action='store_true',
+                        help='read the dump through mmap instead of buffered reads')
+    parser.add_argument('--threshold', type=int, default=1,
+                        help='report words occurring at most this many times')
+    parser.add_argument('--format', choices=FORMATS, default='pipe')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='count in this many processes (0: one pass in this process)')
+    parser.add_argument('--split', choices=('play', 'bytes'), default='play',
+                        help='with --jobs, split the work by play or by byte range of the dump')
+    parser.add_argument('--tables', metavar='DIR',
+                        help='with --jobs, write the frequency tables to DIR')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    if args.make_dump:
+        dump_lines(conn, args.dump, args.escaped)
+    t = time.perf_counter()
+    if args.jobs:
+        counts = parallel_count(args.db, args.dump, args.split, args.jobs, args.mmap,
+                                bool(args.tables))
+        words, first_line, malformed = counts['words'], counts['first_line'], counts['malformed']
+        if args.tables:
+            write_tables(counts, args.tables)
+    else:
+        malformed = new_malformed()
+        words, first_line = count_words(read_dump(args.dump, args.mmap, malformed))
+    if malformed['count']:
+        print('skipped {} malformed lines of the dump, e.g.:'.format(malformed['count']),
+              file=sys.stderr)
+        for line in malformed['lines']:
+            print('    ' + repr(line), file=sys.stderr)
+    print('counted {} words in {:.2f}s'.format(sum(words.values()), time.perf_counter() - t),
+          file=sys.stderr)
+    print(len(words), file=sys.stderr)
+    rare = rare_words(words, args.threshold)
+    print(len(rare), file=sys.stderr)
+    lines = fetch_lines(conn, [first_line[word] for word in rare])
+    write_report(words, first_line, lines, rare, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# coding: utf-8
+
+"""
+Serve a local directory of Moby XML files over HTTP so the fetchers can be
+exercised without ibiblio being reachable.
+
+    with FixtureServer('./moby') as server:
+        index = rebase_index(MOBY_INDEX, server.base_url)
+"""
+import email.utils
+import functools
+import io
+import os
+import re
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Set, Text, Tuple
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    ''' Static file handler that honours conditional and range requests
+        (ETag/If-None-Match, If-Modified-Since, Range/If-Range) and can be
+        told to be slow, flaky or to drop connections part way through a
+        body so that timeouts, retries and resumed downloads can be tested.
+    '''
+
+    def __init__(self, *args, fixture=None, **kwargs):
+        self.fixture = fixture
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        with self.fixture.lock:
+            self.fixture.requests += 1
+        if self.fixture.delay:
+            time.sleep(self.fixture.delay)
+        with self.fixture.lock:
+            failures = self.fixture.failures.get(self.path, 0)
+            if failures < self.fixture.flaky:
+                self.fixture.failures[self.path] = failures + 1
+                self.send_error(503, 'Fixture server is being flaky')
+                return
+            cut = self.fixture.cut and self.path not in self.fixture.cuts
+            if cut:
+                self.fixture.cuts.add(self.path)
+        body = self.send_head()
+        if body is None:
+            return
+        with body:
+            if cut:
+                # claim the whole length but hang up part way through
+                self.wfile.write(body.read(self.fixture.cut))
+                self.close_connection = True
+            else:
+                self.copyfile(body, self.wfile)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        st = os.stat(path)
+        etag = '"%x-%x"' % (st.st_size, st.st_mtime_ns)
+        last_modified = self.date_time_string(int(st.st_mtime))
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            return self._not_modified(etag, last_modified)
+        since = self.headers.get('If-Modified-Since')
+        if since and 'If-None-Match' not in self.headers:
+            try:
+                if int(st.st_mtime) <= email.utils.parsedate_to_datetime(since).timestamp():
+                    return self._not_modified(etag, last_modified)
+            except (TypeError, ValueError):
+                pass
+        f = open(path, 'rb')
+        start, end = 0, st.st_size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        partial = match and (if_range is None or if_range in (etag, last_modified))
+        if partial:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start > end:
+                f.close()
+                self.send_error(416, 'Requested range not satisfiable')
+                return None
+            f.seek(start)
+            body = io.BytesIO(f.read(end - start + 1))
+            f.close()
+            f = body
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, st.st_size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def _not_modified(self, etag, last_modified):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        return None
+
+    def log_message(self, format, *args):
+        if self.fixture.verbose:
+            super().log_message(format, *args)
+
+
+class FixtureServer():
+    ''' Threaded HTTP server for a directory of fixture files.
+        @flaky: number of 503 responses to send for each path before serving it
+        @delay: seconds to sleep before answering each request
+        @cut: if set, the first GET of each path is dropped after this many
+            bytes of the body
+    '''
+
+    def __init__(self, directory: Text, host: Text = '127.0.0.1', port: int = 0,
+                 flaky: int = 0, delay: float = 0.0, cut: int = 0,
+                 verbose: bool = False) -> None:
+        self.directory: Text = directory
+        self.host: Text = host
+        self.port: int = port
+        self.flaky: int = flaky
+        self.delay: float = delay
+        self.cut: int = cut
+        self.cuts: Set[Text] = set()
+        self.verbose: bool = verbose
+        self.requests: int = 0
+        self.failures: Dict[Text, int] = {}
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def base_url(self) -> Text:
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def url(self, name: Text) -> Text:
+        return '%s/%s' % (self.base_url, name)
+
+    def start(self) -> None:
+        handler = functools.partial(FixtureRequestHandler,
+                                    directory=self.directory, fixture=self)
+        self.httpd = ThreadingHTTPServer((self.host, self.port), handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def rebase_index(index: List[Tuple[Text, Text]], base_url: Text) -> List[Tuple[Text, Text]]:
+    """Point every url of a MOBY_INDEX style list at base_url, keeping the file name."""
+    return [(title, '%s/%s' % (base_url.rstrip('/'), url.rsplit('/', 1)[1]))
+            for title, url in index]
+
+
+if __name__ == '__main__':
+    import sys
+    server = FixtureServer(sys.argv[1] if len(sys.argv) > 1 else '.',
+                           port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000,
+                           verbose=True)
+    server.start()
+    print('Serving %s on %s' % (server.directory, server.base_url))
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,403 @@
+# coding: utf-8
+
+"""
+SQLite FTS5 index over actor_lines.
+
+actor_lines_fts is an external content table: it stores only the index and
+reads the text back from actor_lines, and triggers keep it in step with
+every insert, update and delete, so plays stored by store or write_play,
+and plays replaced by an incremental run, are indexed in the same
+transaction as their rows. Bulk loads (syncshake.bulk_load) drop the
+triggers and rebuild the index once at the end instead.
+
+    create_fts(conn)
+    for row in search(conn, 'bloody hands', mode='phrase'):
+        print(row['title'], row['act'], row['scene'], row['speaker'], row['the_text'])
+"""
+import contextlib
+import re
+import statistics
+import time
+from typing import Any, Dict, List, Optional, Sequence, Text, Tuple
+
+from textindex import EDITION_IS, MOBY_EDITION
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    # before python 3.11
+    import sre_constants
+    import sre_parse
+
+# possessive repeats and atomic groups only exist from python 3.11
+REPEATS = tuple(op for op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+                              getattr(sre_constants, 'POSSESSIVE_REPEAT', None))
+                if op is not None)
+ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+
+# index table -> FTS5 options; actor_lines_trigram indexes every three
+# character substring, for arbitrary LIKE patterns and regexes
+INDEXES: Dict[Text, Text] = {'actor_lines_fts': "prefix='2 3'",
+                             'actor_lines_trigram': "tokenize='trigram'"}
+
+
+def _index_sql(table: Text, options: Text) -> List[Text]:
+    sql = ["""CREATE VIRTUAL TABLE IF NOT EXISTS %(table)s
+                USING fts5(the_text, content='actor_lines', content_rowid='id', %(options)s)""",
+           """CREATE TRIGGER IF NOT EXISTS %(table)s_insert
+                AFTER INSERT ON actor_lines BEGIN
+                    INSERT INTO %(table)s(rowid, the_text)
+                    VALUES (new.id, new.the_text);
+                END""",
+           """CREATE TRIGGER IF NOT EXISTS %(table)s_delete
+                AFTER DELETE ON actor_lines BEGIN
+                    INSERT INTO %(table)s(%(table)s, rowid, the_text)
+                    VALUES ('delete', old.id, old.the_text);
+                END""",
+           """CREATE TRIGGER IF NOT EXISTS %(table)s_update
+                AFTER UPDATE OF the_text ON actor_lines BEGIN
+                    INSERT INTO %(table)s(%(table)s, rowid, the_text)
+                    VALUES ('delete', old.id, old.the_text);
+                    INSERT INTO %(table)s(rowid, the_text)
+                    VALUES (new.id, new.the_text);
+                END"""]
+    return [statement % {'table': table, 'options': options} for statement in sql]
+
+
+FTS_TABLES: List[Text] = [sql for table, options in INDEXES.items()
+                          for sql in _index_sql(table, options)]
+
+TRIGGERS: List[Text] = ['%s_%s' % (table, event) for table in INDEXES
+                        for event in ('insert', 'delete', 'update')]
+
+# the indexes are only known to be complete if the tables and all their triggers are there
+FTS_EXISTS = '''SELECT count(*) = %d FROM sqlite_master WHERE name IN (%s)''' % (
+    len(INDEXES) + len(TRIGGERS), ', '.join("'%s'" % name for name in list(INDEXES) + TRIGGERS))
+
+REBUILD: List[Text] = ["INSERT INTO %s(%s) VALUES ('rebuild')" % (table, table)
+                       for table in INDEXES]
+
+SEARCH = '''SELECT
+                plays.title, acts.title AS act, scenes.title AS scene,
+                actor_lines.speaker, actor_lines.the_text, actor_lines_fts.rank
+            FROM
+                actor_lines_fts
+                JOIN actor_lines ON actor_lines.id = actor_lines_fts.rowid
+                JOIN plays ON plays.id = actor_lines.play_id
+                LEFT JOIN acts ON acts.id = actor_lines.act_id
+                LEFT JOIN scenes ON scenes.id = actor_lines.scene_id
+            WHERE
+                actor_lines_fts MATCH ?
+                AND %s
+            ORDER BY actor_lines_fts.rank
+            LIMIT ?''' % EDITION_IS
+
+SEARCH_LIKE = '''SELECT
+                    plays.title, acts.title AS act, scenes.title AS scene,
+                    actor_lines.speaker, actor_lines.the_text, NULL AS rank
+                FROM
+                    actor_lines
+                    JOIN plays ON plays.id = actor_lines.play_id
+                    LEFT JOIN acts ON acts.id = actor_lines.act_id
+                    LEFT JOIN scenes ON scenes.id = actor_lines.scene_id
+                WHERE
+                    actor_lines.the_text LIKE ?
+                    AND %s
+                LIMIT ?''' % EDITION_IS
+
+MODES = ('token', 'prefix', 'phrase', 'raw')
+
+
+def match_expression(query: Text, mode: Text = 'token') -> Text:
+    """Turn a user query into an FTS5 MATCH expression.
+
+    token:  every word must appear in the line, in any order
+    prefix: every word must start a word in the line ('bloo' finds 'bloody')
+    phrase: the words must appear together and in order
+    raw:    query is already FTS5 syntax (NEAR, OR, NOT, column filters ...)
+    """
+    if mode == 'raw':
+        return query
+    if mode not in MODES:
+        raise ValueError('unknown search mode %r' % mode)
+    words = re.findall(r"[\w']+", query)
+    if not words:
+        raise ValueError('nothing to search for in %r' % query)
+    if mode == 'phrase':
+        return '"%s"' % ' '.join(words)
+    suffix = '*' if mode == 'prefix' else ''
+    return ' '.join('"%s"%s' % (word, suffix) for word in words)
+
+
+def create_fts(conn) -> bool:
+    """Create the index and its triggers; index any lines already stored.
+
+    Returns True if the index was (re)built by this call.
+    """
+    created = not conn.execute(FTS_EXISTS).fetchone()[0]
+    for sql in FTS_TABLES:
+        conn.execute(sql)
+    if created:
+        for sql in REBUILD:
+            conn.execute(sql)
+    conn.commit()
+    return created
+
+
+def rebuild_fts(conn) -> None:
+    """Re-index every line, e.g. after actor_lines was changed with the triggers dropped."""
+    for sql in REBUILD:
+        conn.execute(sql)
+    conn.commit()
+
+
+@contextlib.contextmanager
+def deferred_fts(conn):
+    """Stop indexing row by row for the length of a bulk load.
+
+    The triggers are dropped and the whole index is rebuilt in one pass at
+    the end, which is several times faster than a trigger per line; a load
+    that changed no rows (an incremental run over unchanged plays) skips
+    the rebuild. A load that raises has its uncommitted rows rolled back and
+    the index is rebuilt over what was committed. If the process dies half
+    way the triggers are missing, so the next create_fts rebuilds the index.
+    """
+    for name in TRIGGERS:
+        conn.execute('DROP TRIGGER IF EXISTS %s' % name)
+    changes = conn.total_changes
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        for sql in FTS_TABLES:
+            conn.execute(sql)
+        if conn.total_changes != changes:
+            rebuild_fts(conn)
+
+
+def _rows(cursor) -> List[Dict]:
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def search(conn, query: Text, mode: Text = 'token', limit: Optional[int] = 20,
+           edition: Optional[Text] = MOBY_EDITION) -> List[Dict]:
+    """Best matches first, as dicts of title, act, scene, speaker, the_text and
+    rank, in the plays of edition (all editions if None)."""
+    cursor = conn.execute(SEARCH, (match_expression(query, mode), edition,
+                                   -1 if limit is None else limit))
+    return _rows(cursor)
+
+
+def search_like(conn, like: Text, limit: Optional[int] = None,
+                edition: Optional[Text] = MOBY_EDITION) -> List[Dict]:
+    """The old LIKE scan, with the same columns as search (rank is None)."""
+    cursor = conn.execute(SEARCH_LIKE, (like, edition, -1 if limit is None else limit))
+    return _rows(cursor)
+
+
+# Trigram search. A pattern is reduced to an expression over the literal
+# strings any match must contain: a literal, ('and', [...]) or ('or', [...]),
+# or None when nothing is certain. Literals of three or more characters
+# become trigram MATCH phrases that narrow the candidate lines; the real
+# LIKE or regex is then checked on those candidates only.
+
+Literals = Any
+
+
+def _and(items: List[Literals]) -> Literals:
+    items = [item for item in items if item is not None]
+    if not items:
+        return None
+    return items[0] if len(items) == 1 else ('and', items)
+
+
+def _or(items: List[Literals]) -> Literals:
+    if not items or any(item is None for item in items):
+        # one branch with no literal in it can match anything
+        return None
+    return items[0] if len(items) == 1 else ('or', items)
+
+
+def like_literals(like: Text) -> Literals:
+    """The runs of a LIKE pattern between its % and _ wildcards."""
+    return _and([run for run in re.split(r'[%_]', like) if len(run) >= 3])
+
+
+def _regex_literals(parsed) -> Literals:
+    items: List[Literals] = []
+    run: List[Text] = []
+
+    def end_run() -> None:
+        if len(run) >= 3:
+            items.append(''.join(run))
+        run.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        end_run()
+        if op is sre_constants.SUBPATTERN:
+            items.append(_regex_literals(av[-1]))
+        elif op is sre_constants.BRANCH:
+            items.append(_or([_regex_literals(branch) for branch in av[1]]))
+        elif op in REPEATS and av[0] >= 1:
+            # the body has to match at least once
+            items.append(_regex_literals(av[2]))
+        elif ATOMIC_GROUP is not None and op is ATOMIC_GROUP:
+            items.append(_regex_literals(av))
+    end_run()
+    return _and(items)
+
+
+def regex_literals(pattern: Text, flags: int = 0) -> Literals:
+    """The literal strings any match of a Python regex must contain."""
+    return _regex_literals(sre_parse.parse(pattern, flags))
+
+
+def trigram_expression(literals: Literals) -> Optional[Text]:
+    """FTS5 MATCH expression for actor_lines_trigram, or None to scan everything."""
+    if literals is None:
+        return None
+    if isinstance(literals, str):
+        return '"%s"' % literals.replace('"', '""')
+    op = ' AND ' if literals[0] == 'and' else ' OR '
+    return '(%s)' % op.join(trigram_expression(item) for item in literals[1])
+
+
+SEARCH_TRIGRAM = '''SELECT
+                    plays.title, acts.title AS act, scenes.title AS scene,
+                    actor_lines.speaker, actor_lines.the_text, NULL AS rank
+                FROM
+                    actor_lines
+                    JOIN plays ON plays.id = actor_lines.play_id
+                    LEFT JOIN acts ON acts.id = actor_lines.act_id
+                    LEFT JOIN scenes ON scenes.id = actor_lines.scene_id
+                WHERE
+                    actor_lines.id IN (SELECT rowid FROM actor_lines_trigram
+                                       WHERE actor_lines_trigram MATCH ?)
+                    AND %%s
+                    AND %s
+                LIMIT ?''' % EDITION_IS
+
+SEARCH_ALL = SEARCH_TRIGRAM.replace('''actor_lines.id IN (SELECT rowid FROM actor_lines_trigram
+                                       WHERE actor_lines_trigram MATCH ?)
+                    AND ''', '')
+
+
+def candidates(conn, expression: Optional[Text]) -> int:
+    """How many lines the trigram index leaves to check for expression."""
+    if expression is None:
+        return conn.execute('SELECT count(*) FROM actor_lines').fetchone()[0]
+    return conn.execute('SELECT count(*) FROM actor_lines_trigram WHERE actor_lines_trigram MATCH ?',
+                        (expression,)).fetchone()[0]
+
+
+def search_like_trigram(conn, like: Text, limit: Optional[int] = None,
+                        edition: Optional[Text] = MOBY_EDITION) -> List[Dict]:
+    """search_like, narrowed by the trigram index when the pattern allows it."""
+    expression = trigram_expression(like_literals(like))
+    if expression is None:
+        return search_like(conn, like, limit, edition)
+    cursor = conn.execute(SEARCH_TRIGRAM % 'actor_lines.the_text LIKE ?',
+                          (expression, like, edition, -1 if limit is None else limit))
+    return _rows(cursor)
+
+
+def search_regex(conn, pattern: Text, flags: int = 0, limit: Optional[int] = None,
+                 use_index: bool = True, edition: Optional[Text] = MOBY_EDITION) -> List[Dict]:
+    """The lines where the Python regex pattern matches (re.search).
+
+    Candidates come from the trigram index; patterns without a usable
+    literal (or use_index=False) check every line.
+    """
+    regex = re.compile(pattern, flags)
+    conn.create_function('regex_search', 1, lambda text: regex.search(text) is not None,
+                         deterministic=True)
+    expression = trigram_expression(regex_literals(pattern, flags)) if use_index else None
+    if expression is None:
+        cursor = conn.execute(SEARCH_ALL % 'regex_search(actor_lines.the_text)',
+                              (edition, -1 if limit is None else limit))
+    else:
+        cursor = conn.execute(SEARCH_TRIGRAM % 'regex_search(actor_lines.the_text)',
+                              (expression, edition, -1 if limit is None else limit))
+    return _rows(cursor)
+
+
+def _time(run, repeat: int) -> Tuple[float, int]:
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        count = len(run())
+        times.append(time.perf_counter() - t)
+    return statistics.median(times), count
+
+
+def benchmark(conn, queries: Sequence[Tuple[Text, Text, Text]], repeat: int = 5) -> List[Dict]:
+    """Compare median latency of the LIKE scan and the FTS index.
+    @queries: (like pattern, fts query, fts mode) triples asking the same thing
+    """
+    results = []
+    for like, query, mode in queries:
+        like_time, like_count = _time(lambda: search_like(conn, like), repeat)
+        fts_time, fts_count = _time(lambda: search(conn, query, mode, None), repeat)
+        results.append({'like': like, 'query': query, 'mode': mode,
+                        'like_time': like_time, 'like_count': like_count,
+                        'fts_time': fts_time, 'fts_count': fts_count})
+        print('%-16s %6d rows %8.2fms   %-8s %-16s %6d rows %8.2fms  %6.1fx'
+              % (like, like_count, like_time * 1000, mode, query, fts_count,
+                 fts_time * 1000, like_time / max(fts_time, 1e-9)))
+    return results
+
+
+def benchmark_trigram(conn, patterns: Sequence[Tuple[Text, Text]], repeat: int = 3) -> List[Dict]:
+    """Compare full scans with trigram narrowed searches.
+    @patterns: ('like', pattern) or ('regex', pattern) pairs
+    """
+    total = candidates(conn, None)
+    results = []
+    for kind, pattern in patterns:
+        if kind == 'like':
+            literals = like_literals(pattern)
+            scan_time, scan_count = _time(lambda: search_like(conn, pattern), repeat)
+            index_time, index_count = _time(lambda: search_like_trigram(conn, pattern), repeat)
+        else:
+            literals = regex_literals(pattern)
+            scan_time, scan_count = _time(lambda: search_regex(conn, pattern, use_index=False),
+                                          repeat)
+            index_time, index_count = _time(lambda: search_regex(conn, pattern), repeat)
+        count = candidates(conn, trigram_expression(literals))
+        results.append({'kind': kind, 'pattern': pattern, 'lines': total, 'candidates': count,
+                        'matches': index_count, 'scan_time': scan_time,
+                        'index_time': index_time, 'same': scan_count == index_count})
+        print('%-5s %-24s %7d of %7d lines (%5.1f%%) %6d matches  scan %8.2fms  '
+              'trigram %8.2fms  %6.1fx%s'
+              % (kind, pattern, count, total, 100.0 * count / max(total, 1), index_count,
+                 scan_time * 1000, index_time * 1000, scan_time / max(index_time, 1e-9),
+                 '' if scan_count == index_count else '  MISMATCH'))
+    return results
+
+
+BENCHMARK_QUERIES = [('%piss%', 'piss', 'prefix'),
+                     ('%blood%', 'blood', 'prefix'),
+                     ('%the king%', 'the king', 'phrase'),
+                     ('%love%', 'love', 'token')]
+
+BENCHMARK_PATTERNS = [('like', '%piss%'), ('like', '%the k_ng%'), ('like', '%o\'er%'),
+                      ('like', '%a%'), ('regex', r'(king|queen) of'),
+                      ('regex', r'slings?\s+and arrows'), ('regex', r'\bbl\w*d\b'),
+                      ('regex', r'^[A-Z]\w+ die')]
+
+
+if __name__ == '__main__':
+    import sqlite3
+    import sys
+    with sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else './syncshakedb.sqlite') as db:
+        create_fts(db)
+        benchmark(db, BENCHMARK_QUERIES)
+        benchmark_trigram(db, BENCHMARK_PATTERNS)
@@ -0,0 +1,370 @@
+# coding: utf-8
+
+"""
+Strip the Project Gutenberg header and footer (licence, small print,
+transcriber notes) from an etext, leaving the work itself.
+
+Texts are handled as bytes, line by line, so they are written back in
+whatever encoding they came in and never held in memory whole.
+
+    with open('hamlet10.txt', 'rb') as src, open('plain.txt', 'wb') as dest:
+        dest.writelines(GutenbergCleaner(src).lines())
+
+The cleaned plays are then parsed (PlainPlayParser) into the same rows as
+playparser gives for the Moby XML and stored through syncshake.BulkLoader,
+with plays.edition telling the editions apart:
+
+    handler = DownloadHandler()
+    handler.clean_gutenberg()
+    load_works(sqlite3.connect(syncshake.DBFILE), handler.cache, handler._index)
+"""
+import gzip
+import hashlib
+import itertools
+import re
+import time
+import alignment
+import syncshake
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Text, Tuple
+
+Row = Tuple[Any, ...]
+
+# the work starts after one of these and ends before one of the ends; old
+# etexts have the small print, newer ones *** START/END OF ... *** lines
+START = re.compile(rb'^\s*(\*{3}\s*START OF (THE |THIS )?PROJECT GUTENBERG'
+                   rb'|\*END\*\s*THE SMALL PRINT)', re.IGNORECASE)
+END = re.compile(rb'^\s*(\*{3}\s*)?END OF (THE |THIS )?PROJECT GUTENBERG', re.IGNORECASE)
+# a start marker is only looked for this far in, so a text without one is
+# not held in memory to the end before it is known to have none
+HEADER_LINES = 1000
+# characters to cut off the end of particular etexts before cleaning; the
+# sonnets end in a footer the END markers do not catch
+TRIM_TAIL: Dict[Text, int] = {'wssnt10.txt': 120}
+# bumped whenever cleaning changes, so older plain copies are redone
+CLEANER_VERSION = 1
+# the cache version the cleaned texts are stored as
+PLAIN = 'plain'
+# plays.edition by the comment get_relevant_works gives a work
+EDITIONS: Dict[Text, Text] = {'': 'gutenberg', 'folio': 'gutenberg folio'}
+
+
+def _trim(lines: Iterable[bytes], nbytes: int) -> Iterator[bytes]:
+    """lines without their last nbytes, holding back only that much."""
+    held = []
+    size = 0
+    for line in lines:
+        held.append(line)
+        size += len(line)
+        while held and size - len(held[0]) >= nbytes:
+            size -= len(held[0])
+            yield held.pop(0)
+    rest = b''.join(held)
+    if len(rest) > nbytes:
+        yield rest[:len(rest) - nbytes]
+
+
+class GutenbergCleaner():
+    ''' Streams the body of a Gutenberg etext.
+        @trim: bytes to drop from the very end of the raw text first
+    '''
+
+    def __init__(self, infile: BinaryIO, trim: int = 0) -> None:
+        self.infile = infile
+        self.trim: int = trim
+
+    def lines(self) -> Iterator[bytes]:
+        lines = iter(self.infile)
+        if self.trim:
+            lines = _trim(lines, self.trim)
+        header = []
+        for line in lines:
+            if START.match(line):
+                header = None
+                break
+            header.append(line)
+            if len(header) >= HEADER_LINES:
+                break
+        if header:
+            # no header found: the text is all body
+            lines = itertools.chain(header, lines)
+        for line in lines:
+            if END.match(line):
+                return
+            yield line
+
+    def extract_text(self) -> bytes:
+        return b''.join(self.lines())
+
+
+def clean_file(src: Text, dest: Text, trim: int = 0) -> Dict:
+    """Write the cleaned body of the etext at src (gzipped if it ends in .gz)
+    to dest. Returns the bytes read and written, the sha256 of what was
+    read and the seconds taken.
+    """
+    t = time.perf_counter()
+    digest = hashlib.sha256()
+    read = 0
+
+    def source(f):
+        nonlocal read
+        for line in f:
+            digest.update(line)
+            read += len(line)
+            yield line
+
+    opener = gzip.open if src.endswith('.gz') else open
+    written = 0
+    with opener(src, 'rb') as f, open(dest, 'wb') as out:
+        for line in GutenbergCleaner(source(f), trim).lines():
+            out.write(line)
+            written += len(line)
+        # the footer is not read by the cleaner, but is part of the checksum
+        for line in source(f):
+            pass
+    return {'read': read, 'written': written, 'source_sha256': digest.hexdigest(),
+            'time': time.perf_counter() - t}
+
+
+# play structure in the plain texts; headings stand on lines of their own
+# near the margin, speeches start with the speaker's name and a full stop
+# ('  Ham. To be...', or 'HAMLET.' in capitals at the margin) and verse
+# continues on lines indented further
+NUMBER = (r'(?:[IVXL]+|\d+|FIRST|SECOND|THIRD|FOURTH|FIFTH|First|Second|Third|Fourth|Fifth'
+          r'|[A-Z][a-z]+(?:us|a))\b')
+ACT = r'(?:ACT|Act|Actus)\s+' + NUMBER
+SCENE = r'(?:SCENE|Scene|Scena|Scoena|Scaena)\s+' + NUMBER
+# a line of its own, except that a scene heading may carry its location
+HEADING = re.compile(r'^ {0,3}(?:(?P<act>%s)\.?\s*)?(?:(?P<scene>%s)\.?\s*(?P<rest>.*?))?\s*$'
+                     % (ACT, SCENE))
+SECTION = re.compile(r'^ {0,3}(?P<section>(?:THE )?(?:PROLOGUE|EPILOGUE|INDUCTION))\.?\s*$')
+SPEECH = re.compile(r"^(?P<indent> {0,3})(?P<speaker>[A-Z][\w']*(?: [A-Za-z][\w']*){0,3})\."
+                    r"(?:\s+(?P<text>\S.*))?$")
+STAGEDIR = re.compile(r'^\s*(?:\[|(?:Enter|Exit|Exeunt|Re-enter|Reenter|Manet|Flourish|Alarum|'
+                      r'Alarums|Sennet|Trumpets|Hautboys|Thunder|Musicke|Music|Dies|Dyes)\b)')
+# lines set this far in are the right hand stage directions ('Exit.')
+STAGEDIR_INDENT = 16
+PERSONAE = re.compile(r'^\s*(?:DRAMATIS PERSONAE|Dramatis Personae|THE PERSONS OF THE PLAY|'
+                      r'PERSONS REPRESENTED)', re.IGNORECASE)
+SCENE_DESCRIPTION = re.compile(r'^\s*SCENE[.:]?\s*[-:]+\s*(?P<scene>\S.*)$')
+THE_END = re.compile(r'^\s*THE END\b')
+
+
+class PlainPlayParser():
+    ''' Turns the lines of a cleaned Gutenberg play into playparser rows,
+        one line at a time; only the speech or stage direction being read
+        (and the personae, until the first act) is held.
+    '''
+
+    def __init__(self, title: Text) -> None:
+        self.title: Text = title
+        self.scene_description: Optional[Text] = None
+        self.personae: List[Row] = []
+        self.in_personae: bool = False
+        self.header_sent: bool = False
+        self.act: Optional[Text] = None
+        # a scene heading is only sent with the location line that follows it
+        self.pending_scene: Optional[Text] = None
+        self.has_scene: bool = False
+        self.speaker: Optional[Text] = None
+        self.speech: Optional[List[Text]] = None
+        self.stagedir: Optional[List[Text]] = None
+        self.ended: bool = False
+
+    def _flush(self) -> List[Row]:
+        rows: List[Row] = []
+        if self.speech:
+            rows.append(('speech', self.speaker, self.speech))
+        if self.stagedir:
+            rows.append(('stagedir', ' '.join(self.stagedir)))
+        self.speech = self.stagedir = None
+        return rows
+
+    def _header(self) -> List[Row]:
+        if self.header_sent:
+            return []
+        self.header_sent = True
+        rows: List[Row] = [('play', self.title, None, self.scene_description)]
+        rows.extend(self.personae)
+        self.personae = []
+        return rows
+
+    def _open_scene(self) -> List[Row]:
+        """Rows to send before the first content of a scene."""
+        rows: List[Row] = []
+        if self.pending_scene is not None:
+            rows.append(('scene', self.pending_scene))
+            self.pending_scene = None
+            self.has_scene = True
+        elif not self.has_scene:
+            # an act without scenes (or before its first): the act is one scene
+            rows.append(('scene', self.act))
+            self.has_scene = True
+        return rows
+
+    def _act(self, title: Text) -> List[Row]:
+        rows = self._flush() + self._header()
+        rows.append(('act', title))
+        self.act = title
+        self.pending_scene = None
+        self.has_scene = False
+        self.speaker = None
+        return rows
+
+    def feed_line(self, line: Text) -> List[Row]:
+        if self.ended:
+            return []
+        line = line.rstrip('\r\n')
+        stripped = line.strip()
+        if not stripped:
+            # a blank line ends a stage direction, but not a speech
+            return self._flush() if self.stagedir else []
+        if THE_END.match(line):
+            self.ended = True
+            return self._flush()
+        section = SECTION.match(line)
+        if section:
+            title = section.group('section')
+            if self.act is None or title.endswith('EPILOGUE'):
+                rows = self._act(title)
+            else:
+                rows = self._flush()
+            self.pending_scene = title
+            self.has_scene = False
+            return rows
+        heading = HEADING.match(line)
+        if heading and (heading.group('act') or heading.group('scene')):
+            rows: List[Row] = []
+            if heading.group('act'):
+                rows.extend(self._act(heading.group('act')))
+            else:
+                rows.extend(self._flush())
+            if heading.group('scene'):
+                scene = heading.group('scene')
+                if self.act is None:
+                    rows.extend(self._act('ACT I'))
+                self.pending_scene = scene + ('.  ' + heading.group('rest')
+                                              if heading.group('rest') else '')
+                self.has_scene = False
+                self.speaker = None
+            return rows
+        if self.act is None:
+            return self._front_matter(line, stripped)
+        return self._body(line, stripped)
+
+    def _front_matter(self, line: Text, stripped: Text) -> List[Row]:
+        description = SCENE_DESCRIPTION.match(line)
+        if description:
+            self.scene_description = description.group('scene')
+            self.in_personae = False
+        elif PERSONAE.match(line):
+            self.in_personae = True
+        elif self.in_personae:
+            self.personae.append(('persona', '', stripped))
+        return []
+
+    def _body(self, line: Text, stripped: Text) -> List[Row]:
+        indent = len(line) - len(line.lstrip())
+        if self.pending_scene is not None and indent == 0 and not STAGEDIR.match(line) \
+                and not (SPEECH.match(line) and stripped.split('.')[0].isupper()):
+            # the location line under a scene heading
+            self.pending_scene += '.  ' + stripped
+            return []
+        rows = self._open_scene()
+        if STAGEDIR.match(line) or indent >= STAGEDIR_INDENT:
+            rows.extend(self._flush())
+            self.stagedir = [stripped]
+            return rows
+        speech = SPEECH.match(line)
+        if speech and (speech.group('indent') or speech.group('speaker').isupper()):
+            rows.extend(self._flush())
+            self.speaker = speech.group('speaker')
+            self.speech = [speech.group('text')] if speech.group('text') else []
+            return rows
+        if self.stagedir is not None and indent == 0:
+            self.stagedir.append(stripped)
+        elif self.speaker is not None:
+            if self.speech is None:
+                # the speech goes on after a stage direction
+                rows.extend(self._flush())
+                self.speech = []
+            self.speech.append(stripped)
+        else:
+            rows.extend(self._flush())
+            self.stagedir = [stripped]
+        return rows
+
+    def close(self) -> List[Row]:
+        return self._flush()
+
+
+def iter_play_rows(lines: Iterable[Text], title: Text) -> Iterator[Row]:
+    """playparser rows of a cleaned Gutenberg play, in one pass over lines.
+    Nothing is yielded for a text without any acts (e.g. the sonnets).
+    """
+    parser = PlainPlayParser(title)
+    for line in lines:
+        yield from parser.feed_line(line)
+    yield from parser.close()
+
+
+def _decode(line: bytes) -> Text:
+    # the older etexts are latin-1, the newer utf-8
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        return line.decode('latin-1')
+
+
+def load_works(conn, cache, works: Iterable[List[Text]],
+               incremental: bool = True) -> syncshake.BulkLoader:
+    """Parse the plain copies (see DownloadHandler.clean_gutenberg) of works,
+    [title, url, comment] as get_relevant_works lists them, into the syncshake
+    tables, streaming each text once. A work already stored from its url is
+    replaced, or with incremental, skipped if its plain copy is unchanged.
+    """
+    syncshake.create_tables(conn)
+    sources = syncshake.get_sources(conn)
+    loader = syncshake.BulkLoader(conn)
+    with syncshake.bulk_load(conn):
+        for title, url, comment in works:
+            entry = cache.manifest.get(cache.key(url, PLAIN))
+            if entry is None or not cache.exists(url, PLAIN):
+                print('No plain copy of %s, run clean_gutenberg first' % url)
+                continue
+            stored = sources.get(url, {})
+            if incremental and stored.get('content_hash') == entry['sha256']:
+                print('Unchanged: %s' % title)
+                continue
+            source = {'play_id': stored.get('play_id'), 'url': url,
+                      'content_hash': entry['sha256'], 'size': entry['size'],
+                      'etag': None, 'last_modified': None}
+            with cache.open(url, version=PLAIN) as f:
+                rows = iter_play_rows(map(_decode, f), title)
+                first = next(rows, None)
+                if first is None:
+                    print('No acts in %s, not a play' % title)
+                    continue
+                loader.load(itertools.chain([first], rows), source, EDITIONS.get(comment, comment))
+    print(loader.report())
+    return loader
+
+
+def unpaired_folios(works: Iterable[List[Text]]) -> List[Text]:
+    """The titles of the folio works (as get_relevant_works lists them)
+    whose title_key matches no MOBY_INDEX title, so that
+    alignment.edition_pairs would have no standard edition for them.
+    """
+    keys = {alignment.title_key(title) for title, url in syncshake.MOBY_INDEX}
+    return [title for title, url, comment in works
+            if comment == 'folio' and alignment.title_key(title) not in keys]
+
+
+if __name__ == '__main__':
+    import sqlite3
+    from MySqlShakespeare import DownloadHandler
+    handler = DownloadHandler(verbose=True)
+    for title in unpaired_folios(handler._index):
+        print('Warning: the folio %r (key %r) matches no MOBY_INDEX title'
+              % (title, alignment.title_key(title)))
+    handler.clean_gutenberg()
+    load_works(sqlite3.connect(syncshake.DBFILE), handler.cache, handler._index)
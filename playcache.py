@@ -0,0 +1,135 @@
+# coding: utf-8
+
+"""
+Second cache tier holding already parsed plays.
+
+Entries are the play dicts built by handle_play/playparser.build_play,
+pickled and keyed by the sha256 of the source XML bytes together with the
+parser version, so a rebuild of the SQLite or MySQL database can skip XML
+parsing altogether for every play whose source has not changed.
+
+    cache = ParsedPlayCache()
+    play = cache.get_or_parse(play_text, playparser.parse_play)
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Callable, Dict, List, Optional, Text, Tuple
+
+import playparser
+
+PLAY_CACHE = "./playcache"
+MAX_BYTES = 64 * 2**20
+
+
+class CacheStats():
+
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+        self.writes: int = 0
+        self.evictions: int = 0
+        self.bytes_written: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def report(self) -> Text:
+        return ('parsed play cache: %d hits, %d misses (%.0f%% hit), %d writes, '
+                '%.1f KiB written, %d evictions'
+                % (self.hits, self.misses, 100 * self.hit_ratio, self.writes,
+                   self.bytes_written / 1024, self.evictions))
+
+
+class ParsedPlayCache():
+    ''' Content addressed on-disk cache of parsed plays.
+        @max_bytes: total size of the entries; the least recently used are
+            evicted beyond it (a hit refreshes an entry's mtime)
+    '''
+
+    def __init__(self, root: Text = PLAY_CACHE, max_bytes: int = MAX_BYTES) -> None:
+        self.root: Text = root
+        self.max_bytes: int = max_bytes
+        self.stats: CacheStats = CacheStats()
+        self._size: Optional[int] = None
+
+    def key(self, play_text: bytes) -> Text:
+        digest = hashlib.sha256(b'parser-%d\0' % playparser.PARSER_VERSION)
+        digest.update(play_text)
+        return digest.hexdigest()
+
+    def path(self, key: Text) -> Text:
+        return os.path.join(self.root, key[:2], key + '.pickle')
+
+    def get(self, play_text: bytes) -> Optional[Dict]:
+        path = self.path(self.key(play_text))
+        try:
+            with open(path, 'rb') as f:
+                play = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.stats.misses += 1
+            return None
+        os.utime(path)
+        self.stats.hits += 1
+        return play
+
+    def put(self, play_text: bytes, play: Dict) -> None:
+        path = self.path(self.key(play_text))
+        size = self.size()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = pickle.dumps(play, pickle.HIGHEST_PROTOCOL)
+        # write then rename so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp, path)
+        self.stats.writes += 1
+        self.stats.bytes_written += len(data)
+        self._size = size + len(data) - replaced
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def get_or_parse(self, play_text: bytes, parse: Callable[[bytes], Dict]) -> Dict:
+        play = self.get(play_text)
+        if play is None:
+            play = parse(play_text)
+            self.put(play_text, play)
+        return play
+
+    def _entries(self) -> List[Tuple[float, int, Text]]:
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.pickle'):
+                    st = os.stat(os.path.join(dirpath, name))
+                    entries.append((st.st_mtime, st.st_size, os.path.join(dirpath, name)))
+        return entries
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = sum(entry[1] for entry in self._entries())
+        return self._size
+
+    def evict(self, max_bytes: int = None) -> int:
+        """Remove least recently used entries until the cache fits max_bytes."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        evicted = 0
+        for mtime, entry_size, path in entries:
+            if size <= max_bytes:
+                break
+            os.remove(path)
+            size -= entry_size
+            evicted += 1
+        self._size = size
+        self.stats.evictions += evicted
+        return evicted
+
+    def clear(self) -> int:
+        return self.evict(0)
@@ -0,0 +1,237 @@
+# coding: utf-8
+
+"""
+Streaming parser for the Moby/Bosak xml-i-fied plays.
+
+Instead of building a full minidom tree and walking it with the handle_*
+functions, the bytes are fed through an incremental expat parser and rows
+are yielded as soon as each element closes:
+
+    ('play', title, subtitle, scene_description)
+    ('persona_group', group_name)
+    ('persona', group_name, text)     group_name is '' outside a PGROUP
+    ('act', title)
+    ('scene', title)
+    ('stagedir', text)
+    ('speech', speaker, [lines])      speaker is None if the speech has none
+
+build_play turns the rows back into exactly the dict that handle_play (and
+the handle_act/handle_scene/handle_speech functions) produce today.
+"""
+import io
+import time
+import tracemalloc
+import xml.dom.minidom
+import xml.etree.ElementTree
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Text, Tuple
+
+PARSER_VERSION = 1
+CHUNK_SIZE = 64 * 1024
+
+Row = Tuple[Any, ...]
+
+
+def _get_text(element) -> Text:
+    # same as the minidom _get_text: only the element's own text nodes
+    rc: List[Text] = [element.text or '']
+    for child in element:
+        rc.append(child.tail or '')
+    return ''.join(rc)
+
+
+class PlayStreamParser():
+    ''' Incremental play parser. Feed it bytes as they arrive and collect
+        the rows that each chunk completes.
+    '''
+
+    def __init__(self) -> None:
+        self.parser = xml.etree.ElementTree.XMLPullParser(events=('start', 'end'))
+        self.stack: List[Any] = []
+        self.tags: List[Text] = []
+        self.header: Dict[Text, Text] = {}
+        self.personae: List[Row] = []
+        self.header_sent: bool = False
+        self.act_title: Optional[Text] = None
+        self.scene_title: Optional[Text] = None
+        self.group: List[Text] = []
+        self.group_name: Optional[Text] = None
+
+    def feed(self, data: bytes) -> List[Row]:
+        self.parser.feed(data)
+        return self._rows()
+
+    def close(self) -> List[Row]:
+        self.parser.close()
+        rows = self._rows()
+        if not self.header_sent:
+            rows.extend(self._send_header())
+        return rows
+
+    def _send_header(self) -> List[Row]:
+        self.header_sent = True
+        rows: List[Row] = [('play', self.header.get('TITLE'), self.header.get('PLAYSUBT'),
+                            self.header.get('SCNDESCR'))]
+        rows.extend(self.personae)
+        self.personae = []
+        return rows
+
+    def _rows(self) -> List[Row]:
+        rows: List[Row] = []
+        stack, tags = self.stack, self.tags
+        for event, element in self.parser.read_events():
+            tag = element.tag
+            if event == 'start':
+                if tag == 'ACT':
+                    if not self.header_sent:
+                        rows.extend(self._send_header())
+                    self.act_title = None
+                elif tag == 'SCENE':
+                    self.scene_title = None
+                stack.append(element)
+                tags.append(tag)
+                continue
+            stack.pop()
+            tags.pop()
+            parent = tags[-1] if tags else None
+            if tag in ('TITLE', 'PLAYSUBT', 'SCNDESCR') and tag not in self.header:
+                # the first of each in the document belongs to the play
+                self.header[tag] = _get_text(element)
+            if 'ACT' in tags:
+                if tag == 'TITLE':
+                    if self.act_title is None:
+                        self.act_title = _get_text(element)
+                        rows.append(('act', self.act_title))
+                    elif 'SCENE' in tags and self.scene_title is None:
+                        self.scene_title = _get_text(element)
+                        rows.append(('scene', self.scene_title))
+                elif parent == 'SCENE':
+                    if tag == 'STAGEDIR':
+                        rows.append(('stagedir', _get_text(element)))
+                    else:
+                        speaker = None
+                        lines: List[Text] = []
+                        for child in element:
+                            if child.tag == 'SPEAKER':
+                                speaker = _get_text(child)
+                            else:
+                                lines.append(_get_text(child))
+                        rows.append(('speech', speaker, lines))
+            elif parent == 'PERSONAE':
+                if tag == 'PERSONA':
+                    self.personae.append(('persona', '', _get_text(element)))
+                elif tag != 'TITLE':
+                    self.personae.append(('persona_group', self.group_name))
+                    self.personae.extend(('persona', self.group_name, person)
+                                         for person in self.group)
+                    self.group = []
+                    self.group_name = None
+            elif len(tags) > 1 and tags[-2] == 'PERSONAE':
+                if tag == 'GRPDESCR':
+                    self.group_name = _get_text(element)
+                else:
+                    self.group.append(_get_text(element))
+            if parent in ('PLAY', 'ACT', 'SCENE'):
+                # the element is finished with, so drop it from the tree
+                del stack[-1][-1]
+        return rows
+
+
+def iter_play_rows(source: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[Row]:
+    """Yield play rows while reading a binary file object in chunks."""
+    parser = PlayStreamParser()
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            break
+        yield from parser.feed(data)
+    yield from parser.close()
+
+
+def build_play(rows: Iterable[Row]) -> Dict:
+    """Assemble rows into the same dict that handle_play builds from a DOM."""
+    result: Dict = {}
+    result['personae'] = {'persona': [], 'persona_group': []}
+    result['acts'] = []
+    for row in rows:
+        kind = row[0]
+        if kind == 'play':
+            result['title'], result['subtitle'], result['scene_description'] = row[1:]
+        elif kind == 'persona':
+            result['personae']['persona'].append((row[1], row[2]))
+        elif kind == 'persona_group':
+            result['personae']['persona_group'].append(row[1])
+        elif kind == 'act':
+            result['acts'].append({'title': row[1], 'scenes': []})
+        elif kind == 'scene':
+            result['acts'][-1]['scenes'].append({'title': row[1], 'content': []})
+        elif kind == 'stagedir':
+            result['acts'][-1]['scenes'][-1]['content'].append((0, row[1]))
+        else:
+            speech: Dict = {'lines': row[2]}
+            if row[1] is not None:
+                speech['speaker'] = row[1]
+            result['acts'][-1]['scenes'][-1]['content'].append((1, speech))
+    return result
+
+
+def play_rows(play: Dict) -> Iterator[Row]:
+    """The inverse of build_play: rows for an already built play dict."""
+    yield ('play', play['title'], play['subtitle'], play['scene_description'])
+    for group_name in play['personae']['persona_group']:
+        yield ('persona_group', group_name)
+    for group_name, person in play['personae']['persona']:
+        yield ('persona', group_name, person)
+    for act in play['acts']:
+        yield ('act', act['title'])
+        for scene in act['scenes']:
+            yield ('scene', scene['title'])
+            for content in scene['content']:
+                if content[0] == 0:
+                    yield ('stagedir', content[1])
+                else:
+                    yield ('speech', content[1].get('speaker'), content[1]['lines'])
+
+
+def parse_play(play_text: bytes) -> Dict:
+    """Streaming replacement for minidom.parseString + handle_play."""
+    return build_play(iter_play_rows(io.BytesIO(play_text)))
+
+
+def parse_play_dom(play_text: bytes) -> Dict:
+    """The original minidom path, kept for comparison and benchmarking."""
+    import syncshake
+    return syncshake.handle_play(xml.dom.minidom.parseString(play_text))
+
+
+def _measure(parse, play_text: bytes) -> Tuple[float, int, Dict]:
+    tracemalloc.start()
+    t = time.perf_counter()
+    result = parse(play_text)
+    elapsed = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def benchmark(paths: List[Text]) -> List[Dict]:
+    """Compare time and peak memory of the minidom and streaming parsers per play."""
+    results = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            play_text = f.read()
+        dom_time, dom_peak, dom_play = _measure(parse_play_dom, play_text)
+        stream_time, stream_peak, stream_play = _measure(parse_play, play_text)
+        results.append({'path': path, 'bytes': len(play_text),
+                        'dom_time': dom_time, 'dom_peak': dom_peak,
+                        'stream_time': stream_time, 'stream_peak': stream_peak,
+                        'identical': dom_play == stream_play})
+        print('%-40s %8d bytes  dom %.3fs %6.1f MiB  stream %.3fs %6.1f MiB  %s'
+              % (path, len(play_text), dom_time, dom_peak / 2**20,
+                 stream_time, stream_peak / 2**20,
+                 'identical' if dom_play == stream_play else 'DIFFERENT'))
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(sys.argv[1:])
@@ -0,0 +1,251 @@
+# coding: utf-8
+
+"""
+Sparse term-document matrices of the corpus and TF-IDF similarity search.
+
+The spoken lines of a SQLite corpus are tokenized once (textindex.tokenize)
+into a lines x terms count matrix; speeches (consecutive lines of one
+speaker in one scene, as in textindex.PositionalIndex) and scenes are sums
+of lines, built by multiplying with a sparse grouping matrix. Each level is
+weighted by sublinear TF-IDF and L2 normalised, so cosine similarity is a
+sparse matrix product and the top k a vectorised argpartition.
+
+    td = TermDocument.from_db(sqlite3.connect(syncshake.DBFILE))
+    td.save('./termdoc')
+    index = SimilarityIndex(TermDocument.load('./termdoc'))
+    index.similar('line', [1234, 5678], k=5)
+    index.similar('scene', [12])
+"""
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Text, Tuple
+
+import numpy
+import scipy.sparse
+
+from textindex import EDITION_IS, MOBY_EDITION, tokenize
+
+LEVELS = ('line', 'speech', 'scene')
+
+
+def _group(keys: numpy.ndarray) -> Tuple[numpy.ndarray, scipy.sparse.csr_matrix]:
+    """The distinct keys in order of first appearance and the groups x lines
+    matrix that sums the lines of each.
+    """
+    unique, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    # renumber the groups in corpus order rather than key order
+    order = numpy.argsort(first)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    rows = rank[inverse.ravel()]
+    grouping = scipy.sparse.csr_matrix(
+        (numpy.ones(len(keys), dtype=numpy.float32), (rows, numpy.arange(len(keys)))),
+        shape=(len(unique), len(keys)))
+    return unique[order], grouping
+
+
+class TermDocument():
+    ''' Term count matrices of the spoken lines, speeches and scenes.
+        @ids: per level, the id of each row: actor_lines.id, speech number
+            or scenes.id
+        @line_groups: per line, its speech and scene row
+    '''
+
+    def __init__(self, vocabulary: List[Text], counts: Dict[Text, scipy.sparse.csr_matrix],
+                 ids: Dict[Text, numpy.ndarray], line_groups: Dict[Text, numpy.ndarray]) -> None:
+        self.vocabulary: List[Text] = vocabulary
+        self.terms: Dict[Text, int] = {word: i for i, word in enumerate(vocabulary)}
+        self.counts: Dict[Text, scipy.sparse.csr_matrix] = counts
+        self.ids: Dict[Text, numpy.ndarray] = ids
+        self.line_groups: Dict[Text, numpy.ndarray] = line_groups
+
+    @classmethod
+    def from_db(cls, conn, edition: Optional[Text] = MOBY_EDITION) -> 'TermDocument':
+        terms: Dict[Text, int] = {}
+        line_ids: List[int] = []
+        scene_ids: List[int] = []
+        speeches: List[int] = []
+        indices: List[int] = []
+        indptr: List[int] = [0]
+        speech = -1
+        previous = None
+        cursor = conn.execute('''SELECT actor_lines.id, scene_id, speaker, is_stagedir, the_text
+                                 FROM actor_lines JOIN plays ON plays.id = actor_lines.play_id
+                                 WHERE %s ORDER BY actor_lines.id''' % EDITION_IS, (edition,))
+        for line_id, scene_id, speaker, is_stagedir, text in cursor:
+            if is_stagedir:
+                previous = None
+                continue
+            if previous != (scene_id, speaker):
+                previous = (scene_id, speaker)
+                speech += 1
+            line_ids.append(line_id)
+            scene_ids.append(scene_id)
+            speeches.append(speech)
+            indices.extend(terms.setdefault(word, len(terms)) for word in tokenize(text))
+            indptr.append(len(indices))
+        vocabulary = list(terms)
+        lines = scipy.sparse.csr_matrix(
+            (numpy.ones(len(indices), dtype=numpy.float32), numpy.array(indices, dtype=numpy.int32),
+             numpy.array(indptr, dtype=numpy.int64)), shape=(len(line_ids), len(vocabulary)))
+        lines.sum_duplicates()
+        speech_ids, speech_grouping = _group(numpy.array(speeches))
+        scene_keys, scene_grouping = _group(numpy.array(scene_ids))
+        counts = {'line': lines,
+                  'speech': (speech_grouping @ lines).tocsr(),
+                  'scene': (scene_grouping @ lines).tocsr()}
+        ids = {'line': numpy.array(line_ids), 'speech': speech_ids, 'scene': scene_keys}
+        line_groups = {'speech': speech_grouping.tocsc().indices,
+                       'scene': scene_grouping.tocsc().indices}
+        return cls(vocabulary, counts, ids, line_groups)
+
+    def save(self, directory: Text) -> None:
+        """Write the matrices as compressed .npz files into directory."""
+        os.makedirs(directory, exist_ok=True)
+        for level, matrix in self.counts.items():
+            scipy.sparse.save_npz(os.path.join(directory, level + '.npz'), matrix)
+        numpy.savez_compressed(os.path.join(directory, 'index.npz'),
+                               vocabulary=numpy.array(self.vocabulary),
+                               **{'ids_' + level: ids for level, ids in self.ids.items()},
+                               **{'group_' + level: group
+                                  for level, group in self.line_groups.items()})
+
+    @classmethod
+    def load(cls, directory: Text) -> 'TermDocument':
+        counts = {level: scipy.sparse.load_npz(os.path.join(directory, level + '.npz')).tocsr()
+                  for level in LEVELS}
+        with numpy.load(os.path.join(directory, 'index.npz')) as index:
+            vocabulary = index['vocabulary'].tolist()
+            ids = {level: index['ids_' + level] for level in LEVELS}
+            line_groups = {level: index['group_' + level] for level in ('speech', 'scene')}
+        return cls(vocabulary, counts, ids, line_groups)
+
+    def nbytes(self) -> Dict[Text, int]:
+        """Memory held by each matrix."""
+        return {level: matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+                for level, matrix in self.counts.items()}
+
+
+def _normalise(matrix: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return scipy.sparse.diags(1 / norms) @ matrix
+
+
+class SimilarityIndex():
+    ''' TF-IDF weighted, L2 normalised rows of a TermDocument, one matrix
+        per level, and cosine top k queries over them. Every query is a
+        batch: one sparse product of the query rows with the whole level.
+    '''
+
+    def __init__(self, td: TermDocument) -> None:
+        self.td: TermDocument = td
+        self.idf: Dict[Text, numpy.ndarray] = {}
+        self.weights: Dict[Text, scipy.sparse.csr_matrix] = {}
+        self.rows: Dict[Text, Dict[int, int]] = {}
+        for level, counts in td.counts.items():
+            documents = counts.shape[0]
+            df = numpy.bincount(counts.indices, minlength=counts.shape[1])
+            self.idf[level] = (numpy.log((1 + documents) / (1 + df)) + 1).astype(numpy.float32)
+            self.weights[level] = _normalise(self._tfidf(level, counts))
+            self.rows[level] = {int(id_): row for row, id_ in enumerate(td.ids[level])}
+
+    def _tfidf(self, level: Text, counts: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+        weighted = counts.astype(numpy.float32, copy=True)
+        weighted.data = 1 + numpy.log(weighted.data)
+        return weighted.multiply(self.idf[level]).tocsr()
+
+    def vectorize(self, texts: Sequence[Text], level: Text = 'line') -> scipy.sparse.csr_matrix:
+        """TF-IDF rows for free texts; words not in the corpus are ignored."""
+        terms = self.td.terms
+        indices: List[int] = []
+        indptr: List[int] = [0]
+        for text in texts:
+            indices.extend(terms[word] for word in tokenize(text) if word in terms)
+            indptr.append(len(indices))
+        counts = scipy.sparse.csr_matrix(
+            (numpy.ones(len(indices), dtype=numpy.float32), indices, indptr),
+            shape=(len(texts), len(terms)))
+        counts.sum_duplicates()
+        return _normalise(self._tfidf(level, counts))
+
+    def top_k(self, level: Text, queries: scipy.sparse.csr_matrix, k: int = 10,
+              exclude: numpy.ndarray = None) -> List[List[Tuple[int, float]]]:
+        """The k most similar rows of level for each query row, as (id, cosine).
+        @exclude: per query, a row of level to leave out (e.g. the query itself)
+        """
+        scores = (queries @ self.weights[level].T).toarray()
+        if exclude is not None:
+            scores[numpy.arange(len(exclude)), exclude] = -1
+        k = min(k, scores.shape[1])
+        top = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = numpy.take_along_axis(scores, top, axis=1)
+        order = numpy.argsort(-top_scores, axis=1)
+        top = numpy.take_along_axis(top, order, axis=1)
+        top_scores = numpy.take_along_axis(top_scores, order, axis=1)
+        ids = self.td.ids[level][top]
+        return [[(int(id_), float(score)) for id_, score in zip(row_ids, row_scores) if score > 0]
+                for row_ids, row_scores in zip(ids, top_scores)]
+
+    def similar(self, level: Text, ids: Sequence[int], k: int = 10) -> List[List[Tuple[int, float]]]:
+        """For each of the given lines (actor_lines ids), speeches or scenes
+        (scenes ids), the k others most like it.
+        """
+        rows = numpy.array([self.rows[level][id_] for id_ in ids])
+        return self.top_k(level, self.weights[level][rows], k, exclude=rows)
+
+    def similar_to_text(self, level: Text, texts: Sequence[Text],
+                        k: int = 10) -> List[List[Tuple[int, float]]]:
+        """For each text, the k lines, speeches or scenes most like it."""
+        return self.top_k(level, self.vectorize(texts, level), k)
+
+
+def benchmark(conn, directory: Text = None, queries: int = 100, k: int = 10) -> Dict:
+    """Time building (and saving/loading) the matrices and batched and
+    single queries at each level.
+    """
+    results: Dict = {}
+    t = time.perf_counter()
+    td = TermDocument.from_db(conn)
+    results['build'] = time.perf_counter() - t
+    if directory:
+        t = time.perf_counter()
+        td.save(directory)
+        results['save'] = time.perf_counter() - t
+        t = time.perf_counter()
+        td = TermDocument.load(directory)
+        results['load'] = time.perf_counter() - t
+    t = time.perf_counter()
+    index = SimilarityIndex(td)
+    results['weights'] = time.perf_counter() - t
+    results['nbytes'] = td.nbytes()
+    print('built %d terms in %.2fs, tf-idf in %.2fs%s'
+          % (len(td.vocabulary), results['build'], results['weights'],
+             ', save %.2fs, load %.2fs' % (results['save'], results['load'])
+             if directory else ''))
+    rng = numpy.random.default_rng(0)
+    for level in LEVELS:
+        shape = td.counts[level].shape
+        ids = rng.choice(td.ids[level], min(queries, shape[0]), replace=False)
+        t = time.perf_counter()
+        index.similar(level, ids, k)
+        batch = time.perf_counter() - t
+        t = time.perf_counter()
+        index.similar(level, ids[:1], k)
+        single = time.perf_counter() - t
+        results[level] = {'rows': shape[0], 'nnz': td.counts[level].nnz,
+                          'nbytes': results['nbytes'][level],
+                          'batch': batch, 'per_query': batch / len(ids), 'single': single}
+        print('%-6s %7d x %6d  nnz %8d  %7.1f MiB  %d queries %8.1fms (%.2fms each)  '
+              'single %.1fms'
+              % (level, shape[0], shape[1], td.counts[level].nnz,
+                 results['nbytes'][level] / 2**20, len(ids), batch * 1000,
+                 batch / len(ids) * 1000, single * 1000))
+    return results
+
+
+if __name__ == '__main__':
+    import sqlite3
+    import sys
+    benchmark(sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else './syncshakedb.sqlite'),
+              sys.argv[2] if len(sys.argv) > 2 else None)
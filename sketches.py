@@ -0,0 +1,567 @@
+# coding: utf-8
+
+"""
+N-gram and collocation statistics in bounded memory.
+
+Exact Counters of every bigram and trigram grow with the corpus; here each
+n-gram order gets three fixed size sketches instead:
+
+    CountMinSketch  frequency of any n-gram, overestimated by at most
+                    epsilon * N with probability 1 - delta
+    SpaceSaving     the top k heavy hitters, each count overestimated by at
+                    most N / k
+    HyperLogLog     number of distinct n-grams, to about 1.04 / sqrt(m)
+
+N-grams are hashed with blake2b so every process hashes alike, and all
+three sketches merge: a corpus can be split across worker processes (by
+play, or by byte range of the countwords dump) and the results added up.
+
+    stats = NgramStats(memory=16 * 2**20)
+    stats.update(db_lines(sqlite3.connect(syncshake.DBFILE)))
+    stats.heavy_hitters(2, 20)
+    stats.collocations(20, min_count=50)
+    stats.error_bounds()
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import math
+import operator
+import os
+import re
+import sqlite3
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Text, Tuple
+
+import numpy
+
+import countwords
+import textindex
+from textindex import tokenize
+
+# lines tokenized between sketch updates; the batch Counters are exact, so
+# this also bounds the memory they take
+BATCH_LINES = 20000
+# a batch is tokenized as one text with LINE_END between the lines, so its
+# n-grams can be taken in one go and those that span a line end dropped
+LINE_END = '\n'
+TOKEN = re.compile(textindex.WORD.pattern + '|' + LINE_END)
+# rough size of one SpaceSaving entry (key string, two dict slots, two ints)
+ENTRY_BYTES = 200
+
+
+def hash64(item: Text) -> int:
+    """Stable 64 bit hash; hash() is salted per process and would not merge."""
+    return int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def hash_array(items: Iterable[Text]) -> numpy.ndarray:
+    blake2b = hashlib.blake2b
+    digests = b''.join([blake2b(item.encode('utf-8'), digest_size=8).digest() for item in items])
+    return numpy.frombuffer(digests, dtype='<u8').astype(numpy.uint64)
+
+
+def ngram_counts(lines: Sequence[Text], orders: Sequence[int]) -> Dict[int, collections.Counter]:
+    """Exact counts of the n-grams of each order in lines, as tokenize splits
+    them; n-grams do not cross line ends.
+    """
+    tokens = TOKEN.findall(LINE_END.join(text.replace(LINE_END, ' ') for text in lines).lower())
+    counts = {}
+    for n in orders:
+        if n == 1:
+            counter = collections.Counter(tokens)
+            counter.pop(LINE_END, None)
+        else:
+            counter = collections.Counter(map(' '.join, zip(*(tokens[i:] for i in range(n)))))
+            for ngram in [ngram for ngram in counter if LINE_END in ngram]:
+                del counter[ngram]
+        counts[n] = counter
+    return counts
+
+
+def _bit_length(values: numpy.ndarray) -> numpy.ndarray:
+    """bit_length of each uint64, exactly (float64 only holds 53 bits)."""
+    high = (values >> numpy.uint64(32)).astype(numpy.float64)
+    low = (values & numpy.uint64(0xffffffff)).astype(numpy.float64)
+    return numpy.where(high > 0, 32 + numpy.frexp(high)[1], numpy.frexp(low)[1])
+
+
+class CountMinSketch():
+    ''' depth x width counters; an item adds its count to one counter per
+        row and its estimate is the smallest of them. Estimates are never
+        low and exceed the true count by at most epsilon * total with
+        probability 1 - delta, where epsilon = e / width and
+        delta = exp(-depth).
+    '''
+
+    def __init__(self, width: int, depth: int = 4) -> None:
+        self.width: int = width
+        self.depth: int = depth
+        self.table: numpy.ndarray = numpy.zeros((depth, width), dtype=numpy.int64)
+        self.total: int = 0
+
+    @classmethod
+    def from_error(cls, epsilon: float, delta: float) -> 'CountMinSketch':
+        return cls(math.ceil(math.e / epsilon), math.ceil(math.log(1 / delta)))
+
+    @classmethod
+    def from_bytes(cls, nbytes: int, depth: int = 4) -> 'CountMinSketch':
+        return cls(max(nbytes // (8 * depth), 1), depth)
+
+    @property
+    def epsilon(self) -> float:
+        return math.e / self.width
+
+    @property
+    def delta(self) -> float:
+        return math.exp(-self.depth)
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes
+
+    def _columns(self, hashes: numpy.ndarray) -> numpy.ndarray:
+        # double hashing: row i uses h1 + i * h2
+        h1 = hashes & numpy.uint64(0xffffffff)
+        h2 = (hashes >> numpy.uint64(32)) | numpy.uint64(1)
+        rows = numpy.arange(self.depth, dtype=numpy.uint64)[:, None]
+        return ((h1[None, :] + rows * h2[None, :]) % numpy.uint64(self.width)).astype(numpy.intp)
+
+    def add_hashes(self, hashes: numpy.ndarray, counts: numpy.ndarray) -> None:
+        for row, columns in zip(self.table, self._columns(hashes)):
+            row += numpy.bincount(columns, weights=counts, minlength=self.width).astype(numpy.int64)
+        self.total += int(counts.sum())
+
+    def estimate_hashes(self, hashes: numpy.ndarray) -> numpy.ndarray:
+        columns = self._columns(hashes)
+        return self.table[numpy.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def estimate(self, item: Text) -> int:
+        return int(self.estimate_hashes(hash_array([item]))[0])
+
+    def error(self) -> float:
+        """The additive error bound, epsilon * total."""
+        return self.epsilon * self.total
+
+    def merge(self, other: 'CountMinSketch') -> None:
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('cannot merge count-min sketches of different shapes')
+        self.table += other.table
+        self.total += other.total
+
+
+class SpaceSaving():
+    ''' The k items with the highest counts, each with a count that is never
+        low and an error that bounds how high it may be (true count is in
+        [count - error, count]); no error exceeds total / k.
+
+        Updates are merged in as exact summaries of a batch, using the merge
+        of two summaries: an item missing from a full summary is assumed to
+        have that summary's smallest count.
+    '''
+
+    def __init__(self, k: int) -> None:
+        self.k: int = k
+        self.counts: Dict[Text, int] = {}
+        self.errors: Dict[Text, int] = {}
+        self.total: int = 0
+
+    def _floor(self) -> int:
+        return min(self.counts.values()) if len(self.counts) >= self.k else 0
+
+    def _merge(self, counts: Dict[Text, int], errors: Dict[Text, int], floor: int,
+               total: int) -> None:
+        own_floor = self._floor()
+        merged = {}
+        for item in self.counts.keys() | counts.keys():
+            merged[item] = (self.counts.get(item, own_floor) + counts.get(item, floor),
+                            self.errors.get(item, own_floor) + errors.get(item, floor))
+        kept = heapq.nlargest(self.k, merged.items(), key=lambda entry: entry[1][0])
+        self.counts = {item: count for item, (count, error) in kept}
+        self.errors = {item: error for item, (count, error) in kept}
+        self.total += total
+
+    def update(self, counter: Dict[Text, int]) -> None:
+        """Add exact counts, e.g. a batch Counter."""
+        # an item new to the summary can only be kept if it is among the k
+        # largest of the batch, so the rest need not be merged at all
+        counts = dict(heapq.nlargest(self.k, counter.items(), key=operator.itemgetter(1)))
+        counts.update((item, counter[item]) for item in self.counts if item in counter)
+        self._merge(counts, {}, 0, sum(counter.values()))
+
+    def merge(self, other: 'SpaceSaving') -> None:
+        if self.k != other.k:
+            raise ValueError('cannot merge space-saving summaries of different k')
+        self._merge(other.counts, other.errors, other._floor(), other.total)
+
+    def top(self, n: int = None) -> List[Tuple[Text, int, int]]:
+        """(item, count, error), highest count first."""
+        items = sorted(self.counts, key=lambda item: (-self.counts[item], item))[:n]
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+    def error(self) -> float:
+        return self.total / self.k
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.counts) * ENTRY_BYTES
+
+
+class HyperLogLog():
+    ''' 2**precision one byte registers; each keeps the longest run of
+        leading zeros seen among the hashes routed to it.
+    '''
+
+    def __init__(self, precision: int = 14) -> None:
+        self.precision: int = precision
+        self.m: int = 1 << precision
+        self.registers: numpy.ndarray = numpy.zeros(self.m, dtype=numpy.uint8)
+
+    @property
+    def nbytes(self) -> int:
+        return self.registers.nbytes
+
+    def add_hashes(self, hashes: numpy.ndarray) -> None:
+        rest = 64 - self.precision
+        index = (hashes >> numpy.uint64(rest)).astype(numpy.intp)
+        tail = hashes & numpy.uint64((1 << rest) - 1)
+        rank = (rest + 1 - _bit_length(tail)).astype(numpy.uint8)
+        numpy.maximum.at(self.registers, index, rank)
+
+    def estimate(self) -> float:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / numpy.sum(numpy.ldexp(1.0, -self.registers.astype(numpy.int64)))
+        zeros = int(numpy.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            return m * math.log(m / zeros)
+        return float(estimate)
+
+    def error(self) -> float:
+        """Relative standard error of estimate()."""
+        return 1.04 / math.sqrt(self.m)
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        if self.precision != other.precision:
+            raise ValueError('cannot merge HyperLogLogs of different precision')
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+
+class NgramStats():
+    ''' Count-min, space-saving and HyperLogLog sketches for each n-gram
+        order, fed with lines of text. N-grams do not cross line ends.
+        @memory: bytes to spend on the sketches of all orders together; what
+            the HyperLogLogs and top k lists do not take goes to the
+            count-min tables
+    '''
+
+    def __init__(self, orders: Sequence[int] = (1, 2, 3), memory: int = 16 * 2**20,
+                 k: int = 1000, depth: int = 4, precision: int = 14) -> None:
+        self.orders: Tuple[int, ...] = tuple(orders)
+        self.memory: int = memory
+        per_order = memory // len(self.orders)
+        cms_bytes = per_order - (1 << precision) - k * ENTRY_BYTES
+        if cms_bytes < 8 * depth:
+            raise ValueError('%d bytes is too little memory for %d orders with k=%d'
+                             % (memory, len(self.orders), k))
+        self.cms: Dict[int, CountMinSketch] = {
+            n: CountMinSketch.from_bytes(cms_bytes, depth) for n in self.orders}
+        self.top: Dict[int, SpaceSaving] = {n: SpaceSaving(k) for n in self.orders}
+        self.distinct: Dict[int, HyperLogLog] = {n: HyperLogLog(precision) for n in self.orders}
+        self.lines: int = 0
+        self._batch: List[Text] = []
+
+    def add(self, text: Text) -> None:
+        """Count the n-grams of one line."""
+        self._batch.append(text)
+        self.lines += 1
+        if len(self._batch) >= BATCH_LINES:
+            self.flush()
+
+    def update(self, lines: Iterable[Text]) -> 'NgramStats':
+        for text in lines:
+            self.add(text)
+        self.flush()
+        return self
+
+    def flush(self) -> None:
+        """Count the pending lines exactly and fold the counts into the sketches."""
+        if not self._batch:
+            return
+        for n, batch in ngram_counts(self._batch, self.orders).items():
+            if not batch:
+                continue
+            hashes = hash_array(batch.keys())
+            counts = numpy.fromiter(batch.values(), dtype=numpy.float64, count=len(batch))
+            self.cms[n].add_hashes(hashes, counts)
+            self.distinct[n].add_hashes(hashes)
+            self.top[n].update(batch)
+        self._batch = []
+
+    def merge(self, other: 'NgramStats') -> 'NgramStats':
+        if self.orders != other.orders:
+            raise ValueError('cannot merge statistics of different n-gram orders')
+        self.flush()
+        other.flush()
+        for n in self.orders:
+            self.cms[n].merge(other.cms[n])
+            self.top[n].merge(other.top[n])
+            self.distinct[n].merge(other.distinct[n])
+        self.lines += other.lines
+        return self
+
+    def __getstate__(self):
+        self.flush()
+        return self.__dict__
+
+    def total(self, n: int) -> int:
+        """Number of n-grams counted (not distinct)."""
+        return self.cms[n].total
+
+    def count(self, ngram: Text) -> Tuple[int, float]:
+        """(estimate, lower bound) of how often ngram occurs; the true count
+        is in between with probability 1 - delta.
+        """
+        words = tokenize(ngram)
+        cms = self.cms[len(words)]
+        estimate = cms.estimate(' '.join(words))
+        return estimate, max(estimate - cms.error(), 0)
+
+    def distinct_count(self, n: int) -> float:
+        return self.distinct[n].estimate()
+
+    def heavy_hitters(self, n: int, top: int = 20) -> List[Tuple[Text, int, int]]:
+        """(ngram, count, error) of the most frequent n-grams."""
+        return self.top[n].top(top)
+
+    def pmi(self, bigram: Text) -> Tuple[float, float, float]:
+        """Pointwise mutual information log2(p(xy) / (p(x) p(y))) of a bigram,
+        with its (low, high) bounds from the count-min error bounds.
+        """
+        x, y = tokenize(bigram)
+        xy, xy_low = self.count(bigram)
+        (cx, cx_low), (cy, cy_low) = self.count(x), self.count(y)
+        n1, n2 = self.total(1), self.total(2)
+
+        def pmi(c_xy, c_x, c_y):
+            if c_xy <= 0:
+                return float('-inf')
+            return math.log2(c_xy * n1 * n1 / (max(c_x, 1) * max(c_y, 1) * n2))
+
+        return pmi(xy, cx, cy), pmi(xy_low, cx, cy), pmi(xy, cx_low, cy_low)
+
+    def collocations(self, top: int = 20, min_count: int = 20) -> List[Tuple[Text, int, float, float, float]]:
+        """(bigram, count, pmi, low, high) of the heavy hitter bigrams seen
+        at least min_count times, highest PMI first. Rare bigrams are left
+        out: PMI overrates them and the sketches only know the frequent ones.
+        """
+        scored = []
+        for bigram, count, error in self.top[2].top():
+            if count - error >= min_count:
+                scored.append((bigram, count) + self.pmi(bigram))
+        scored.sort(key=lambda row: -row[2])
+        return scored[:top]
+
+    def nbytes(self) -> int:
+        return sum(self.cms[n].nbytes + self.top[n].nbytes + self.distinct[n].nbytes
+                   for n in self.orders)
+
+    def error_bounds(self) -> Dict[int, Dict]:
+        """Per order, what the estimates can be off by."""
+        return {n: {'ngrams': self.total(n),
+                    'count_error': self.cms[n].error(),
+                    'count_epsilon': self.cms[n].epsilon,
+                    'count_delta': self.cms[n].delta,
+                    'top_k_error': self.top[n].error(),
+                    'distinct_relative_error': self.distinct[n].error()}
+                for n in self.orders}
+
+
+def db_lines(conn, play_id: int = None) -> Iterator[Text]:
+    """The spoken lines of a syncshake/asyncshake database (or one play)."""
+    sql = 'SELECT the_text FROM actor_lines WHERE is_stagedir = 0'
+    params: Tuple = ()
+    if play_id is not None:
+        sql, params = sql + ' AND play_id = ?', (play_id,)
+    for text, in conn.execute(sql + ' ORDER BY id', params):
+        yield text
+
+
+def dump_lines(path: Text, start: int = 0, end: int = None,
+               use_mmap: bool = False) -> Iterator[Text]:
+    """The lines of a countwords dump, or of the records starting in [start, end)."""
+    records = countwords.parse_records(countwords.iter_dump_lines(path, start, end, use_mmap),
+                                       countwords.dump_is_escaped(path))
+    return (text for line_id, text in records)
+
+
+def scaled(lines: Callable[[], Iterable[Text]], factor: int) -> Iterator[Text]:
+    """A synthetic corpus factor times the size: the lines, read factor times."""
+    for _ in range(factor):
+        yield from lines()
+
+
+def stats_play(db: Text, play_id: int, params: Dict) -> NgramStats:
+    conn = sqlite3.connect(db)
+    try:
+        return NgramStats(**params).update(db_lines(conn, play_id))
+    finally:
+        conn.close()
+
+
+def stats_range(path: Text, start: int, end: int, params: Dict) -> NgramStats:
+    return NgramStats(**params).update(dump_lines(path, start, end))
+
+
+def parallel_stats(db: Text = None, dump: Text = None, workers: int = None,
+                   **params) -> NgramStats:
+    """Sketch a database (split by play) or a dump (split by byte range) in a
+    process pool and merge the sketches.
+    """
+    workers = workers or os.cpu_count()
+    stats = NgramStats(**params)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        if dump is not None:
+            ranges = countwords.byte_ranges(dump, workers * countwords.RANGES_PER_WORKER)
+            results = executor.map(stats_range, [dump] * len(ranges), [r[0] for r in ranges],
+                                   [r[1] for r in ranges], [params] * len(ranges))
+        elif db is not None:
+            conn = sqlite3.connect(db)
+            play_ids = [row[0] for row in conn.execute('SELECT id FROM plays ORDER BY id')]
+            conn.close()
+            results = executor.map(stats_play, [db] * len(play_ids), play_ids,
+                                   [params] * len(play_ids))
+        else:
+            raise ValueError('need a database or a dump to read')
+        for result in results:
+            stats.merge(result)
+    return stats
+
+
+def exact_counts(lines: Iterable[Text], orders: Sequence[int] = (1, 2, 3)) -> Dict[int, collections.Counter]:
+    """Exact Counters of the same n-grams, to check the sketches against."""
+    counts = {n: collections.Counter() for n in orders}
+    lines = iter(lines)
+    while True:
+        batch = list(itertools.islice(lines, BATCH_LINES))
+        if not batch:
+            return counts
+        for n, counter in ngram_counts(batch, orders).items():
+            counts[n].update(counter)
+
+
+def _measure(function: Callable, trace: bool = True):
+    """(result, seconds, peak bytes allocated) of function(); tracemalloc
+    slows allocation down several times, so the peak is taken in a second run.
+    """
+    t = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - t
+    if not trace:
+        return result, seconds, None
+    tracemalloc.start()
+    try:
+        function()
+        return result, seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _mib(nbytes: Optional[int]) -> Text:
+    return '?' if nbytes is None else '%.1f MiB' % (nbytes / 2**20)
+
+
+def benchmark(lines: Callable[[], Iterable[Text]], factor: int = 1, exact: bool = True,
+              trace: bool = True, **params) -> Dict:
+    """Sketch the corpus (scaled up factor times) and, if exact, count it
+    exactly as well; report time, peak memory (if trace) and the errors
+    actually seen against the bounds.
+    """
+    results: Dict = {}
+    stats, seconds, peak = _measure(
+        lambda: NgramStats(**params).update(scaled(lines, factor)), trace)
+    results['sketch'] = {'time': seconds, 'peak': peak, 'nbytes': stats.nbytes()}
+    print('sketched %d lines in %.2fs, peak %s (sketches %s)'
+          % (stats.lines, seconds, _mib(peak), _mib(stats.nbytes())))
+    bounds = stats.error_bounds()
+    results['bounds'] = bounds
+    if exact:
+        counts, seconds, peak = _measure(
+            lambda: exact_counts(scaled(lines, factor), stats.orders), trace)
+        results['exact'] = {'time': seconds, 'peak': peak}
+        print('counted exactly in %.2fs, peak %s' % (seconds, _mib(peak)))
+    for n in stats.orders:
+        line = '%d-grams: %d, distinct ~%d, count error <= %.1f (p %.3f), top-k error <= %.1f' % (
+            n, stats.total(n), stats.distinct_count(n), bounds[n]['count_error'],
+            1 - bounds[n]['count_delta'], bounds[n]['top_k_error'])
+        if exact:
+            counter = counts[n]
+            keys = list(counter)
+            estimates = stats.cms[n].estimate_hashes(hash_array(keys))
+            errors = estimates - numpy.fromiter(counter.values(), dtype=numpy.int64, count=len(keys))
+            true_top = {item for item, count in counter.most_common(len(stats.top[n].counts) // 10)}
+            found = {item for item, count, error in stats.heavy_hitters(n, len(true_top))}
+            recall = len(true_top & found) / max(len(true_top), 1)
+            results[n] = {'distinct': len(counter), 'max_count_error': int(errors.max()),
+                          'over_bound': float(numpy.mean(errors > bounds[n]['count_error'])),
+                          'distinct_error': stats.distinct_count(n) / len(counter) - 1,
+                          'top_recall': recall}
+            line += ('\n    exact: distinct %d (%+.2f%%), max count error %d, %.3f%% over bound,'
+                     ' top %d recall %.2f'
+                     % (len(counter), results[n]['distinct_error'] * 100, errors.max(),
+                        results[n]['over_bound'] * 100, len(true_top), recall))
+        print(line)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='N-gram frequencies, heavy hitters and '
+                                     'collocations of the plays in bounded memory.')
+    parser.add_argument('--db', default='./syncshakedb.sqlite')
+    parser.add_argument('--dump', help='read a countwords dump instead of the database')
+    parser.add_argument('--memory', type=float, default=16, help='MiB for the sketches')
+    parser.add_argument('--top', type=int, default=1000, help='heavy hitters kept per order')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='sketch in this many processes and merge (0: in this process)')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='without --jobs, read the corpus this many times over')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare with exact counts instead of reporting')
+    args = parser.parse_args(argv)
+
+    params = {'memory': int(args.memory * 2**20), 'k': args.top}
+    if args.dump:
+        lines = lambda: dump_lines(args.dump)
+    else:
+        lines = lambda: db_lines(sqlite3.connect(args.db))
+    if args.benchmark:
+        benchmark(lines, args.scale, **params)
+        return
+    t = time.perf_counter()
+    if args.jobs:
+        stats = parallel_stats(None if args.dump else args.db, args.dump, args.jobs, **params)
+    else:
+        stats = NgramStats(**params).update(scaled(lines, args.scale))
+    print('sketched %d lines in %.2fs' % (stats.lines, time.perf_counter() - t), file=sys.stderr)
+    for n in stats.orders:
+        print('top %d-grams (~%d distinct):' % (n, stats.distinct_count(n)))
+        for ngram, count, error in stats.heavy_hitters(n, 10):
+            print('    %-30s %10d  +- %d' % (ngram, count, error))
+    print('collocations:')
+    for bigram, count, pmi, low, high in stats.collocations():
+        print('    %-30s %10d  pmi %.2f [%.2f, %.2f]' % (bigram, count, pmi, low, high))
+    for n, bounds in stats.error_bounds().items():
+        print('%d-gram count error <= %.1f with p %.3f, top-k error <= %.1f, '
+              'distinct error ~%.2f%%' % (n, bounds['count_error'], 1 - bounds['count_delta'],
+                                           bounds['top_k_error'],
+                                           bounds['distinct_relative_error'] * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,23 @@
 # coding: utf-8
 
 
+import alignment
+import contextlib
+import hashlib
 import os
 import re
+import urllib.error
 import urllib.request
 import xml.etree.ElementTree
 import xml.dom.minidom
 import time
 import sqlite3
-from typing import Dict, Text, List, Match, Any
+import ftsindex
+import playparser
+import wordfreq
+from playcache import ParsedPlayCache
+from textindex import MOBY_EDITION
+from typing import Dict, Text, List, Match, Any, Iterable, Tuple, Optional, Callable, BinaryIO
 
 
 MOBY_INDEX = [
@@ -93,6 +102,8 @@ MOBY_INDEX = [
 
 
 DBFILE = "./syncshakedb.sqlite"
+BATCH_SIZE = 5000
+ADD_EDITION = "ALTER TABLE plays ADD COLUMN edition TEXT DEFAULT '%s'" % MOBY_EDITION
 
 def create_tables(conn):
     # Now create the tables
@@ -100,7 +111,8 @@ def create_tables(conn):
                         (id        INTEGER PRIMARY KEY,
                         title     TEXT,
                         subtitle  TEXT,
-                        scene     TEXT
+                        scene     TEXT,
+                        edition   TEXT DEFAULT 'moby'
                         );''', 
                   '''CREATE TABLE IF NOT EXISTS acts
                          (id        INTEGER PRIMARY KEY,
@@ -130,10 +142,30 @@ def create_tables(conn):
                           name      TEXT,
                           description TEXT,
                           group_name TEXT
+                          );''',
+                    '''CREATE TABLE IF NOT EXISTS play_sources
+                         (play_id   INTEGER PRIMARY KEY,
+                          url       TEXT UNIQUE,
+                          content_hash TEXT,
+                          size      INTEGER,
+                          etag      TEXT,
+                          last_modified TEXT,
+                          fetched_at TEXT
                           );'''
                  ]
         [conn.execute(sql) for sql in tables]
+        add_edition(conn)
         conn.commit()
+        ftsindex.create_fts(conn)
+        wordfreq.create_freq(conn)
+        alignment.create_alignments(conn)
+
+def add_edition(conn) -> None:
+    """Add plays.edition to a database made before it existed; the plays
+    already there are all Moby ones."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(plays)')]
+    if 'edition' not in columns:
+        conn.execute(ADD_EDITION)
 
 def _get_text(nodelist: List):
     rc: List = []
@@ -212,34 +244,341 @@ def handle_act(act):
         result['scenes'].append(handle_scene(scene))
     return result
 
+def handle_play(play):
+    result: Dict = {}
+    result['title'] = handle_title(play.getElementsByTagName('TITLE')[0])
+    result['subtitle'] = handle_title(play.getElementsByTagName('PLAYSUBT')[0])
+    result['scene_description'] = handle_title(play.getElementsByTagName('SCNDESCR')[0])
+    result['personae'] = handle_personae(play.getElementsByTagName('PERSONAE')[0])
+    result['acts'] = []
+    acts = play.getElementsByTagName('ACT')
+    for act in acts:
+        result['acts'].append(handle_act(act))
+    return result
+
+def parse_play(play_text: bytes, streaming: bool = False) -> Dict:
+    if streaming:
+        return playparser.parse_play(play_text)
+    return handle_play(xml.dom.minidom.parseString(play_text))
+
+def split_persona(person) -> Tuple[Text, Text]:
+    """Split a (group, 'NAME, description') personae entry into name and description."""
+    matches: List[Text] = re.split(r',', person[1])
+    match: Match[Any] = re.match(r'[A-z ]*', matches[0])
+    name = match.group(0).strip(' .')
+    if len(matches) == 1:
+        return (name,'')
+    elif len(matches) == 2:
+        return (name, re.match(r'[A-z ]*',matches[1]).group(0).strip(' .'))
+    return (person[1],'')
+
+def get_sources(conn) -> Dict[Text, Dict]:
+    """The play_sources rows of the stored plays, keyed by url."""
+    cursor = conn.execute('''SELECT play_id, url, content_hash, size, etag, last_modified
+                            FROM play_sources''')
+    columns = [column[0] for column in cursor.description]
+    return {row[1]: dict(zip(columns, row)) for row in cursor}
+
+def delete_play(conn, play_id: int) -> None:
+    for table in ('actor_lines', 'scenes', 'acts', 'person') + wordfreq.TABLES:
+        conn.execute('DELETE FROM %s WHERE play_id = ?' % table, (play_id,))
+    conn.execute(alignment.DELETE, (play_id, play_id))
+    conn.execute('DELETE FROM plays WHERE id = ?', (play_id,))
+
+def insert_play(conn, title: Text, subtitle: Text, scene: Text, source: Dict = None,
+                edition: Text = MOBY_EDITION) -> int:
+    """Insert the plays row, replacing the stored copy of source's url if any.
+
+    The old rows are deleted in the same (uncommitted) transaction and the
+    old play id is reused, so a re-ingested play lands atomically at commit.
+    Copies of the same title and edition that no play_sources row points at
+    (left by runs that appended instead of replacing) are deleted with it.
+    """
+    source = source or {}
+    if source:
+        stale = [row[0] for row in conn.execute('''
+                    SELECT play_id FROM play_sources WHERE url = ?
+                    UNION
+                    SELECT id FROM plays WHERE title = ? AND edition = ?
+                        AND id NOT IN (SELECT play_id FROM play_sources)''',
+                    (source['url'], title, edition))]
+        for play_id in stale:
+            delete_play(conn, play_id)
+    cursor = conn.execute('''
+                INSERT INTO plays
+                (id, title, subtitle, scene, edition)
+                VALUES (?,?,?,?,?)''',
+                (source.get('play_id'), title, subtitle, scene, edition))
+    play_id: int = cursor.lastrowid
+    if source:
+        conn.execute('''
+            INSERT OR REPLACE INTO play_sources
+            (play_id, url, content_hash, size, etag, last_modified, fetched_at)
+            VALUES (?,?,?,?,?,?,datetime('now'))''',
+            (play_id, source['url'], source['content_hash'], source['size'],
+             source['etag'], source['last_modified']))
+    return play_id
+
+@contextlib.contextmanager
+def bulk_load(conn):
+    """Relax durability for the length of a bulk load.
+
+    Switches to WAL with synchronous=OFF and a big page cache, then puts the
+    original journal mode and synchronous setting back and runs ANALYZE.
+    The full-text index is rebuilt once at the end instead of line by line.
+    If the load raises, whatever it has not committed is rolled back.
+    """
+    journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    synchronous = conn.execute('PRAGMA synchronous').fetchone()[0]
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    try:
+        with ftsindex.deferred_fts(conn):
+            yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        conn.execute('PRAGMA synchronous=%d' % synchronous)
+        conn.execute('PRAGMA journal_mode=%s' % journal_mode)
+    conn.execute('ANALYZE')
+    conn.commit()
+
+class BulkLoader():
+    ''' Writes plays from playparser rows, batching persons and lines into
+        executemany calls and committing once per play. Each play is
+        written inside a savepoint, so one that fails part way leaves
+        nothing behind.
+    '''
+
+    def __init__(self, conn, batch_size: int = BATCH_SIZE) -> None:
+        self.conn = conn
+        self.batch_size: int = batch_size
+        self.lines: List[Tuple] = []
+        self.plays: int = 0
+        self.rows: int = 0
+        self.elapsed: float = 0.0
+
+    def _flush_people(self, people: List[Tuple]) -> None:
+        self.conn.executemany('''
+            INSERT INTO person
+            (play_id, name, description,group_name)
+            VALUES (?,?,?,?)''', people)
+        self.rows += len(people)
+        people.clear()
+
+    def _flush(self) -> None:
+        if self.lines:
+            self.conn.executemany('''
+                INSERT INTO actor_lines
+                (play_id, act_id, scene_id,
+                is_stagedir, the_text, speaker)
+                VALUES (?,?,?,?,?,?)''', self.lines)
+            self.rows += len(self.lines)
+            self.lines = []
+
+    def load(self, rows: Iterable[Tuple], source: Dict = None,
+             edition: Text = MOBY_EDITION,
+             unchanged: Callable[[], bool] = None) -> Optional[int]:
+        """Store one play given as playparser rows and return its id.
+
+        If rows raises (e.g. the XML is cut short) the play is rolled back and
+        the error re-raised.
+        @unchanged: for a source whose content_hash and size are only known
+        once rows is exhausted; called then, and if it returns True the play
+        is rolled back and None returned, otherwise the hash is stored
+        """
+        t = time.perf_counter()
+        conn = self.conn
+        rows_before = self.rows
+        people: List[Tuple] = []
+        conn.execute('SAVEPOINT load_play')
+        try:
+            play_id = self._load(rows, source, edition, people)
+            keep = unchanged is None or not unchanged()
+        except BaseException:
+            self._rollback(people, rows_before)
+            raise
+        if not keep:
+            self._rollback(people, rows_before)
+            return None
+        if unchanged is not None and source:
+            conn.execute('''
+                UPDATE play_sources SET content_hash = ?, size = ?
+                WHERE play_id = ?''', (source['content_hash'], source['size'], play_id))
+        conn.execute('RELEASE load_play')
+        conn.commit()
+        self.plays += 1
+        self.elapsed += time.perf_counter() - t
+        return play_id
+
+    def _rollback(self, people: List[Tuple], rows_before: int) -> None:
+        # drop the play's buffered rows so they are not written with the
+        # next play
+        self.lines = []
+        people.clear()
+        self.rows = rows_before
+        self.conn.execute('ROLLBACK TO load_play')
+        self.conn.execute('RELEASE load_play')
+
+    def _load(self, rows: Iterable[Tuple], source: Dict, edition: Text,
+              people: List[Tuple]) -> int:
+        conn = self.conn
+        play_id = act_id = scene_id = None
+        freq = None
+        act_num = scene_num = 0
+        speaker = None
+        for row in rows:
+            kind = row[0]
+            if kind in ('stagedir', 'speech'):
+                if kind == 'stagedir':
+                    self.lines.append((play_id, act_id, scene_id, 1, row[1], 'None'))
+                else:
+                    if row[1] is None:
+                        # same as store: keep the previous speaker
+                        print(row)
+                    else:
+                        speaker = row[1]
+                    self.lines.extend((play_id, act_id, scene_id, 0, line, speaker)
+                                      for line in row[2])
+                    for line in row[2]:
+                        freq.add(act_id, scene_id, speaker, line)
+                if len(self.lines) >= self.batch_size:
+                    self._flush()
+            elif kind == 'scene':
+                scene_num = scene_num + 1
+                cursor = conn.execute('''
+                    INSERT INTO scenes
+                    (play_id, act_id, title, scene_num)
+                    VALUES (?,?,?,?)''',
+                    (play_id, act_id, row[1], scene_num))
+                scene_id = cursor.lastrowid
+            elif kind == 'act':
+                self._flush_people(people)
+                print(title, row[1])
+                act_num = act_num + 1
+                scene_num = 0
+                cursor = conn.execute('''
+                    INSERT INTO acts
+                    (title, play_id, act_num)
+                    VALUES (?,?,?)''',
+                    (row[1], play_id, act_num))
+                act_id = cursor.lastrowid
+            elif kind == 'persona':
+                people.append((play_id,) + split_persona(row[1:]) + (row[1],))
+            elif kind == 'play':
+                title = row[1]
+                print(title)
+                play_id = insert_play(conn, *row[1:], source=source, edition=edition)
+                freq = wordfreq.PlayFrequencies(play_id)
+        self._flush_people(people)
+        self._flush()
+        if freq is not None:
+            self.rows += freq.write(conn)
+        return play_id
+
+    def report(self) -> Text:
+        return 'bulk loaded %d plays, %d rows in %.2fs (%.0f rows/s)' % (
+            self.plays, self.rows, self.elapsed, self.rows / max(self.elapsed, 1e-9))
+
+class HashingReader():
+    ''' Wraps a binary file object (an HTTP response) and keeps a sha256 and
+        byte count of everything read through it, so a play can be parsed
+        as it downloads and still be compared with the stored copy.
+    '''
+
+    def __init__(self, raw: BinaryIO) -> None:
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+        self.size: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self) -> Text:
+        return self.sha256.hexdigest()
+
+    def __enter__(self) -> 'HashingReader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.raw.close()
+
 class Play():
     
-    def __init__(self, title: str, url: str):
+    def __init__(self, title: str, url: str, source: Dict = None, incremental: bool = True):
         self.title: str = title
         self.url: str = url
+        # the play_sources row of the stored copy, if there is one
+        self.source: Dict = source or {}
+        # if False the play is reloaded even when the stored copy is current
+        self.incremental: bool = incremental
+        self.fetched: Dict = None
+
+    def open(self) -> Optional[HashingReader]:
+        """Open the play's XML, or return None if the server says the stored
+        copy is still current.
+
+        With incremental the request is conditional on the stored
+        ETag/Last-Modified. self.fetched is filled in except for content_hash
+        and size, which are only known once the body has been read.
+        """
+        request = urllib.request.Request(self.url)
+        if self.incremental and self.source.get('etag'):
+            request.add_header('If-None-Match', self.source['etag'])
+        if self.incremental and self.source.get('last_modified'):
+            request.add_header('If-Modified-Since', self.source['last_modified'])
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        self.fetched = {'play_id': self.source.get('play_id'), 'url': self.url,
+                        'content_hash': None, 'size': None,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}
+        return HashingReader(response)
+
+    def unchanged(self, reader: HashingReader) -> bool:
+        """Record the hash of everything read and say whether it matches the
+        stored copy (never, without incremental)."""
+        self.fetched['content_hash'] = reader.hexdigest()
+        self.fetched['size'] = reader.size
+        return self.incremental and self.fetched['content_hash'] == self.source.get('content_hash')
+
+    def fetch(self) -> Optional[bytes]:
+        """Fetch the play's XML, or None if the stored copy is still current.
+
+        With incremental the body is also compared by sha256, so unchanged
+        plays are never re-parsed.
+        """
+        reader = self.open()
+        if reader is None:
+            return None
+        with reader:
+            play_text = reader.read()
+        if self.unchanged(reader):
+            return None
+        return play_text
     
     
-    def store(self, play: Dict[str, Dict], conn):
+    def store(self, play: Dict[str, Dict], conn, source: Dict = None):
         print(play['title'])
         
-        cursor = conn.execute('''
-                    INSERT INTO plays
-                    (title, subtitle, scene)
-                    VALUES (?,?,?)''',
-                    (play['title'], play['subtitle'], play['scene_description']))
-        play_id: int = cursor.lastrowid
+        play_id: int = insert_play(conn, play['title'], play['subtitle'],
+                                   play['scene_description'], source)
+        freq = wordfreq.PlayFrequencies(play_id)
         # create the groups
         for person in play['personae']['persona']:
-            # split the name
-            matches: List[Text] = re.split(r',', person[1])
-            match: Match[Any] = re.match(r'[A-z ]*', matches[0])
-            name = match.group(0).strip(' .')
-            if len(matches) == 1:
-                persona = (name,'')
-            elif len(matches) == 2:
-                persona = (name, re.match(r'[A-z ]*',matches[1]).group(0).strip(' .'))
-            else:
-                persona = (person[1],'')
+            persona = split_persona(person)
             conn.execute('''
                 INSERT INTO person
                 (play_id, name, description,group_name)
@@ -287,53 +626,103 @@ class Play():
                                 VALUES (?,?,?,?,?,?)''',
                                 (play_id, act_id, scene_id,
                                 0, line, speaker))
+                            freq.add(act_id, scene_id, speaker, line)
                 # Increment scene_num
                 scene_num = scene_num + 1
             # Increment act num
             act_num = act_num + 1
+        freq.write(conn)
         # Commit this play.
         conn.commit()
 
-    def fetch_and_store(self, conn):
-        with urllib.request.urlopen(self.url) as response:
-            play_text = response.read()
-            play = xml.dom.minidom.parseString(play_text)
-            result: Dict = {}
-            result['title'] = handle_title(play.getElementsByTagName('TITLE')[0])              
-            result['subtitle'] = handle_title(play.getElementsByTagName('PLAYSUBT')[0])
-            result['scene_description'] = handle_title(play.getElementsByTagName('SCNDESCR')[0])
-            result['personae'] = handle_personae(play.getElementsByTagName('PERSONAE')[0])
-            result['acts'] = []
-            acts = play.getElementsByTagName('ACT')
-            for act in acts:
-                result['acts'].append(handle_act(act))
-            self.store(result, conn)
-
-def main():
+    def fetch_and_store(self, conn, streaming: bool = False, loader: BulkLoader = None,
+                        play_cache: ParsedPlayCache = None):
+        if streaming and play_cache is None:
+            self.stream_and_store(conn, loader)
+            return
+        play_text = self.fetch()
+        if play_text is None:
+            print('Unchanged: %s' % self.title)
+            return
+        if play_cache is not None:
+            play = play_cache.get_or_parse(play_text, lambda text: parse_play(text, streaming))
+        else:
+            play = parse_play(play_text, streaming)
+        if loader is not None:
+            loader.load(playparser.play_rows(play), self.fetched)
+        else:
+            self.store(play, conn, self.fetched)
+
+    def stream_and_store(self, conn, loader: BulkLoader = None):
+        """Parse the rows as the bytes arrive, hashing them on the way.
+
+        With a loader the rows go straight into it and the play is rolled
+        back if the body turns out unchanged; without one the play dict is
+        built from the rows and only stored if it changed.
+        """
+        reader = self.open()
+        if reader is None:
+            print('Unchanged: %s' % self.title)
+            return
+        with reader:
+            if loader is not None:
+                play_id = loader.load(playparser.iter_play_rows(reader), self.fetched,
+                                      unchanged=lambda: self.unchanged(reader))
+                changed = play_id is not None
+            else:
+                play = playparser.build_play(playparser.iter_play_rows(reader))
+                changed = not self.unchanged(reader)
+                if changed:
+                    self.store(play, conn, self.fetched)
+        if not changed:
+            print('Unchanged: %s' % self.title)
+
+def main(streaming: bool = False, bulk: bool = False, incremental: bool = False,
+         play_cache: ParsedPlayCache = None):
+    """Load MOBY_INDEX into DBFILE.
+    A play already stored from the same url is replaced, never appended.
+    @incremental: skip plays whose source is unchanged since they were stored
+    @play_cache: reuse parsed plays from this cache instead of parsing again
+    """
     print('entering main')
     #os.remove(DBFILE)
     with sqlite3.connect(DBFILE) as db:
         print('Creating tables')
         create_tables(db)
-        plays = [Play(play[0], play[1]) for play in MOBY_INDEX]
-        for play in plays:
-            play.fetch_and_store(db)
-        
-def get_stuff():
+        sources = get_sources(db)
+        plays = [Play(play[0], play[1], sources.get(play[1]), incremental)
+                 for play in MOBY_INDEX]
+        t = time.perf_counter()
+        changes = db.total_changes
+        if bulk:
+            loader = BulkLoader(db)
+            with bulk_load(db):
+                for play in plays:
+                    play.fetch_and_store(db, streaming, loader, play_cache)
+            print(loader.report())
+        else:
+            for play in plays:
+                play.fetch_and_store(db, streaming, play_cache=play_cache)
+        elapsed = time.perf_counter() - t
+        rows = db.total_changes - changes
+        print('stored %d rows in %.2fs (%.0f rows/s)' % (rows, elapsed, rows / max(elapsed, 1e-9)))
+        if play_cache is not None:
+            print(play_cache.stats.report())
+
+def get_stuff(like: Text = '%piss%', match: Text = None, mode: Text = 'token',
+              limit: int = None):
+    """Print the lines matching like, or with match given, the ranked
+    full-text matches of match (see ftsindex.match_expression for mode).
+    """
     conn = sqlite3.connect(DBFILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.execute('''SELECT 
-                                actor_lines.the_text, actor_lines.speaker, plays.title 
-                            FROM 
-                                actor_lines, plays 
-                            WHERE
-                                plays.id = actor_lines.play_id AND
-                                actor_lines.the_text LIKE ?
-                            ''', ('%piss%',))
+    if match is not None:
+        rows = ftsindex.search(conn, match, mode, limit)
+    else:
+        rows = ftsindex.search_like(conn, like, limit)
     x = 0
-    for row in cursor:
+    for row in rows:
         x = x + 1
-        print(tuple(row))
+        print((row['the_text'], row['speaker'], row['title'], row['act'], row['scene']))
     print(x)
 
 def get_tables():
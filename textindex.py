@@ -0,0 +1,262 @@
+# coding: utf-8
+
+"""
+Tokenizing of play lines for the word indexes.
+
+Every index (the MySQL words/word_to_line tables and anything built on
+SQLite) must split lines and normalise words the same way, or a query word
+would never meet the words that were indexed, so they all go through
+tokenize.
+
+PositionalIndex is a phrase/NEAR search engine over those token positions
+for the SQLite databases.
+
+    >>> tokenize("O'er the moon, 'tis True.")
+    ["o'er", 'the', 'moon', 'tis', 'true']
+"""
+import array
+import bisect
+import collections
+import heapq
+import re
+import statistics
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Text, Tuple, Union
+
+# a word is letters/digits, with apostrophes allowed inside it (o'er, ne'er)
+WORD = re.compile(r"\w+(?:'\w+)*")
+# plays.edition of the Moby XML plays. The readers (here, wordfreq, ftsindex,
+# similarity) default to it, so storing other editions of the plays next to
+# them (gutenberg.py) leaves their results alone; edition=None reads them all.
+MOBY_EDITION = 'moby'
+# the condition on plays.edition for an edition parameter, None for any
+EDITION_IS = 'plays.edition IS coalesce(?, plays.edition)'
+
+
+def tokenize(text: Text) -> List[Text]:
+    """The lower cased words of text, in order; a word's position is its index."""
+    return WORD.findall(text.lower())
+
+
+def positions(text: Text) -> Iterator[Tuple[int, Text]]:
+    """(line_pos, word) for each word of text."""
+    return enumerate(tokenize(text))
+
+
+Hit = collections.namedtuple('Hit', 'title act scene speaker line_ids start end')
+
+
+class PositionalIndex():
+    ''' In-memory positional index of the spoken lines of a SQLite corpus.
+
+        Every word of the corpus gets a position in one running token
+        stream, in actor_lines order; a posting list is the sorted array of
+        a word's positions. The lines of a speech (consecutive lines of one
+        speaker in one scene) are contiguous in the stream, so phrases and
+        NEAR windows can run on across line ends, but a match never crosses
+        from one speech into the next.
+
+            index = PositionalIndex.from_db(sqlite3.connect(syncshake.DBFILE))
+            for hit in index.search('NEAR("to be" question, 5)'):
+                print(hit.title, hit.speaker, index.text(hit))
+    '''
+
+    def __init__(self, conn, edition: Optional[Text] = MOBY_EDITION) -> None:
+        self.conn = conn
+        self.edition: Optional[Text] = edition
+        self.postings: Dict[Text, array.array] = {}
+        # first position of each line / speech, with what they belong to
+        self.line_starts: array.array = array.array('l')
+        self.line_ids: array.array = array.array('l')
+        self.speech_starts: array.array = array.array('l')
+        self.speeches: List[Tuple[Text, Text, Text, Text]] = []
+        self.size: int = 0
+
+    @classmethod
+    def from_db(cls, conn, edition: Optional[Text] = MOBY_EDITION) -> 'PositionalIndex':
+        index = cls(conn, edition)
+        index.build()
+        return index
+
+    def build(self) -> None:
+        cursor = self.conn.execute('''SELECT
+                                        actor_lines.id, actor_lines.scene_id, actor_lines.speaker,
+                                        actor_lines.is_stagedir, actor_lines.the_text,
+                                        plays.title, acts.title, scenes.title
+                                    FROM actor_lines
+                                        JOIN plays ON plays.id = actor_lines.play_id
+                                        LEFT JOIN acts ON acts.id = actor_lines.act_id
+                                        LEFT JOIN scenes ON scenes.id = actor_lines.scene_id
+                                    WHERE %s
+                                    ORDER BY actor_lines.id''' % EDITION_IS, (self.edition,))
+        postings: Dict[Text, List[int]] = collections.defaultdict(list)
+        position = 0
+        speech = None
+        for line_id, scene_id, speaker, is_stagedir, text, title, act, scene in cursor:
+            if is_stagedir:
+                speech = None
+                continue
+            if speech != (scene_id, speaker):
+                speech = (scene_id, speaker)
+                self.speech_starts.append(position)
+                self.speeches.append((title, act, scene, speaker))
+            self.line_starts.append(position)
+            self.line_ids.append(line_id)
+            for word in tokenize(text):
+                postings[word].append(position)
+                position += 1
+        self.postings = {word: array.array('l', positions)
+                         for word, positions in postings.items()}
+        self.size = position
+
+    def _speech(self, position: int) -> int:
+        return bisect.bisect_right(self.speech_starts, position) - 1
+
+    def hit(self, start: int, end: int) -> Hit:
+        """Describe the match of the tokens [start, end)."""
+        first = bisect.bisect_right(self.line_starts, start) - 1
+        last = bisect.bisect_right(self.line_starts, end - 1) - 1
+        return Hit(*self.speeches[self._speech(start)],
+                   tuple(self.line_ids[first:last + 1]), start, end)
+
+    def text(self, hit: Hit) -> Text:
+        """The lines of a hit, joined with ' / '."""
+        lines = dict(self.conn.execute('SELECT id, the_text FROM actor_lines WHERE id IN (%s)'
+                                       % ','.join('?' * len(hit.line_ids)), hit.line_ids))
+        return ' / '.join(lines[line_id] for line_id in hit.line_ids)
+
+    def occurrences(self, phrase: Union[Text, Sequence[Text]]) -> Iterator[Tuple[int, int]]:
+        """(start, end) of each occurrence of phrase within a speech, in order."""
+        words = tokenize(phrase) if isinstance(phrase, str) else list(phrase)
+        lists = [self.postings.get(word) for word in words]
+        if not words or not all(lists):
+            return
+        if len(words) == 1:
+            yield from ((position, position + 1) for position in lists[0])
+            return
+        # walk the rarest word and look the others up by bisection
+        pivot = min(range(len(words)), key=lambda i: len(lists[i]))
+        for position in lists[pivot]:
+            start = position - pivot
+            for i, positions in enumerate(lists):
+                j = bisect.bisect_left(positions, start + i)
+                if j == len(positions) or positions[j] != start + i:
+                    break
+            else:
+                if self._speech(start) == self._speech(start + len(words) - 1):
+                    yield start, start + len(words)
+
+    def phrase(self, phrase: Union[Text, Sequence[Text]]) -> Iterator[Hit]:
+        """Exact phrase matches, which may run over line ends within a speech."""
+        return (self.hit(start, end) for start, end in self.occurrences(phrase))
+
+    def near(self, terms: Sequence[Union[Text, Sequence[Text]]], k: int = 10,
+             ordered: bool = False) -> Iterator[Hit]:
+        """Spans holding every term (word or phrase) with at most k other tokens
+        between the first term and the last, within one speech.
+        @ordered: the terms must also come in the given order
+        """
+        if ordered:
+            spans = self._ordered(terms, k)
+        else:
+            spans = self._unordered(terms, k)
+        return (self.hit(start, end) for start, end in spans)
+
+    def _within(self, start: int, end: int, length: int, k: int) -> bool:
+        return end - start - length <= k and self._speech(start) == self._speech(end - 1)
+
+    def _ordered(self, terms, k: int) -> Iterator[Tuple[int, int]]:
+        lists = [list(self.occurrences(term)) for term in terms]
+        if not all(lists):
+            return
+        starts = [[occurrence[0] for occurrence in occurrences] for occurrences in lists[1:]]
+        for start, end in lists[0]:
+            # the tightest match: each term as soon as possible after the last
+            length = end - start
+            for occurrences, term_starts in zip(lists[1:], starts):
+                j = bisect.bisect_left(term_starts, end)
+                if j == len(term_starts):
+                    return
+                end = occurrences[j][1]
+                length += end - occurrences[j][0]
+                if end - start - length > k:
+                    break
+            else:
+                if self._within(start, end, length, k):
+                    yield start, end
+
+    def _tagged(self, term, i: int) -> Iterator[Tuple[int, int, int]]:
+        for start, end in self.occurrences(term):
+            yield start, end, i
+
+    def _unordered(self, terms, k: int) -> Iterator[Tuple[int, int]]:
+        streams = [self._tagged(term, i) for i, term in enumerate(terms)]
+        latest: List[Optional[Tuple[int, int]]] = [None] * len(terms)
+        last = None
+        # the tightest window ending at each occurrence, from the latest
+        # occurrence of every other term
+        for start, end, i in heapq.merge(*streams):
+            latest[i] = (start, end)
+            if None in latest:
+                continue
+            # this occurrence starts last, so it ends the window
+            first = min(latest)[0]
+            length = sum(e - s for s, e in latest)
+            if end - first - length > k or (first, end) == last:
+                continue
+            spans = sorted(latest)
+            if any(a[1] > b[0] for a, b in zip(spans, spans[1:])):
+                continue
+            if self._speech(first) == self._speech(end - 1):
+                last = (first, end)
+                yield last
+
+    def search(self, query: Text) -> Iterator[Hit]:
+        """Run a query in a small FTS5 like syntax:
+
+            "to be or not"                      exact phrase
+            NEAR("to be" question, 5)           all terms within 5 tokens
+            ONEAR(slings arrows fortune, 3)     the same, in this order
+
+        Anything else is taken as a phrase of its words.
+        """
+        match = re.match(r'\s*(O?NEAR)\((.*?)(?:,\s*(\d+))?\)\s*$', query)
+        if match is None:
+            return self.phrase(query.strip().strip('"'))
+        terms = re.findall(r'"([^"]*)"|(\S+)', match.group(2))
+        return self.near([phrase or word for phrase, word in terms],
+                         int(match.group(3) or 10), match.group(1) == 'ONEAR')
+
+
+def benchmark(index: PositionalIndex, queries: Sequence[Text], repeat: int = 5) -> List[Dict]:
+    """Median latency of each query, running the generator to the end."""
+    results = []
+    for query in queries:
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            count = sum(1 for hit in index.search(query))
+            times.append(time.perf_counter() - t)
+        first = time.perf_counter()
+        next(iter(index.search(query)), None)
+        first = time.perf_counter() - first
+        results.append({'query': query, 'hits': count, 'time': statistics.median(times),
+                        'first': first})
+        print('%-40s %7d hits %8.2fms  (first hit %.2fms)'
+              % (query, count, statistics.median(times) * 1000, first * 1000))
+    return results
+
+
+BENCHMARK_QUERIES = ['"to be or not"', '"the king"', 'NEAR("to be" question, 5)',
+                     'ONEAR(slings arrows fortune, 3)', 'NEAR(heart ache, 0)']
+
+
+if __name__ == '__main__':
+    import sqlite3
+    import sys
+    t = time.perf_counter()
+    index = PositionalIndex.from_db(sqlite3.connect(sys.argv[1] if len(sys.argv) > 1
+                                                    else './syncshakedb.sqlite'))
+    print('indexed %d tokens, %d words, %d speeches in %.2fs'
+          % (index.size, len(index.postings), len(index.speeches), time.perf_counter() - t))
+    benchmark(index, sys.argv[2:] or BENCHMARK_QUERIES)
@@ -0,0 +1,219 @@
+# coding: utf-8
+
+"""
+Word frequency tables kept up to date at ingest.
+
+As each play is stored its spoken lines are tokenized (textindex.tokenize)
+and the counts are written, in the same transaction as its actor_lines, to
+
+    play_words(play_id, word, count)
+    act_words(act_id, play_id, word, count)
+    scene_words(scene_id, play_id, word, count)
+    speaker_words(play_id, speaker, word, count)
+
+Every table carries play_id, so when a play is re-ingested delete_play
+clears its counts along with its lines and the new counts replace them.
+Frequency questions are then index lookups:
+
+    top_words(conn, play='Hamlet')
+    exclusive_words(conn, 'FALSTAFF')
+"""
+import collections
+from typing import Dict, List, Optional, Text, Tuple
+
+from textindex import EDITION_IS, MOBY_EDITION, tokenize
+
+TABLES: Tuple[Text, ...] = ('play_words', 'act_words', 'scene_words', 'speaker_words')
+
+FREQ_TABLES: List[Text] = ['''CREATE TABLE IF NOT EXISTS play_words
+                             (play_id   INTEGER,
+                              word      TEXT,
+                              count     INTEGER,
+                              PRIMARY KEY (play_id, word)
+                              ) WITHOUT ROWID;''',
+                           '''CREATE TABLE IF NOT EXISTS act_words
+                             (act_id    INTEGER,
+                              play_id   INTEGER,
+                              word      TEXT,
+                              count     INTEGER,
+                              PRIMARY KEY (act_id, word)
+                              ) WITHOUT ROWID;''',
+                           '''CREATE TABLE IF NOT EXISTS scene_words
+                             (scene_id  INTEGER,
+                              play_id   INTEGER,
+                              word      TEXT,
+                              count     INTEGER,
+                              PRIMARY KEY (scene_id, word)
+                              ) WITHOUT ROWID;''',
+                           '''CREATE TABLE IF NOT EXISTS speaker_words
+                             (play_id   INTEGER,
+                              speaker   TEXT,
+                              word      TEXT,
+                              count     INTEGER,
+                              PRIMARY KEY (play_id, speaker, word)
+                              ) WITHOUT ROWID;''',
+                           'CREATE INDEX IF NOT EXISTS play_words_word ON play_words (word)',
+                           'CREATE INDEX IF NOT EXISTS act_words_play ON act_words (play_id)',
+                           'CREATE INDEX IF NOT EXISTS scene_words_play ON scene_words (play_id)',
+                           '''CREATE INDEX IF NOT EXISTS speaker_words_speaker
+                              ON speaker_words (speaker, word)''',
+                           'CREATE INDEX IF NOT EXISTS speaker_words_word ON speaker_words (word)']
+
+FREQ_EXISTS = '''SELECT count(*) = %d FROM sqlite_master WHERE type = 'table' AND name IN (%s)''' % (
+    len(TABLES), ', '.join("'%s'" % table for table in TABLES))
+
+INSERTS: Dict[Text, Text] = {
+    'play_words': 'INSERT INTO play_words (play_id, word, count) VALUES (?,?,?)',
+    'act_words': 'INSERT INTO act_words (act_id, play_id, word, count) VALUES (?,?,?,?)',
+    'scene_words': 'INSERT INTO scene_words (scene_id, play_id, word, count) VALUES (?,?,?,?)',
+    'speaker_words': '''INSERT INTO speaker_words (play_id, speaker, word, count)
+                        VALUES (?,?,?,?)'''}
+
+
+class PlayFrequencies():
+    ''' Word counts of one play by play, act, scene and speaker, gathered
+        line by line while the play is written.
+    '''
+
+    def __init__(self, play_id: int) -> None:
+        self.play_id: int = play_id
+        # only the finest grain is counted per line, the rest is summed up
+        # from it in rows()
+        self.counts: Dict[Tuple[int, int, Text], collections.Counter] = \
+            collections.defaultdict(collections.Counter)
+
+    def add(self, act_id: int, scene_id: int, speaker: Text, text: Text) -> None:
+        """Count the words of one spoken line."""
+        self.counts[(act_id, scene_id, speaker)].update(tokenize(text))
+
+    def rows(self) -> Dict[Text, List[Tuple]]:
+        """The rows to insert, by table."""
+        play: collections.Counter = collections.Counter()
+        acts: Dict[int, collections.Counter] = collections.defaultdict(collections.Counter)
+        scenes: Dict[int, collections.Counter] = collections.defaultdict(collections.Counter)
+        speakers: Dict[Text, collections.Counter] = collections.defaultdict(collections.Counter)
+        for (act_id, scene_id, speaker), words in self.counts.items():
+            play.update(words)
+            acts[act_id].update(words)
+            scenes[scene_id].update(words)
+            speakers[speaker].update(words)
+        play_id = self.play_id
+        return {'play_words': [(play_id, word, count) for word, count in play.items()],
+                'act_words': [(act_id, play_id, word, count)
+                              for act_id, words in acts.items()
+                              for word, count in words.items()],
+                'scene_words': [(scene_id, play_id, word, count)
+                                for scene_id, words in scenes.items()
+                                for word, count in words.items()],
+                'speaker_words': [(play_id, speaker, word, count)
+                                  for speaker, words in speakers.items()
+                                  for word, count in words.items()]}
+
+    def write(self, conn) -> int:
+        """Insert the counts without committing; returns the number of rows."""
+        rows = 0
+        for table, table_rows in self.rows().items():
+            conn.executemany(INSERTS[table], table_rows)
+            rows += len(table_rows)
+        return rows
+
+
+def create_freq(conn) -> bool:
+    """Create the tables and fill them from any plays already stored.
+
+    Returns True if the tables were created by this call.
+    """
+    created = not conn.execute(FREQ_EXISTS).fetchone()[0]
+    for sql in FREQ_TABLES:
+        conn.execute(sql)
+    if created:
+        rebuild_freq(conn)
+    conn.commit()
+    return created
+
+
+def rebuild_freq(conn) -> None:
+    """Recount every play from actor_lines."""
+    for table in TABLES:
+        conn.execute('DELETE FROM %s' % table)
+    freq = None
+    for play_id, act_id, scene_id, speaker, text in conn.execute('''
+            SELECT play_id, act_id, scene_id, speaker, the_text
+            FROM actor_lines WHERE is_stagedir = 0 ORDER BY play_id''').fetchall():
+        if freq is None or freq.play_id != play_id:
+            if freq is not None:
+                freq.write(conn)
+            freq = PlayFrequencies(play_id)
+        freq.add(act_id, scene_id, speaker, text)
+    if freq is not None:
+        freq.write(conn)
+    conn.commit()
+
+
+# the play ids of an edition parameter (see textindex.EDITION_IS)
+IN_EDITION = 'play_id IN (SELECT id FROM plays WHERE %s)' % EDITION_IS
+
+
+def _play_id(conn, play: Text, edition: Optional[Text] = MOBY_EDITION) -> Optional[int]:
+    row = conn.execute('SELECT id FROM plays WHERE title = ? AND %s' % EDITION_IS,
+                       (play, edition)).fetchone()
+    return row[0] if row else None
+
+
+def top_words(conn, n: int = 20, play: Text = None, act_id: int = None,
+              scene_id: int = None, speaker: Text = None,
+              edition: Optional[Text] = MOBY_EDITION) -> List[Tuple[Text, int]]:
+    """The n most frequent (word, count) of a scene, an act, a speaker (in
+    one play if play is given, else in all), a play (by title) or the corpus,
+    counting the plays of edition only (all editions if None).
+    """
+    if scene_id is not None:
+        sql, params = 'SELECT word, count FROM scene_words WHERE scene_id = ?', [scene_id]
+    elif act_id is not None:
+        sql, params = 'SELECT word, count FROM act_words WHERE act_id = ?', [act_id]
+    elif speaker is not None:
+        sql, params = 'SELECT word, SUM(count) FROM speaker_words WHERE speaker = ?', [speaker]
+        if play is not None:
+            sql, params = sql + ' AND play_id = ?', params + [_play_id(conn, play, edition)]
+        else:
+            sql, params = sql + ' AND ' + IN_EDITION, params + [edition]
+        sql += ' GROUP BY word'
+    elif play is not None:
+        sql, params = ('SELECT word, count FROM play_words WHERE play_id = ?',
+                       [_play_id(conn, play, edition)])
+    else:
+        sql, params = ('SELECT word, SUM(count) FROM play_words WHERE %s GROUP BY word' % IN_EDITION,
+                       [edition])
+    return conn.execute(sql + ' ORDER BY 2 DESC, 1 LIMIT ?', params + [n]).fetchall()
+
+
+def word_count(conn, word: Text, by: Text = 'play',
+               edition: Optional[Text] = MOBY_EDITION) -> List[Tuple]:
+    """How often word is used in each play ((title, count)) or by each
+    speaker ((title, speaker, count)) of edition (all if None), most first.
+    """
+    word = ' '.join(tokenize(word))
+    if by == 'play':
+        sql = '''SELECT plays.title, play_words.count FROM play_words
+                 JOIN plays ON plays.id = play_words.play_id
+                 WHERE play_words.word = ? AND %s ORDER BY 2 DESC'''
+    elif by == 'speaker':
+        sql = '''SELECT plays.title, speaker_words.speaker, speaker_words.count
+                 FROM speaker_words JOIN plays ON plays.id = speaker_words.play_id
+                 WHERE speaker_words.word = ? AND %s ORDER BY 3 DESC'''
+    else:
+        raise ValueError('by must be "play" or "speaker", not %r' % by)
+    return conn.execute(sql % EDITION_IS, (word, edition)).fetchall()
+
+
+def exclusive_words(conn, speaker: Text, n: int = None,
+                    edition: Optional[Text] = MOBY_EDITION) -> List[Tuple[Text, int]]:
+    """The words only speaker ever uses, in any play of edition (all if
+    None), most used first."""
+    return conn.execute('''SELECT word, SUM(count) FROM speaker_words AS mine
+                           WHERE speaker = ? AND %s AND NOT EXISTS
+                               (SELECT 1 FROM speaker_words AS other
+                                WHERE other.word = mine.word AND other.speaker != mine.speaker
+                                    AND other.%s)
+                           GROUP BY word ORDER BY 2 DESC, 1 LIMIT ?''' % (IN_EDITION, IN_EDITION),
+                        (speaker, edition, edition, -1 if n is None else n)).fetchall()